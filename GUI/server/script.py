@@ -2,15 +2,24 @@ import torch
 from PIL import Image
 from torchvision.transforms import transforms
 import pandas as pd
-from torchvision.models import resnet50, ResNet50_Weights
+from torchvision.models import ResNet50_Weights
 import matplotlib.pyplot as plt
 import cv2
+import numpy as np
 import os
+import sys
 
 # Image.MAX_IMAGE_PIXELS = None
 
 dirname = os.path.dirname(__file__)
 
+# The models and checkpoints are shared with the training code at the root of the repository
+sys.path.insert(0, os.path.join(dirname, '..', '..'))
+from config import PREVIEW_SIZE
+from src.checkpoint import load_checkpoint
+from src.data import image_io
+from src.models.pretrained import get_pretrained_od_model, get_pretrained_resnet50
+
 '''
     Gets and returns the dimensions of a chosen image
     Inputs: 
@@ -22,6 +31,19 @@ def getImageSize(path):
     width, height = Image.open(path).size
     return height, width
 
+'''
+    Decodes a preview of an image no larger than max_size with the image loading of the training code, which
+    decodes large JPEGs at a reduced resolution
+    Inputs:
+            path - denotes the absolute path to the image
+            max_size - the maximum width and height of the preview
+    Returns:
+            The preview as a BGR array for cv2 and the scale from image to preview coordinates
+'''
+def load_preview(path, max_size=PREVIEW_SIZE):
+    preview, scale = image_io.load_preview(path, max_size)
+    return cv2.cvtColor(np.asarray(preview), cv2.COLOR_RGB2BGR), scale
+
 '''
     The code to run both the detector and the classifier on a selected image
     Inputs: 
@@ -33,14 +55,17 @@ def bird_classifier(path):
     print(dirname)
     torch.manual_seed(2023)
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-    detector_path = os.path.join(dirname, 'models/bird_only.pth')
-    classifier_path = os.path.join(dirname, 'models/bird_classifier.pth')
+    # Checkpoints written by train_detector.py and train_classifier.py, i.e. copies of their best <name>.pt
+    detector_path = os.path.join(dirname, 'models/bird_only.pt')
+    classifier_path = os.path.join(dirname, 'models/bird_classifier.pt')
     img_path = path
+    num_detector_class = 2
     num_class = 23
    
     # Load trained bird detector
-    detector = torch.load(detector_path, map_location=device)
-    detector.eval()
+    detector = get_pretrained_od_model(num_detector_class, pretrained=False)
+    detector.load_state_dict(load_checkpoint(detector_path)['model'])
+    detector.to(device).eval()
    
     # Upload and transform image 
     transformer = transforms.Compose([transforms.PILToTensor(),
@@ -65,6 +90,7 @@ def bird_classifier(path):
     height, width = getImageSize(path)
     
     bird_data = []
+    preview, scale = load_preview(path)
 
     for box in boxes_array:
         x1, y1, x2, y2 = box
@@ -73,7 +99,7 @@ def bird_classifier(path):
         #sql.addRow(x1, y1, x2-x1, y2-y1)
         bird_data.append(['', '', int(x1), int(y1), int(x2-x1), int(y2-y1)])
 
-        cropped_birds_expanded.append(draw_box(path, int(x1), int(y1), int(x2), int(y2)))
+        cropped_birds_expanded.append(draw_box(preview, int(x1 * scale), int(y1 * scale), int(x2 * scale), int(y2 * scale)))
 
     for i in range(len(cropped_birds)):
         string1 = 'upload/bird' + str(i) + '.jpg'
@@ -84,8 +110,9 @@ def bird_classifier(path):
     weights = ResNet50_Weights.IMAGENET1K_V2
     preprocess = weights.transforms()
    
-    resnet = torch.load(classifier_path, map_location=device)
-    resnet.eval()
+    resnet = get_pretrained_resnet50(num_class, weights=None)
+    resnet.load_state_dict(load_checkpoint(classifier_path)['model'])
+    resnet.to(device).eval()
                                                 
     # Classify birds
     bird_tensors = torch.stack([preprocess(bird_image) for bird_image in cropped_birds])
@@ -139,17 +166,16 @@ def bird_classifier(path):
 '''
     Draws a box around the bird that we are currently working on and returns it to be saved
     Inputs: 
-            path - denotes the absolute path to the image being worked on
+            img - the preview of the image being worked on, as returned by load_preview
             x1 - the x coordinate of the top left corner of the box
             y1 - the y coordinate of the top left corner of the box 
             x2 - the x coordinate of the bottom right corner of the box
             y2 - the y coordinate of the bottom right corner of the box
 
     Returns:
-            A copy of the image found in path with a red box drawn around it
+            A copy of the preview with a red box drawn around it
 '''
-def draw_box(path, x1, y1, x2, y2):
-    img = cv2.imread(path)
+def draw_box(img, x1, y1, x2, y2):
     imgCopy = img.copy()
     cv2.rectangle(imgCopy, (x1, y1), (x2, y2), (0, 0, 255), 5)
     return imgCopy
\ No newline at end of file
@@ -1,3 +1,4 @@
+import os
 import torch
 
 # Flags for training detector
@@ -5,18 +6,46 @@ BIRD_ONLY = True
 
 # Constants
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+DIST_BACKEND = None  # backend of distributed training with launch.py or torchrun, None for NCCL on GPUs, else gloo
 SEED = 2023
 DPI = 500
+PREVIEW_SIZE = 2048  # maximum width and height of visualized predictions
 
 # Configurations
 CONFIG_DETECTOR = {
     'model': ('bird_only', 2) if BIRD_ONLY else ('species', 23),  # NOTE: 23 is read from ../database/class_id.csv,
     'data_split': (0.8, 0.1, 0.1),
-    "batch_size": 8
+    "batch_size": 8,
+    'group_by_size': True,  # batch tiles of a similar size and aspect ratio together
+    'background_ratio': 0.25,  # fraction of the tiles without birds drawn every epoch
+    'rare_repeat': 2,  # number of times tiles with rare species are drawn every epoch
+    'window_size': None,  # (height, width) to train on random windows of the raw images instead of tiles
+    'windows_per_epoch': 4000,
+    'eval_workers': min(os.cpu_count() or 1, 8),  # processes evaluating precision and recall on shards of the images
+    'train_stats_fraction': 0.1,  # fraction of the training set evaluated every epoch, None to skip
+    'eval_every_epochs': 1,  # epochs between evaluations, the last epoch is always evaluated
+    'eval_every_minutes': None,  # also evaluate once this many minutes have passed since the last evaluation
+    'eval_subset': None,  # number or fraction of validation samples to evaluate on, None for all
+    'async_eval': False,  # evaluate checkpoints in a separate process while training continues
+    'mixed_precision': False,  # bfloat16 on the CPU, float16 with gradient scaling on a GPU
+    'accumulation_steps': 1,  # batches per optimizer step, the effective batch size is batch_size times this
+    'warmup_steps': 0,  # optimizer steps of linear learning rate warmup
+    'checkpoint_every': 1,  # epochs between checkpoints of the training state, the last epoch is always saved
+    'resume': False  # resume from the latest checkpoint of the training state if there is one
 }
 CONFIG_CLASSIFIER = {
     'model': 'resnet50',
-    'batch_size': 32
+    'batch_size': 32,
+    'cache_preprocess': True,
+    'eval_every_epochs': 1,
+    'eval_every_minutes': None,
+    'eval_subset': None,
+    'async_eval': False,
+    'mixed_precision': False,
+    'accumulation_steps': 1,
+    'warmup_steps': 0,
+    'checkpoint_every': 1,
+    'resume': False
 }
 
 # Hyperparameters
@@ -38,18 +67,28 @@ DATA_PATH = "../database/"
 IMG_PATH = DATA_PATH + 'detection/raw_data/annotated_images/'
 OLD_CSV_PATH = DATA_PATH + 'detection/raw_data/annotations_xywh/'
 NEW_CSV_PATH = DATA_PATH + 'detection/raw_data/annotations_xxyy/'
+ANNOTATIONS_PATH = DATA_PATH + 'detection/raw_data/annotations.parquet'
+CATALOG_PATH = DATA_PATH + 'detection/raw_data/catalog.json'
 
 # Tiled images path
 TILED_IMG_PATH = DATA_PATH + 'detection/tiled_data/annotated_images/'
 TILED_OLD_CSV_PATH = DATA_PATH + 'detection/tiled_data/annotations_xywh/'
 TILED_NEW_CSV_PATH = DATA_PATH + 'detection/tiled_data/annotations_xxyy/'
+TILED_ANNOTATIONS_PATH = DATA_PATH + 'detection/tiled_data/annotations.parquet'
+TILED_CATALOG_PATH = DATA_PATH + 'detection/tiled_data/catalog.json'
 
 # Cropped images path
 CROPPED_PATH = DATA_PATH + 'cropped/'
-CROPPED_SPLIT_PATH = DATA_PATH + 'cropped_splitted/'
-CLF_TRAIN_PATH = CROPPED_SPLIT_PATH + 'train/'
-CLF_VAL_PATH = CROPPED_SPLIT_PATH + 'val/'
-CLF_TEST_PATH = CROPPED_SPLIT_PATH + 'test/'
+SPLIT_INDEX_PATH = DATA_PATH + 'cropped_split.csv'
+
+# Packed cropped images path
+CROPPED_PACKED_PATH = DATA_PATH + 'cropped_packed/'
+
+# Preprocessed classifier inputs path
+PREPROCESS_CACHE_PATH = DATA_PATH + 'preprocess_cache/'
+
+# Manifest of processed files path
+MANIFEST_PATH = DATA_PATH + 'manifest.json'
 
 # Models path
 DETECTOR_PATH = DATA_PATH + 'models/' + CONFIG_DETECTOR['model'][0] + '/'
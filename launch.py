@@ -0,0 +1,33 @@
+import argparse
+import os
+import torch
+from torch.distributed import run
+
+
+def launch(script, nproc_per_node, script_args=()):
+    '''
+    Runs a training script in several local processes for distributed data parallel training, like
+    torchrun --standalone. The processes get the environment variables of torchrun, from which the script joins
+    the process group, and divide the CPU cores between them.
+
+    Input:
+        script (str): Path of the training script, e.g. train_detector.py or train_classifier.py
+        nproc_per_node (int): Number of processes, at most one per GPU where GPUs are used
+        script_args (list of str): Command line arguments of the script. Default is no arguments.
+    '''
+    # torchrun would otherwise limit every process to one thread
+    if 'OMP_NUM_THREADS' not in os.environ:
+        os.environ['OMP_NUM_THREADS'] = str(max(1, (os.cpu_count() or 1) // nproc_per_node))
+    run.main(['--standalone', f'--nproc_per_node={nproc_per_node}', script, *script_args])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train in several local processes with distributed data parallel.')
+    parser.add_argument('--nproc_per_node', type=int, default=torch.cuda.device_count() or None,
+                        help='number of processes, by default one per GPU; required without GPUs')
+    parser.add_argument('script', help='training script, e.g. train_detector.py')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER, help='arguments of the training script')
+    args = parser.parse_args()
+    if args.nproc_per_node is None:
+        parser.error('--nproc_per_node is required without GPUs')
+    launch(args.script, args.nproc_per_node, args.script_args)
@@ -0,0 +1,177 @@
+import atexit
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+from .data.coco.utils import all_gather, get_rank
+
+
+def get_rng_state():
+    '''
+    Returns the states of the Python, numpy and torch random number generators, including those of the GPUs.
+    '''
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    '''
+    Restores the random number generators from a state returned by get_rng_state.
+    '''
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def training_state(epoch, model, optimizer, scaler=None, scheduler=None, metrics=None):
+    '''
+    Returns the state to resume training after an epoch. In distributed training every process calls it, as the
+    random number generator states of all processes are gathered.
+
+    Args:
+        epoch (int): Index of the last finished epoch.
+        model (torch.nn.Module): Model being trained.
+        optimizer (torch.optim.Optimizer): Optimizer of the model.
+        scaler (GradScaler, optional): Gradient scaler of mixed precision training. Default is None.
+        scheduler (torch.optim.lr_scheduler.LRScheduler, optional): Learning rate scheduler. Default is None.
+        metrics (dict, optional): Metric lists recorded so far. Default is None.
+
+    Returns:
+        A dictionary of the epoch, the state_dicts, the random number generator states of every process and the
+        metrics.
+    '''
+    return {
+        'epoch': epoch,
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scaler': scaler.state_dict() if scaler is not None else None,
+        'scheduler': scheduler.state_dict() if scheduler is not None else None,
+        'rng': all_gather(get_rng_state()),
+        'metrics': metrics
+    }
+
+
+def restore_training_state(checkpoint, model, optimizer=None, scaler=None, scheduler=None):
+    '''
+    Loads a state returned by training_state into the model, optimizer, scaler and scheduler and restores the
+    random number generators of the process, so that training continues with the same batches as without
+    interruption.
+
+    Returns:
+        A tuple of the index of the last finished epoch and the metric lists.
+    '''
+    model.load_state_dict(checkpoint['model'])
+    if optimizer is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    if scaler is not None and checkpoint['scaler'] is not None:
+        scaler.load_state_dict(checkpoint['scaler'])
+    if scheduler is not None and checkpoint['scheduler'] is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    rng = checkpoint['rng']
+    set_rng_state(rng[get_rank()] if get_rank() < len(rng) else rng[0])
+    return checkpoint['epoch'], checkpoint['metrics']
+
+
+def save_checkpoint(state, path):
+    '''
+    Saves a checkpoint atomically, so that the file at the path is always either the previous or the new one.
+    '''
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path):
+    '''
+    Loads a checkpoint to the CPU. The state_dicts are copied to the device of the model when loaded into it.
+    '''
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def _snapshot(obj):
+    # copy tensors to the CPU and containers, so that training can continue while the copy is written
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {key: _snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    '''
+    Writes checkpoints in a background thread. A checkpoint is copied when it is queued, and written to a temporary
+    file which then replaces the checkpoint file, so an interrupted write never leaves a corrupt checkpoint.
+    '''
+    def __init__(self):
+        '''
+        Initialize CheckpointWriter object and start the writer thread, which is flushed at exit if not closed.
+        '''
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        # write the queued checkpoints until None is received
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                state, paths, done = task
+                for path in paths:
+                    save_checkpoint(state, path)
+                if done is not None:
+                    done()
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        # raise the error of a failed write in the training thread
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f'Writing a checkpoint failed: {error!r}') from error
+
+    def save(self, state, *paths, done=None):
+        '''
+        Copies a checkpoint and queues it to be written to one or more paths.
+
+        Args:
+            state (dict): Checkpoint, e.g. from training_state.
+            paths (str): Paths of the checkpoint files.
+            done (function, optional): Function called without arguments once the checkpoint is written.
+                Default is None.
+        '''
+        self._raise()
+        self._queue.put((_snapshot(state), paths, done))
+
+    def wait(self):
+        '''
+        Waits until every queued checkpoint is written.
+        '''
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        '''
+        Writes the queued checkpoints and stops the writer thread.
+        '''
+        if self._thread is None:
+            return
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._raise()
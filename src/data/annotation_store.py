@@ -0,0 +1,162 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .spatial_index import BoxIndex
+
+# Columns of the per-image csv files written by convert_annotations
+CSV_COLUMNS = ['class_id', 'class_name', 'xmax', 'xmin', 'ymax', 'ymin']
+
+# Key of the schema metadata listing every image, including images without any bounding box
+IMAGES_KEY = b'avialert.images'
+
+
+def write_annotation_store(frames, store_path):
+    '''
+    Writes the annotations of many images into one typed Parquet file. Every row holds the key of its image,
+    the bounding box in both xywh and xyxy format, the class name and the class id.
+
+    Args:
+        frames (Dict): Dictionary mapping image keys (file names without extension) to the dataframes
+            of the converted csv files.
+        store_path (str): Path of the Parquet file to write.
+    '''
+    images = sorted(frames)
+    parts = [frames[image].assign(image=image) for image in images]
+    frame = pd.concat(parts, axis=0, ignore_index=True) if parts else pd.DataFrame(columns=CSV_COLUMNS + ['image'])
+
+    # build typed columns
+    xmin = frame['xmin'].to_numpy(dtype=np.int32)
+    ymin = frame['ymin'].to_numpy(dtype=np.int32)
+    xmax = frame['xmax'].to_numpy(dtype=np.int32)
+    ymax = frame['ymax'].to_numpy(dtype=np.int32)
+    store = pd.DataFrame({
+        'image': pd.Categorical(frame['image'], categories=images),
+        'x': xmin,
+        'y': ymin,
+        'width': xmax - xmin,
+        'height': ymax - ymin,
+        'xmin': xmin,
+        'ymin': ymin,
+        'xmax': xmax,
+        'ymax': ymax,
+        'class_name': pd.Categorical(frame['class_name'].astype(str)),
+        'class_id': frame['class_id'].to_numpy(dtype=np.int32),
+    })
+
+    # keep the list of images in the metadata so images without boxes are not lost
+    table = pa.Table.from_pandas(store, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[IMAGES_KEY] = json.dumps(images).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    folder = os.path.dirname(store_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    tmp_path = store_path + '.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, store_path)
+
+
+class AnnotationStore:
+    '''
+    Reader of the consolidated annotation file. All annotations are loaded in one read and can be filtered
+    with vectorized pandas operations.
+    '''
+    def __init__(self, store_path, images=None, columns=None):
+        '''
+        Initialize AnnotationStore object.
+
+        Args:
+            store_path (str): Path of the Parquet file written by write_annotation_store.
+            images (list of str, optional): Only load the annotations of these images. Default is None.
+            columns (list of str, optional): Only load these columns. Default is None.
+        '''
+        filters = [('image', 'in', list(images))] if images is not None else None
+        if columns is not None and 'image' not in columns:
+            columns = ['image'] + list(columns)
+        table = pq.read_table(store_path, columns=columns, filters=filters)
+        self.images = json.loads(pq.read_schema(store_path).metadata[IMAGES_KEY])
+        if images is not None:
+            images = set(images)
+            self.images = [image for image in self.images if image in images]
+        self.frame = table.to_pandas()
+        self._groups = None
+        self._indices = {}
+
+    def __len__(self):
+        '''
+        Return the number of images in the store.
+        '''
+        return len(self.images)
+
+    def _rows(self, image):
+        # group the row indices by image once, on first access
+        if self._groups is None:
+            codes = self.frame['image'].astype(str).to_numpy()
+            self._groups = pd.Series(np.arange(len(codes))).groupby(codes).indices
+        return self._groups.get(image, np.zeros(0, dtype=np.int64))
+
+    def get(self, image):
+        '''
+        Returns the annotations of one image with the columns of the per-image csv files.
+
+        Args:
+            image (str): Key of the image (file name without extension).
+
+        Returns:
+            A pandas dataframe, empty if the image has no bounding box.
+        '''
+        rows = self.frame.iloc[self._rows(image)]
+        frame = rows[[col for col in CSV_COLUMNS if col in rows.columns]].reset_index(drop=True)
+        if 'class_name' in frame.columns:
+            frame['class_name'] = frame['class_name'].astype(str)
+        return frame
+
+    def boxes(self, image):
+        '''
+        Returns the bounding boxes of one image as an (N, 4) array of xmin, ymin, xmax and ymax.
+        '''
+        return self.frame.iloc[self._rows(image)][['xmin', 'ymin', 'xmax', 'ymax']].to_numpy()
+
+    def index(self, image):
+        '''
+        Returns the spatial index of the bounding boxes of one image, built on first access. Box indices of the
+        index are rows of boxes(image).
+
+        Args:
+            image (str): Key of the image (file name without extension).
+
+        Returns:
+            A BoxIndex object.
+        '''
+        if image not in self._indices:
+            self._indices[image] = BoxIndex(self.boxes(image))
+        return self._indices[image]
+
+    def query(self, image, window):
+        '''
+        Returns the annotations of one image intersecting a window, e.g. the view of a served image.
+
+        Args:
+            image (str): Key of the image (file name without extension).
+            window (tuple): xmin, ymin, xmax and ymax of the window.
+
+        Returns:
+            A pandas dataframe with the columns of the per-image csv files.
+        '''
+        return self.get(image).iloc[self.index(image).query(window)].reset_index(drop=True)
+
+    def counts(self):
+        '''
+        Returns a pandas series with the number of bounding boxes of every image, including empty images.
+        '''
+        return self.frame['image'].astype(str).value_counts().reindex(self.images, fill_value=0)
+
+    def to_csv_frames(self):
+        '''
+        Returns a dictionary mapping every image key to its annotations in the per-image csv format.
+        '''
+        return {image: self.get(image) for image in self.images}
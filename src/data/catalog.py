@@ -0,0 +1,119 @@
+import json
+import os
+import numpy as np
+from PIL import Image
+
+
+def _scan(path, extension):
+    '''
+    Lists the files of a folder with a given extension in one os.scandir pass.
+
+    Returns:
+        A dictionary mapping file stems to (path, size, modification time) tuples.
+    '''
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(extension) and entry.is_file():
+                stat = entry.stat()
+                files[os.path.splitext(entry.name)[0]] = (os.path.join(path, entry.name), stat.st_size,
+                                                          stat.st_mtime_ns)
+    return files
+
+
+class Catalog:
+    '''
+    Catalog of a folder of images and the folder of their csv annotations. Images and annotations are joined
+    by file stem, and the size, modification time and dimensions of every image are recorded. The dimensions
+    are read from the image headers, only for images which are new or changed since the catalog was saved.
+    '''
+    def __init__(self, img_path, csv_path, catalog_path=None):
+        '''
+        Initialize Catalog object. Both folders are scanned once; the saved catalog at catalog_path, if any,
+        is reused for every image whose size and modification time are unchanged.
+
+        Args:
+            img_path (str): Path to the folder containing the images.
+            csv_path (str): Path to the folder containing the csv files.
+            catalog_path (str, optional): Path of the JSON file to load and save the catalog. Default is None.
+        '''
+        self._catalog_path = catalog_path
+        previous = {}
+        if catalog_path and os.path.exists(catalog_path):
+            with open(catalog_path) as f:
+                saved = json.load(f)
+            if saved.get('img_path') == img_path:
+                previous = saved['entries']
+        self.img_path = img_path
+        self.csv_path = csv_path
+
+        # join images and annotations by stem
+        images = _scan(img_path, 'jpg')
+        csv_files = _scan(csv_path, 'csv')
+        self.entries = {}
+        n_read = 0
+        for stem, (path, size, mtime) in images.items():
+            entry = previous.get(stem)
+            if entry is None or entry['size'] != size or entry['mtime'] != mtime:
+                with Image.open(path) as image:
+                    width, height = image.size
+                entry = {'size': size, 'mtime': mtime, 'width': width, 'height': height}
+                n_read += 1
+            entry = dict(entry, jpg=path, csv=csv_files[stem][0] if stem in csv_files else None)
+            self.entries[stem] = entry
+        self.orphan_csv = sorted(csv_files[stem][0] for stem in csv_files if stem not in images)
+        self.n_read = n_read
+
+    def save(self):
+        '''
+        Writes the catalog to its JSON file, replacing the previous file atomically.
+        '''
+        if not self._catalog_path:
+            return
+        folder = os.path.dirname(self._catalog_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp_path = self._catalog_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'img_path': self.img_path, 'csv_path': self.csv_path, 'entries': self.entries}, f)
+        os.replace(tmp_path, self._catalog_path)
+
+    def pairs(self):
+        '''
+        Returns the images which have annotations, sorted by stem.
+
+        Returns:
+            A tuple of the list of stems, the list of image paths and the list of csv paths.
+        '''
+        stems = sorted(stem for stem, entry in self.entries.items() if entry['csv'] is not None)
+        return stems, [self.entries[stem]['jpg'] for stem in stems], [self.entries[stem]['csv'] for stem in stems]
+
+    def unannotated(self):
+        '''
+        Returns the sorted paths of the images without a csv file.
+        '''
+        return sorted(entry['jpg'] for entry in self.entries.values() if entry['csv'] is None)
+
+    def sizes(self, jpg_paths):
+        '''
+        Returns the width and height of images of the catalog.
+
+        Args:
+            jpg_paths (list of str): Paths of the images.
+
+        Returns:
+            A numpy array of shape (N, 2) holding the width and height of every image.
+        '''
+        sizes = np.zeros((len(jpg_paths), 2), dtype=np.int64)
+        for idx, path in enumerate(jpg_paths):
+            entry = self.entries[os.path.splitext(os.path.basename(path))[0]]
+            sizes[idx] = entry['width'], entry['height']
+        return sizes
+
+    def summary(self):
+        '''
+        Returns a one line description of the catalog, reporting files which could not be paired.
+        '''
+        n_pairs = len(self.pairs()[0])
+        return (f'{len(self.entries)} images ({self.n_read} headers read), {n_pairs} with annotations, '
+                f'{len(self.unannotated())} without annotations, {len(self.orphan_csv)} csv files without images')
@@ -1,5 +1,9 @@
 import copy
 import io
+import multiprocessing
+import os
+import time
+from collections import defaultdict
 from contextlib import redirect_stdout
 
 import numpy as np
@@ -11,7 +15,7 @@ from .interface import COCOeval
 
 
 class CocoEvaluator:
-    def __init__(self, coco_gt, iou_types):
+    def __init__(self, coco_gt, iou_types, num_workers=0, max_dets=(1, 20, 200)):
         """
         Initializes a CocoEvaluator object.
 
@@ -19,6 +23,11 @@ class CocoEvaluator:
             coco_gt (COCO): The COCO object representing the ground truth.
             iou_types (list or tuple): The IoU types to be evaluated. It should be a list or tuple of strings,
             where each string represents an IoU type. Possible values are 'bbox', 'segm', and 'keypoints'.
+            num_workers (int): Number of processes evaluating shards of the images. If greater than 1, the
+            predictions are only collected by update and all images are evaluated at once in
+            synchronize_between_processes. Defaults to 0, which evaluates every update in the current process.
+            max_dets (list or tuple of int): Thresholds on the number of detections per image, the last of which
+            limits the detections evaluated. Defaults to (1, 20, 200).
         """
         if not isinstance(iou_types, (list, tuple)):
             raise TypeError(f"This constructor expects iou_types of type list or tuple, instead  got {type(iou_types)}")
@@ -29,10 +38,12 @@ class CocoEvaluator:
         self.coco_eval = {}
         for iou_type in iou_types:
             self.coco_eval[iou_type] = COCOeval(coco_gt, iouType=iou_type)
-            self.coco_eval[iou_type].params.maxDets = [1, 20, 200] # TODO: make this configurable
+            self.coco_eval[iou_type].params.maxDets = list(max_dets)
 
         self.img_ids = []
         self.eval_imgs = {k: [] for k in iou_types}
+        self.num_workers = num_workers
+        self.results = {k: [] for k in iou_types}
 
     def update(self, predictions):
         """
@@ -48,6 +59,9 @@ class CocoEvaluator:
 
         for iou_type in self.iou_types:
             results = self.prepare(predictions, iou_type)
+            if self.num_workers > 1:
+                self.results[iou_type].extend(results)
+                continue
             with redirect_stdout(io.StringIO()):
                 coco_dt = COCO.loadRes(self.coco_gt, results) if results else COCO()
             coco_eval = self.coco_eval[iou_type]
@@ -64,6 +78,18 @@ class CocoEvaluator:
         Updates the evaluation results and the existing coco eval object in-place.
         """
         for iou_type in self.iou_types:
+            if self.num_workers > 1:
+                # evaluate the collected predictions of all images in a pool of processes
+                results = self.results[iou_type]
+                with redirect_stdout(io.StringIO()):
+                    coco_dt = COCO.loadRes(self.coco_gt, results) if results else COCO()
+                coco_eval = self.coco_eval[iou_type]
+                coco_eval.cocoDt = coco_dt
+                coco_eval.params.imgIds = list(self.img_ids)
+                img_ids, eval_imgs = evaluate(coco_eval, self.num_workers)
+                self.eval_imgs[iou_type] = eval_imgs
+                create_common_coco_eval(coco_eval, img_ids, eval_imgs)
+                continue
             self.eval_imgs[iou_type] = np.concatenate(self.eval_imgs[iou_type], 2)
             create_common_coco_eval(self.coco_eval[iou_type], self.img_ids, self.eval_imgs[iou_type])
 
@@ -170,6 +196,175 @@ class CocoEvaluator:
         return coco_results
 
 
+class StreamingCocoEvaluator:
+    def __init__(self, coco_gt, iou_types=("bbox",), max_dets=(1, 20, 200)):
+        """
+        Initializes a StreamingCocoEvaluator object, which matches the predictions of every batch against the
+        indexed ground truth straight away and keeps only compact arrays of the per image matches. The ground
+        truth is shared read-only instead of copied, and no COCO object is built for the predictions, so memory
+        and time per batch stay constant over the evaluation set. Only bounding boxes are supported.
+
+        Input:
+            coco_gt (COCO): The COCO object representing the ground truth.
+            iou_types (list or tuple): The IoU types to be evaluated. Only 'bbox' is supported.
+            max_dets (list or tuple of int): Thresholds on the number of detections per image, the last of which
+            limits the detections evaluated. Defaults to (1, 20, 200).
+        """
+        if not isinstance(iou_types, (list, tuple)):
+            raise TypeError(f"This constructor expects iou_types of type list or tuple, instead  got {type(iou_types)}")
+        if list(iou_types) != ["bbox"]:
+            raise ValueError(f"StreamingCocoEvaluator only supports the bbox iou type, got {iou_types}")
+        self.coco_gt = coco_gt
+
+        self.iou_types = iou_types
+        self.coco_eval = {"bbox": COCOeval(coco_gt, iouType="bbox")}
+        self.coco_eval["bbox"].params.maxDets = list(max_dets)
+
+        self.img_ids = []
+        self.chunks = []
+        self._seen = set()
+        self._next_dt_id = 1
+
+    def update(self, predictions):
+        """
+        Matches the predictions for a set of images against their ground truth and appends the matches.
+
+        Input:
+            predictions (dict): A dictionary of predicted bounding boxes and corresponding confidence scores for each image,
+            where the keys are the image IDs and the values are dictionaries of boxes, scores and labels.
+        """
+        coco_eval = self.coco_eval["bbox"]
+        p = coco_eval.params
+        cat_ids = set(p.catIds)
+        img_ids = [img_id for img_id in np.unique(list(predictions.keys())) if img_id not in self._seen]
+        self._seen.update(img_ids)
+        self.img_ids.extend(img_ids)
+
+        # copies of the ground truth and detections of the batch, with the fields set by loadRes and _prepare
+        gts, dts = defaultdict(list), defaultdict(list)
+        for img_id in img_ids:
+            for gt in self.coco_gt.imgToAnns[img_id]:
+                if gt["category_id"] in cat_ids:
+                    gts[img_id, gt["category_id"]].append(dict(gt, ignore="iscrowd" in gt and gt["iscrowd"]))
+            prediction = predictions[img_id]
+            if len(prediction) == 0:
+                continue
+            boxes = convert_to_xywh(prediction["boxes"]).tolist()
+            for box, score, label in zip(boxes, prediction["scores"].tolist(), prediction["labels"].tolist()):
+                if label in cat_ids:
+                    dts[img_id, label].append({"id": self._next_dt_id, "image_id": img_id, "category_id": label,
+                                               "bbox": box, "score": score, "area": box[2] * box[3], "iscrowd": 0})
+                self._next_dt_id += 1
+        coco_eval._gts, coco_eval._dts = gts, dts
+
+        # match every image, category and area range, keeping only the arrays used by accumulate
+        cat_ids = p.catIds if p.useCats else [-1]
+        coco_eval.ious = {(img_id, cat_id): coco_eval.computeIoU(img_id, cat_id)
+                          for img_id in img_ids for cat_id in cat_ids}
+        keys, dt_counts, gt_counts = [], [], []
+        scores, matched, ignored, gt_ignored = [], [], [], []
+        for k, cat_id in enumerate(cat_ids):
+            for a, area_rng in enumerate(p.areaRng):
+                for img_id in img_ids:
+                    e = coco_eval.evaluateImg(img_id, cat_id, area_rng, p.maxDets[-1])
+                    if e is None:
+                        continue
+                    keys.append((k, a, img_id))
+                    dt_counts.append(len(e["dtScores"]))
+                    gt_counts.append(len(e["gtIgnore"]))
+                    scores.append(np.asarray(e["dtScores"], dtype=np.float64))
+                    matched.append(e["dtMatches"] != 0)
+                    ignored.append(np.asarray(e["dtIgnore"], dtype=bool))
+                    gt_ignored.append(e["gtIgnore"] != 0)
+        coco_eval._gts, coco_eval._dts, coco_eval.ious = defaultdict(list), defaultdict(list), {}
+        if not keys:
+            return
+        T = len(p.iouThrs)
+        self.chunks.append({
+            "keys": np.array(keys, dtype=np.int64).reshape(-1, 3),
+            "dt_counts": np.array(dt_counts, dtype=np.int64),
+            "gt_counts": np.array(gt_counts, dtype=np.int64),
+            "dtScores": np.concatenate(scores),
+            "dtMatched": np.concatenate(matched, axis=1).reshape(T, -1),
+            "dtIgnored": np.concatenate(ignored, axis=1).reshape(T, -1),
+            "gtIgnored": np.concatenate(gt_ignored).astype(bool),
+        })
+
+    def synchronize_between_processes(self):
+        """
+        Gathers the matches computed by different processes, keeping the first matches of every image, and
+        flattens them in the order of the per image results of COCOeval.
+        """
+        all_img_ids = utils.all_gather(self.img_ids)
+        all_chunks = utils.all_gather(self.chunks)
+        seen, chunks = set(), []
+        for img_ids, rank_chunks in zip(all_img_ids, all_chunks):
+            new = set(img_ids) - seen
+            seen.update(new)
+            chunks.extend(_select_images(chunk, new) for chunk in rank_chunks)
+
+        coco_eval = self.coco_eval["bbox"]
+        p = coco_eval.params
+        p.imgIds = sorted(seen)
+        coco_eval._paramsEval = copy.deepcopy(p)
+        self.flat = _flatten_chunks(chunks, len(p.iouThrs), len(p.catIds) if p.useCats else 1,
+                                    len(p.areaRng), p.imgIds)
+
+    def accumulate(self):
+        for coco_eval in self.coco_eval.values():
+            coco_eval.accumulate(flat=self.flat)
+
+    def summarize(self):
+        for iou_type, coco_eval in self.coco_eval.items():
+            coco_eval.summarize()
+
+
+def _segments(counts, segments):
+    # indices of the items of the selected segments, in the order selected, for items stored segment after segment
+    starts = (np.cumsum(counts) - counts)[segments]
+    counts = counts[segments]
+    return np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+
+def _select_images(chunk, img_ids):
+    # the matches of a chunk for a set of images
+    keep = np.isin(chunk["keys"][:, 2], list(img_ids))
+    dind, gind = _segments(chunk["dt_counts"], keep), _segments(chunk["gt_counts"], keep)
+    return {"keys": chunk["keys"][keep], "dt_counts": chunk["dt_counts"][keep], "gt_counts": chunk["gt_counts"][keep],
+            "dtScores": chunk["dtScores"][dind], "dtMatched": chunk["dtMatched"][:, dind],
+            "dtIgnored": chunk["dtIgnored"][:, dind], "gtIgnored": chunk["gtIgnored"][gind]}
+
+
+def _flatten_chunks(chunks, T, K, A, img_ids):
+    # the arrays of flatten_eval_imgs for the KxAxI per image results stored in chunks
+    keys = np.concatenate([c["keys"] for c in chunks]) if chunks else np.zeros((0, 3), dtype=np.int64)
+    dt_counts = np.concatenate([c["dt_counts"] for c in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+    gt_counts = np.concatenate([c["gt_counts"] for c in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+    I = len(img_ids)
+    entries = keys[:, 0] * A * I + keys[:, 1] * I + np.searchsorted(img_ids, keys[:, 2])
+
+    # reorder the detections and ground truths by entry
+    order = np.argsort(entries, kind="stable")
+    dind, gind = _segments(dt_counts, order), _segments(gt_counts, order)
+    dt_counts, gt_counts = dt_counts[order], gt_counts[order]
+    dt_scores = np.concatenate([c["dtScores"] for c in chunks]) if chunks else np.zeros(0)
+    dt_matched = np.concatenate([c["dtMatched"] for c in chunks], axis=1) if chunks else np.zeros((T, 0), dtype=bool)
+    dt_ignored = np.concatenate([c["dtIgnored"] for c in chunks], axis=1) if chunks else np.zeros((T, 0), dtype=bool)
+    gt_ignored = np.concatenate([c["gtIgnored"] for c in chunks]) if chunks else np.zeros(0, dtype=bool)
+    has_entry = np.zeros(K * A * I, dtype=bool)
+    has_entry[entries] = True
+    return {
+        "dtEntry": entries[order].repeat(dt_counts),
+        "dtRank": np.arange(dt_counts.sum()) - (np.cumsum(dt_counts) - dt_counts).repeat(dt_counts),
+        "dtScores": dt_scores[dind],
+        "dtMatched": dt_matched[:, dind],
+        "dtIgnored": dt_ignored[:, dind],
+        "gtEntry": entries[order].repeat(gt_counts),
+        "gtIgnored": gt_ignored[gind],
+        "hasEntry": has_entry,
+    }
+
+
 def convert_to_xywh(boxes):
     xmin, ymin, xmax, ymax = boxes.unbind(1)
     return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
@@ -207,7 +402,108 @@ def create_common_coco_eval(coco_eval, img_ids, eval_imgs):
     coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
 
 
-def evaluate(imgs):
+def evaluate(imgs, num_workers=0):
+    """
+    Runs the per image evaluation of a COCOeval object.
+
+    Input:
+        imgs (COCOeval): The COCOeval object, with the detections and image ids to evaluate.
+        num_workers (int): Number of processes evaluating shards of the images. Defaults to 0, which evaluates
+        all images in the current process.
+
+    Output:
+        A tuple of the sorted image ids and an array of the per image evaluation results of shape
+        (categories, area ranges, images).
+    """
+    num_workers = min(num_workers, len(np.unique(imgs.params.imgIds)))
+    if num_workers > 1:
+        return evaluate_sharded(imgs, num_workers)
     with redirect_stdout(io.StringIO()):
         imgs.evaluate()
     return imgs.params.imgIds, np.asarray(imgs.evalImgs).reshape(-1, len(imgs.params.areaRng), len(imgs.params.imgIds))
+
+
+_shard_eval = None
+
+
+def _init_shard_worker(imgs):
+    global _shard_eval
+    _shard_eval = imgs
+
+
+def _evaluate_shard(img_ids):
+    # evaluate a shard of the images against the ground truth and detections shared by the pool
+    imgs = copy.copy(_shard_eval)
+    imgs.params = copy.deepcopy(_shard_eval.params)
+    imgs.params.imgIds = img_ids
+    return evaluate(imgs)
+
+
+def evaluate_sharded(imgs, num_workers):
+    """
+    Runs the per image evaluation of a COCOeval object in a pool of processes, each computing the IoUs and
+    matches of a contiguous shard of the sorted image ids. Where processes are forked, the ground truth and
+    detections are inherited by the workers instead of being copied to them. The shards are concatenated in
+    order, which gives the same results as evaluating all images in one process.
+
+    Input:
+        imgs (COCOeval): The COCOeval object, with the detections and image ids to evaluate.
+        num_workers (int): Number of processes.
+
+    Output:
+        A tuple of the sorted image ids and an array of the per image evaluation results of shape
+        (categories, area ranges, images).
+    """
+    p = imgs.params
+    p.imgIds = list(np.unique(p.imgIds))
+    if p.useCats:
+        p.catIds = list(np.unique(p.catIds))
+    p.maxDets = sorted(p.maxDets)
+    shards = [list(shard) for shard in np.array_split(p.imgIds, num_workers) if len(shard)]
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with context.Pool(len(shards), initializer=_init_shard_worker, initargs=(imgs,)) as pool:
+        results = pool.map(_evaluate_shard, shards)
+    img_ids = [img_id for shard_ids, _ in results for img_id in shard_ids]
+    return img_ids, np.concatenate([eval_imgs for _, eval_imgs in results], 2)
+
+
+def benchmark_evaluation(coco_gt, results, worker_counts=None, iou_type='bbox', max_dets=(1, 20, 200)):
+    """
+    Measures the scaling of the sharded evaluation from 1 to N processes, and checks that every number of
+    processes gives the same precision and recall as one process.
+
+    Input:
+        coco_gt (COCO): The COCO object representing the ground truth.
+        results (list): Detections in the COCO results format.
+        worker_counts (list of int, optional): Numbers of processes to measure. Defaults to None, which uses
+        1, 2, 4, ... up to the number of CPUs.
+        iou_type (str): The IoU type to evaluate. Defaults to 'bbox'.
+        max_dets (list or tuple of int): Thresholds on the number of detections per image. Defaults to (1, 20, 200).
+
+    Output:
+        A dictionary mapping every number of processes to the evaluation time in seconds.
+    """
+    if worker_counts is None:
+        n_cpus = os.cpu_count() or 1
+        worker_counts = sorted({2 ** k for k in range(n_cpus.bit_length()) if 2 ** k <= n_cpus} | {n_cpus})
+    with redirect_stdout(io.StringIO()):
+        coco_dt = COCO.loadRes(coco_gt, results)
+    timings, expected = {}, None
+    for num_workers in worker_counts:
+        coco_eval = COCOeval(coco_gt, coco_dt, iouType=iou_type)
+        coco_eval.params.maxDets = list(max_dets)
+        tic = time.perf_counter()
+        img_ids, eval_imgs = evaluate(coco_eval, num_workers)
+        timings[num_workers] = time.perf_counter() - tic
+        create_common_coco_eval(coco_eval, img_ids, eval_imgs)
+        with redirect_stdout(io.StringIO()):
+            coco_eval.accumulate()
+        if expected is None:
+            expected = coco_eval.eval
+        elif not all(np.array_equal(coco_eval.eval[k], expected[k]) for k in ['precision', 'recall', 'scores']):
+            raise AssertionError(f'Evaluation with {num_workers} processes differs from one process')
+        print(f'{num_workers} processes: {timings[num_workers]:.2f}s, speed-up '
+              f'{timings[worker_counts[0]] / max(timings[num_workers], 1e-12):.2f}x')
+    return timings
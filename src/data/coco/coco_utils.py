@@ -150,14 +150,17 @@ def convert_to_coco_api(ds):
     dataset = {"images": [], "categories": [], "annotations": []}
     categories = set()
     for img_idx in range(len(ds)):
-        # find better way to get target
-        # targets = ds.get_annotations(img_idx)
-        img, targets = ds[img_idx]
+        # read targets without decoding the image if the dataset allows it
+        if hasattr(ds, "get_annotations"):
+            height, width, targets = ds.get_annotations(img_idx)
+        else:
+            img, targets = ds[img_idx]
+            height, width = img.shape[-2], img.shape[-1]
         image_id = targets["image_id"].item()
         img_dict = {}
         img_dict["id"] = image_id
-        img_dict["height"] = img.shape[-2]
-        img_dict["width"] = img.shape[-1]
+        img_dict["height"] = height
+        img_dict["width"] = width
         dataset["images"].append(img_dict)
         bboxes = targets["boxes"].clone()
         bboxes[:, 2:] -= bboxes[:, :2]
@@ -203,6 +206,14 @@ def get_coco_api_from_dataset(dataset):
             dataset = dataset.dataset
     if isinstance(dataset, torchvision.datasets.CocoDetection):
         return dataset.coco
+
+    # keep the ground truth of datasets with annotation access until their targets change, e.g. across epochs
+    if hasattr(dataset, "get_annotations"):
+        cached = getattr(dataset, "_coco_gt", None)
+        key = dataset.ground_truth_key()
+        if cached is None or cached[0] != key:
+            dataset._coco_gt = (key, convert_to_coco_api(dataset))
+        return dataset._coco_gt[1]
     return convert_to_coco_api(dataset)
 
 
@@ -271,30 +271,17 @@ class COCOeval:
         gtIg = np.array([g['_ignore'] for g in gt])
         dtIg = np.zeros((T,D))
         if not len(ious)==0:
-            for tind, t in enumerate(p.iouThrs):
-                for dind, d in enumerate(dt):
-                    # information about best match so far (m=-1 -> unmatched)
-                    iou = min([t,1-1e-10])
-                    m   = -1
-                    for gind, g in enumerate(gt):
-                        # if this gt already matched, and not a crowd, continue
-                        if gtm[tind,gind]>0 and not iscrowd[gind]:
-                            continue
-                        # if dt matched to reg gt, and on ignore gt, stop
-                        if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
-                            break
-                        # continue to next gt unless better match made
-                        if ious[dind,gind] < iou:
-                            continue
-                        # if match successful and best so far, store appropriately
-                        iou=ious[dind,gind]
-                        m=gind
-                    # if match made store id of match for both dt and gt
-                    if m ==-1:
-                        continue
-                    dtIg[tind,dind] = gtIg[m]
-                    dtm[tind,dind]  = gt[m]['id']
-                    gtm[tind,m]     = d['id']
+            # match all iou thresholds at once, m holds the matched gt index of every dt or -1
+            m = match_detections(ious, gtIg, iscrowd, p.iouThrs)
+            tind, dind = np.nonzero(m > -1)
+            gind = m[tind, dind]
+            gtIds = np.array([g['id'] for g in gt])
+            dtIds = np.array([d['id'] for d in dt])
+            dtIg[tind, dind] = gtIg[gind]
+            dtm[tind, dind]  = gtIds[gind]
+            # later dts overwrite earlier ones on crowd gts, as in the sequential matching
+            order = np.lexsort((dind, tind))
+            gtm[tind[order], gind[order]] = dtIds[dind[order]]
         # set unmatched detections outside of area range to ignore
         a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
         dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
@@ -313,15 +300,16 @@ class COCOeval:
                 'dtIgnore':     dtIg,
             }
 
-    def accumulate(self, p = None):
+    def accumulate(self, p = None, flat = None):
         '''
         Accumulate per image evaluation results and store the result in self.eval
         :param p: input params for evaluation
+        :param flat: per image results flattened as by flatten_eval_imgs, used instead of self.evalImgs
         :return: None
         '''
         # print('Accumulating evaluation results...')
         tic = time.time()
-        if not self.evalImgs:
+        if not self.evalImgs and flat is None:
             print('Please run evaluate() first')
         # allows input customized parameters
         if p is None:
@@ -350,65 +338,60 @@ class COCOeval:
         i_list = [n for n, i in enumerate(p.imgIds)  if i in setI]
         I0 = len(_pe.imgIds)
         A0 = len(_pe.areaRng)
+        # flatten the per-image results once into preallocated arrays
+        if flat is None:
+            flat = flatten_eval_imgs(self.evalImgs, T)
+        dtEntry, dtRank, dtScoresAll = flat['dtEntry'], flat['dtRank'], flat['dtScores']
+        dtMatched, dtIgnored = flat['dtMatched'], flat['dtIgnored']
+        gtEntry, gtIgnored, hasEntry = flat['gtEntry'], flat['gtIgnored'], flat['hasEntry']
+        recThrs = np.asarray(p.recThrs)
+
         # retrieve E at each category, area range, and max number of detections
         for k, k0 in enumerate(k_list):
             Nk = k0*A0*I0
             for a, a0 in enumerate(a_list):
                 Na = a0*I0
+                selected = np.zeros(len(hasEntry), dtype=bool)
+                selected[[Nk + Na + i for i in i_list]] = True
+                if not (selected & hasEntry).any():
+                    continue
+                npig = np.count_nonzero(selected[gtEntry] & ~gtIgnored)
+                if npig == 0:
+                    continue
+                dtSelected = selected[dtEntry]
                 for m, maxDet in enumerate(m_list):
-                    E = [self.evalImgs[Nk + Na + i] for i in i_list]
-                    E = [e for e in E if not e is None]
-                    if len(E) == 0:
-                        continue
-                    dtScores = np.concatenate([e['dtScores'][0:maxDet] for e in E])
+                    dind = np.flatnonzero(dtSelected & (dtRank < maxDet))
+                    dtScores = dtScoresAll[dind]
 
                     # different sorting method generates slightly different results.
                     # mergesort is used to be consistent as Matlab implementation.
                     inds = np.argsort(-dtScores, kind='mergesort')
                     dtScoresSorted = dtScores[inds]
-
-                    dtm  = np.concatenate([e['dtMatches'][:,0:maxDet] for e in E], axis=1)[:,inds]
-                    dtIg = np.concatenate([e['dtIgnore'][:,0:maxDet]  for e in E], axis=1)[:,inds]
-                    gtIg = np.concatenate([e['gtIgnore'] for e in E])
-                    npig = np.count_nonzero(gtIg==0 )
-                    if npig == 0:
-                        continue
-                    tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
-                    fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
-
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
-                    for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
-                        tp = np.array(tp)
-                        fp = np.array(fp)
-                        nd = len(tp)
-                        rc = tp / npig
-                        pr = tp / (fp+tp+np.spacing(1))
-                        q  = np.zeros((R,))
-                        ss = np.zeros((R,))
-
-                        if nd:
-                            recall[t,k,a,m] = rc[-1]
-                        else:
-                            recall[t,k,a,m] = 0
-
-                        # numpy is slow without cython optimization for accessing elements
-                        # use python array gets significant speed improvement
-                        pr = pr.tolist(); q = q.tolist()
-
-                        for i in range(nd-1, 0, -1):
-                            if pr[i] > pr[i-1]:
-                                pr[i-1] = pr[i]
-
-                        inds = np.searchsorted(rc, p.recThrs, side='left')
-                        try:
-                            for ri, pi in enumerate(inds):
-                                q[ri] = pr[pi]
-                                ss[ri] = dtScoresSorted[pi]
-                        except:
-                            pass
-                        precision[t,:,k,a,m] = np.array(q)
-                        scores[t,:,k,a,m] = np.array(ss)
+                    dind = dind[inds]
+                    nd = len(dind)
+
+                    # precision and recall at every detection for all iou thresholds at once
+                    tps = dtMatched[:, dind] & ~dtIgnored[:, dind]
+                    fps = ~dtMatched[:, dind] & ~dtIgnored[:, dind]
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum+tp_sum+np.spacing(1))
+                    recall[:,k,a,m] = rc[:, -1] if nd else 0
+
+                    # precision envelope: maximum precision at any higher recall
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+                    # precision and score at every recall threshold, 0 beyond the highest recall
+                    q = np.zeros((T, R))
+                    ss = np.zeros((T, R))
+                    for t in range(T):
+                        pi = np.searchsorted(rc[t], recThrs, side='left')
+                        valid = pi < nd
+                        q[t, valid] = pr[t, pi[valid]]
+                        ss[t, valid] = dtScoresSorted[pi[valid]]
+                    precision[:,:,k,a,m] = q
+                    scores[:,:,k,a,m] = ss
         self.eval = {
             'params': p,
             'counts': [T, R, K, A, M],
@@ -539,3 +522,149 @@ class Params:
         self.iouType = iouType
         # useSegm is deprecated
         self.useSegm = None
+
+
+def flatten_eval_imgs(evalImgs, T):
+    '''
+    Flattens per image evaluation results into preallocated arrays, detections and ground truths of all
+    entries concatenated in the order of the entries
+    :param evalImgs: list of the results of evaluateImg, or None, in KxAxI order
+    :param T: number of iou thresholds
+    :return: dict of arrays: dtEntry, dtRank (position of a detection in its entry), dtScores, dtMatched (TxD),
+             dtIgnored (TxD), gtEntry, gtIgnored and hasEntry (whether an entry is not None)
+    '''
+    entries = [(n, e) for n, e in enumerate(evalImgs) if e is not None]
+    nD = sum(len(e['dtScores']) for n, e in entries)
+    nG = sum(len(e['gtIgnore']) for n, e in entries)
+    flat = {
+        'dtEntry':   np.zeros(nD, dtype=np.int64),
+        'dtRank':    np.zeros(nD, dtype=np.int64),
+        'dtScores':  np.zeros(nD),
+        'dtMatched': np.zeros((T, nD), dtype=bool),
+        'dtIgnored': np.zeros((T, nD), dtype=bool),
+        'gtEntry':   np.zeros(nG, dtype=np.int64),
+        'gtIgnored': np.zeros(nG, dtype=bool),
+        'hasEntry':  np.zeros(len(evalImgs), dtype=bool),
+    }
+    d0 = g0 = 0
+    for n, e in entries:
+        d1, g1 = d0 + len(e['dtScores']), g0 + len(e['gtIgnore'])
+        flat['dtEntry'][d0:d1] = n
+        flat['dtRank'][d0:d1] = np.arange(d1 - d0)
+        flat['dtScores'][d0:d1] = e['dtScores']
+        flat['dtMatched'][:, d0:d1] = e['dtMatches'] != 0
+        flat['dtIgnored'][:, d0:d1] = e['dtIgnore']
+        flat['gtEntry'][g0:g1] = n
+        flat['gtIgnored'][g0:g1] = e['gtIgnore'] != 0
+        flat['hasEntry'][n] = True
+        d0, g0 = d1, g1
+    return flat
+
+
+def match_detections(ious, gtIg, iscrowd, iouThrs):
+    '''
+    Greedy matching of score sorted detections to ground truths (ignored ground truths last) at every IoU
+    threshold at once. Gives the same matches as the sequential loop of the reference implementation,
+    match_detections_loop: a detection takes the available ground truth with the highest IoU (the last one on
+    ties) among the non ignored ground truths, and only if there is none among the ignored ones.
+    :param ious (ndarray): DxG ious of the detections and ground truths
+    :param gtIg (ndarray): G ignore flags of the ground truths
+    :param iscrowd (list): G crowd flags of the ground truths
+    :param iouThrs (ndarray): T iou thresholds
+    :return: m (ndarray): TxD index of the matched ground truth of every detection at every threshold or -1
+    '''
+    D, G = ious.shape
+    T = len(iouThrs)
+    m = -np.ones((T, D), dtype=np.int64)
+    if D == 0 or G == 0:
+        return m
+    thrs = np.minimum(np.asarray(iouThrs, dtype=np.float64), 1-1e-10)[:, None]
+    ignored = np.asarray(gtIg, dtype=bool)
+    crowd = np.asarray(iscrowd, dtype=bool)
+    matched = np.zeros((T, G), dtype=bool)
+    rows = np.arange(T)
+    for dind in range(D):
+        # only gts above the lowest threshold can be matched
+        cols = np.flatnonzero(ious[dind] >= thrs[0, 0] if T == 1 else ious[dind] >= thrs.min())
+        if not len(cols):
+            continue
+        iou = ious[dind, cols][None, :]
+        candidates = ~(matched[:, cols] & ~crowd[cols]) & (iou >= thrs)
+        match = -np.ones(T, dtype=np.int64)
+        for phase in (~ignored[cols], ignored[cols]):
+            valid = candidates & phase
+            todo = (match == -1) & valid.any(axis=1)
+            if not todo.any():
+                continue
+            # last maximum: argmax of the reversed row
+            vals = np.where(valid, iou, -np.inf)
+            best = len(cols) - 1 - np.argmax(vals[:, ::-1], axis=1)
+            match[todo] = cols[best[todo]]
+        hit = match > -1
+        matched[rows[hit], match[hit]] = True
+        m[:, dind] = match
+    return m
+
+
+def match_detections_loop(ious, gtIg, iscrowd, iouThrs):
+    '''
+    Reference sequential implementation of match_detections, kept to validate it.
+    '''
+    D, G = ious.shape
+    m_all = -np.ones((len(iouThrs), D), dtype=np.int64)
+    gtm = np.zeros((len(iouThrs), G))
+    for tind, t in enumerate(iouThrs):
+        for dind in range(D):
+            # information about best match so far (m=-1 -> unmatched)
+            iou = min([t,1-1e-10])
+            m   = -1
+            for gind in range(G):
+                # if this gt already matched, and not a crowd, continue
+                if gtm[tind,gind]>0 and not iscrowd[gind]:
+                    continue
+                # if dt matched to reg gt, and on ignore gt, stop
+                if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
+                    break
+                # continue to next gt unless better match made
+                if ious[dind,gind] < iou:
+                    continue
+                # if match successful and best so far, store appropriately
+                iou=ious[dind,gind]
+                m=gind
+            if m ==-1:
+                continue
+            gtm[tind,m] = dind + 1
+            m_all[tind,dind] = m
+    return m_all
+
+
+def benchmark_matching(n_trials=200, n_dets=200, n_gts=100, seed=0):
+    '''
+    Validates match_detections against match_detections_loop on random fixtures, with ties, crowd and ignored
+    ground truths, and measures both.
+    :return: dict with the total time in seconds of both implementations and the speed-up
+    '''
+    rng = np.random.default_rng(seed)
+    iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+    timings = {'loop': 0.0, 'vectorized': 0.0}
+    for trial in range(n_trials):
+        D, G = rng.integers(0, n_dets + 1), rng.integers(0, n_gts + 1)
+        # jittered copies of integer xywh gt boxes on a tile, duplicated boxes produce ties
+        gts = np.hstack([rng.integers(0, 800, (G, 2)), rng.integers(10, 60, (G, 2))]).astype(np.float64)
+        gts[1::9] = gts[0:-1:9]
+        dts = gts[rng.integers(0, G, D)] + rng.integers(-8, 9, (D, 4)) if G else rng.random((D, 4)) * 60
+        dts[:, 2:] = np.maximum(dts[:, 2:], 1)
+        dts[1::7] = dts[0:-1:7]
+        ious = np.asarray(maskUtils.iou(dts.tolist(), gts.tolist(), [0] * G)) if D and G else np.zeros((D, G))
+        gtIg = np.sort(rng.random(G) < 0.2).astype(int)
+        iscrowd = (rng.random(G) < 0.05).astype(int).tolist()
+        tic = time.perf_counter()
+        expected = match_detections_loop(ious, gtIg, iscrowd, iouThrs)
+        timings['loop'] += time.perf_counter() - tic
+        tic = time.perf_counter()
+        result = match_detections(ious, gtIg, iscrowd, iouThrs)
+        timings['vectorized'] += time.perf_counter() - tic
+        if not np.array_equal(result, expected):
+            raise AssertionError('match_detections differs from the reference in trial {}'.format(trial))
+    timings['speedup'] = timings['loop'] / max(timings['vectorized'], 1e-12)
+    return timings
@@ -138,6 +138,25 @@ def all_gather(data):
     return data_list
 
 
+def broadcast(data, src=0):
+    """
+    Send arbitrary picklable data from one process to all processes, e.g. a decision which must be the same
+    in every process.
+
+    Input:
+        data: any picklable object, only used in the process src
+        src (int): rank of the process sending the data
+
+    Output:
+        The data of the process src.
+    """
+    if get_world_size() == 1:
+        return data
+    data_list = [data]
+    dist.broadcast_object_list(data_list, src)
+    return data_list[0]
+
+
 def reduce_dict(input_dict, average=True):
     """
     Reduce the values in the dictionary from all processes so that all processes
@@ -428,18 +447,20 @@ def init_distributed_mode(args):
     Initializes distributed mode for PyTorch training based on the environment variables.
     
     Intput:
-        args: Namespace containing the command-line arguments.
+        args: Namespace containing the command-line arguments. args.dist_backend selects the backend, "nccl"
+        or "gloo"; if it is missing or None, NCCL is used where GPUs exist and gloo otherwise.
     """
     # Check if the environment variables "RANK", "WORLD_SIZE", and "LOCAL_RANK" are set.
     if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
         #If they are set, set the rank, world size, and GPU device ID for the process.
         args.rank = int(os.environ["RANK"])
         args.world_size = int(os.environ["WORLD_SIZE"])
-        args.gpu = int(os.environ["LOCAL_RANK"])
+        args.gpu = int(os.environ.get("LOCAL_RANK", 0))
     # If not, check if the environment variable "SLURM_PROCID" is set and use it to set the rank and GPU device ID.
     elif "SLURM_PROCID" in os.environ:
         args.rank = int(os.environ["SLURM_PROCID"])
-        args.gpu = args.rank % torch.cuda.device_count()
+        args.world_size = int(os.environ["SLURM_NTASKS"])
+        args.gpu = args.rank % torch.cuda.device_count() if torch.cuda.is_available() else 0
     # If neither set of environment variables is found, disable distributed mode.
     else:
         print("Not using distributed mode")
@@ -448,10 +469,13 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    # Once the rank and GPU device ID are determined, set the device for PyTorch and initializes the process group using the NCCL 
-    # backend and the URL specified in the command-line arguments.
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = "nccl"
+    # Once the rank and GPU device ID are determined, choose the backend, set the GPU of the process for NCCL and initialize
+    # the process group using the URL specified in the command-line arguments.
+    if getattr(args, "dist_backend", None) is None:
+        args.dist_backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if args.dist_backend == "nccl":
+        torch.cuda.set_device(args.gpu)
+    args.dist_url = getattr(args, "dist_url", "env://")
     print(f"| distributed init (rank {args.rank}): {args.dist_url}", flush=True)
     torch.distributed.init_process_group(
         backend=args.dist_backend, init_method=args.dist_url, world_size=args.world_size, rank=args.rank
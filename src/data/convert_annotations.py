@@ -1,91 +1,121 @@
 import csv
 import os
-from src.data.utils import get_file_names, concat_frames, csv_to_df
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from src.data.utils import get_file_names, csv_to_df
 from src.data.plotlib import plot_distribution
+from src.data.annotation_store import write_annotation_store, CSV_COLUMNS
 
 
-def write_csv(old_path, new_path, mapping):
+def _write_frame(frame, file_name):
     '''
-    Write new csv files to new_path with new class names and new columns.
-
-    Args:
-        old_path (str): path to the folder containing the old csv files
-        new_path (str): path to the folder to save the new csv files
-        mapping (Dict): dictionary mapping old class names to new class names
+    Writes a dataframe to a csv file through a temporary file, which is renamed atomically.
     '''
-    # get all file names in the old csv files folder sorted alphabetically
-    old_csv_file_names = get_file_names(old_path, 'csv')
-    if not os.path.exists(new_path):
-        os.makedirs(new_path)
-
-    # loop through all the csv files
-    for idx in range(len(old_csv_file_names)):
-        # get new file name to save new dataframe
-        new_csv_file_name = new_path + old_csv_file_names[idx].split('/')[-1]
-
-        # read in old dataframe and have columns renamed and changed
-        frame = csv_to_df(old_csv_file_names[idx])
-        frame['class_name'] = frame['desc'].map(mapping).fillna(frame['desc'])
-        frame['xmin'] = frame['x']
-        frame['ymin'] = frame['y']
-        frame['xmax'] = frame['x'] + frame['width']
-        frame['ymax'] = frame['y'] + frame['height']
-
-        # drop old columns
-        frame = frame.drop('desc', axis=1)
-        frame = frame.drop('class_id', axis=1)
-        frame = frame.drop('x', axis=1)
-        frame = frame.drop('y', axis=1)
-        frame = frame.drop('width', axis=1)
-        frame = frame.drop('height', axis=1)
+    tmp_path = file_name + '.tmp'
+    frame.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, file_name)
+    return file_name
 
-        # save new dataframe to csv file
-        with open(new_csv_file_name, 'w') as f:
-            frame.to_csv(f, index=False)
 
-    # print that all csv files have been written
-    print('Finished writing csv files')
+def _map(num_workers, function, *iterables):
+    '''
+    Maps a function over iterables in a pool of processes, or in the current process if num_workers is 0.
+    '''
+    if num_workers == 0:
+        return list(map(function, *iterables))
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(function, *iterables, chunksize=64))
 
 
-def add_class_id_and_data_exploration(new_path, title, data_path, plot_path=None):
+def convert_annotations(old_path, new_path, mapping, title, data_path, plot_path=None, store_path=None,
+                        manifest=None, num_workers=None):
     '''
-    Add class_id column to each csv file and plot distribution of classes.
+    Converts the old csv files to new csv files in one pass. Every old csv file is read once in a pool of
+    processes. Class names are mapped and boxes are converted from xywh to xyxy for all files at once, class ids
+    are assigned from the class counts of all files, and every new csv file is written once with an atomic
+    rename. The class id mapping is saved to class_id.csv and the distribution of classes is plotted.
 
     Args:
-        new_path (str): Path to the folder containing the new csv files
+        old_path (str): Path to the folder containing the old csv files
+        new_path (str): Path to the folder to save the new csv files
+        mapping (Dict): Dictionary mapping old class names to new class names
         title (str): Title of the plot
-        data_path (str): Path to the folder to save the class_id_mapping.csv file
+        data_path (str): Path to the folder to save the class_id.csv file
         plot_path (str, optional): Path to the folder to save the plot. Default is None.
+        store_path (str, optional): Path to save all annotations in one Parquet file. Default is None.
+        manifest (Manifest, optional): Manifest of processed files. If given, only new csv files whose old csv
+            file changed are written, unless the mapping or the class ids changed, and new csv files whose old
+            csv file vanished are removed. Default is None.
+        num_workers (int, optional): Number of processes reading and writing csv files. 0 uses the current
+            process. Default is None, which uses one process per CPU.
+
+    Returns:
+        A list of the new csv files that were written.
     '''
-    # get all file names in the new csv files folder sorted alphabetically
-    new_csv_file_names = get_file_names(new_path, 'csv')
+    # get all file names in the old csv files folder sorted alphabetically
+    old_csv_file_names = get_file_names(old_path, 'csv')
+    base_names = [os.path.basename(file_name) for file_name in old_csv_file_names]
+    stems = [os.path.splitext(base_name)[0] for base_name in base_names]
+    if not os.path.exists(new_path):
+        os.makedirs(new_path)
 
-    # concat all the dataframes into one
-    contact_frame = concat_frames(new_csv_file_names)
-    val_counts = contact_frame['class_name'].value_counts()
-    print('Number of classes: ', len(val_counts))
-    # print(val_counts)
+    # read every old csv file once and convert all of them together
+    frames = _map(num_workers, csv_to_df, old_csv_file_names)
+    lengths = np.array([len(frame) for frame in frames], dtype=np.int64)
+    non_empty = [frame for frame in frames if len(frame)]
+    old = pd.concat(non_empty, axis=0, ignore_index=True) if non_empty else pd.DataFrame(
+        columns=['desc', 'x', 'y', 'width', 'height'])
+    class_name = old['desc'].map(mapping).fillna(old['desc'])
 
-    # add class_id column
-    sorted_class_name = sorted(contact_frame['class_name'].unique())  # alphabetically sorted
-    class_id_mapping = {item: index for index, item in enumerate(sorted_class_name)}
-    # print('class_id_mapping: ', class_id_mapping)
+    # assign class ids from the class counts of all files
+    val_counts = class_name.value_counts()
+    print('Number of classes: ', len(val_counts))
+    class_id_mapping = {item: index for index, item in enumerate(sorted(val_counts.index))}
+    converted = pd.DataFrame({
+        'class_id': pd.Categorical(class_name, categories=sorted(val_counts.index)).codes.astype(np.int64),
+        'class_name': class_name,
+        'xmax': old['x'] + old['width'],
+        'xmin': old['x'],
+        'ymax': old['y'] + old['height'],
+        'ymin': old['y'],
+    }, columns=CSV_COLUMNS)
 
     # save class_id_mapping to csv file
-    with open(data_path + 'class_id.csv', 'w', newline='') as file:
+    tmp_path = data_path + 'class_id.csv.tmp'
+    with open(tmp_path, 'w', newline='') as file:
         writer = csv.writer(file)
         writer.writerow(['class_name', 'class_id'])
         for key, value in class_id_mapping.items():
             writer.writerow([key, value])
-
-    # add class_id column to each csv file
-    for new_csv_file_name in new_csv_file_names:
-        frame = csv_to_df(new_csv_file_name)
-        frame['class_id'] = frame['class_name'].map(class_id_mapping)
-        frame = frame.reindex(sorted(frame.columns), axis=1)
-        with open(new_csv_file_name, 'w') as f:
-            frame.to_csv(f, index=False)
+    os.replace(tmp_path, data_path + 'class_id.csv')
+
+    # a different mapping or different class ids invalidate every new csv file written before
+    stage = 'convert:' + new_path
+    if manifest is not None and (manifest.get_state(stage, 'mapping') != mapping or
+                                 manifest.get_state(stage, 'class_ids') != class_id_mapping):
+        manifest.invalidate(stage)
+        manifest.set_state(stage, 'mapping', mapping)
+        manifest.set_state(stage, 'class_ids', class_id_mapping)
+
+    # split the converted annotations back into one frame per file and write the changed ones
+    ends = np.cumsum(lengths)
+    new_frames = [converted.iloc[end - length:end].reset_index(drop=True) for end, length in zip(ends, lengths)]
+    pending = [idx for idx in range(len(base_names)) if manifest is None or
+               not manifest.is_current(stage, base_names[idx], [old_csv_file_names[idx]])]
+    written = _map(num_workers, _write_frame, [new_frames[idx] for idx in pending],
+                   [new_path + base_names[idx] for idx in pending])
+    if manifest is not None:
+        for idx, new_csv_file_name in zip(pending, written):
+            manifest.record(stage, base_names[idx], [old_csv_file_names[idx]], [new_csv_file_name])
+        manifest.remove_vanished(stage, base_names)
+    print(f'Finished writing csv files ({len(written)} of {len(old_csv_file_names)} updated)')
+
+    # save all annotations in one consolidated file
+    if store_path:
+        write_annotation_store(dict(zip(stems, new_frames)), store_path)
 
     # plot distribution of classes
-    _ = plot_distribution(contact_frame, 'class_name', 'class', 'count', title, plot_path)
+    _ = plot_distribution(converted, 'class_name', 'class', 'count', title, plot_path)
     print("Finished adding class_id column and plotting distribution of classes")
+    return written
@@ -1,36 +1,179 @@
 import cv2
+import hashlib
 import os
-from src.data.utils import csv_to_df, get_file_names
+import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from src.data.catalog import Catalog
+from src.data.utils import csv_to_df
 
 
-def cropping(csv_path, img_path, cropped_path):
+def _write_crop(cropped_img, file_name):
+    """
+    Encodes a cropped image as JPEG and writes it to file_name.
+    """
+    dummy, buffer = cv2.imencode('.jpg', cropped_img)
+    buffer.tofile(file_name)
+
+
+def _crop_image(jpg_file, coords, file_names, max_pending=64, n_writers=2):
+    """
+    Decodes an image once and writes the crops of all of its bounding boxes. Encoding and writing are done
+    by a small pool of threads fed through a bounded queue, so decoding the next boxes overlaps with disk writes.
+
+    Args:
+        jpg_file (str): Path of the image.
+        coords (numpy array): Array of shape (N, 4) holding xmin, ymin, xmax and ymax of every bounding box.
+        file_names (list of str): Path to save the crop of every bounding box.
+        max_pending (int): Maximum number of crops waiting to be encoded and written. Default is 64.
+        n_writers (int): Number of threads encoding and writing crops. Default is 2.
+
+    Returns:
+        The list of written file names.
+    """
+    img = cv2.imread(jpg_file)
+    with ThreadPoolExecutor(max_workers=n_writers) as writers:
+        pending = deque()
+        for (xmin, ymin, xmax, ymax), file_name in zip(coords, file_names):
+            if len(pending) >= max_pending:
+                pending.popleft().result()
+            pending.append(writers.submit(_write_crop, img[ymin:ymax, xmin:xmax], file_name))
+        for future in pending:
+            future.result()
+    return file_names
+
+
+def cropping(csv_path, img_path, cropped_path, manifest=None, num_workers=None, annotations=None, catalog=None):
     """
     Crops images based on bounding boxes in csv files and saves them in a new folder.
+    Images are paired with csv files by file name and distributed over a pool of processes.
     
     Args:
         csv_path (str): Path to the folder containing the csv files.
                         csv files contain bounding boxes of birds in images.
         img_path (str): Path to the folder containing the images.
         cropped_path (str): Path to the folder to save the cropped images.
+        manifest (Manifest, optional): Manifest of processed files. If given, only new or changed images are
+                                       cropped and the crops of vanished images are removed. Default is None.
+        num_workers (int, optional): Number of processes cropping images. 0 crops in the current process.
+                                     Default is None, which uses one process per CPU.
+        annotations (AnnotationStore, optional): Consolidated annotations. If given, bounding boxes are read
+                                                 from the store instead of the csv files. Default is None.
+        catalog (Catalog, optional): Catalog pairing the images with the csv files. Default is None, which
+                                     scans both folders.
+
+    Returns:
+        A list of the cropped image files that were written.
     """
-    # Get the file names of CSV and JPG files from their parent paths
-    jpg_files = get_file_names(img_path, 'jpg')
-    csv_files = get_file_names(csv_path, 'csv')
-    
-    
-    for idx in range(len(jpg_files)):
-        # Read the CSV and JPG files from paths
-        img = cv2.imread(jpg_files[idx])
-        boxes = csv_to_df(csv_files[idx])
-
-        # Loop through every bounding box and crop images
-        for dummy, box in boxes.iterrows():
-            xmin, xmax, ymin, ymax = box['xmin'], box['xmax'], box['ymin'], box['ymax']
-            class_name = box['class_name']
-            cropped_img = img[ymin:ymax, xmin:xmax]
-            class_folder = cropped_path + class_name
-            if not os.path.exists(class_folder):
-                os.makedirs(class_folder)
-            file_name = f"{class_folder}/{idx}_{xmin}_{ymin}.jpg"
-            cv2.imwrite(file_name, cropped_img)
-    print('Finished cropping images')
+    # Get the JPG files paired with their CSV files by name
+    if catalog is None:
+        catalog = Catalog(img_path, csv_path)
+    stems, jpg_files, csv_files = catalog.pairs()
+    stage = 'cropping:' + cropped_path
+
+    # Read the bounding boxes of every image which has to be cropped
+    tasks = []
+    for stem, jpg_file, csv_file in zip(stems, jpg_files, csv_files):
+        inputs = [jpg_file, csv_file]
+        if manifest is not None:
+            if manifest.is_current(stage, stem, inputs):
+                continue
+            manifest.remove_outputs(stage, stem)
+        boxes = annotations.get(stem) if annotations is not None else csv_to_df(csv_file)
+        coords = boxes[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy(dtype=int)
+        file_names = [f"{cropped_path}{class_name}/{stem}_{xmin}_{ymin}.jpg"
+                      for class_name, xmin, ymin in zip(boxes['class_name'], coords[:, 0], coords[:, 1])]
+        tasks.append((stem, inputs, coords, file_names))
+
+    # Create the class folders once
+    class_folders = {os.path.dirname(file_name) for task in tasks for file_name in task[3]}
+    for class_folder in class_folders:
+        os.makedirs(class_folder, exist_ok=True)
+
+    # Crop every image, one image per task
+    written = []
+
+    def _record(stem, inputs, outputs):
+        written.extend(outputs)
+        if manifest is not None:
+            manifest.record(stage, stem, inputs, outputs)
+
+    if num_workers == 0:
+        for stem, inputs, coords, file_names in tasks:
+            _record(stem, inputs, _crop_image(inputs[0], coords, file_names))
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = {pool.submit(_crop_image, inputs[0], coords, file_names): (stem, inputs)
+                       for stem, inputs, coords, file_names in tasks}
+            for future in as_completed(futures):
+                stem, inputs = futures[future]
+                _record(stem, inputs, future.result())
+
+    # Remove the crops of images which do not exist anymore
+    if manifest is not None:
+        manifest.remove_vanished(stage, stems)
+    print(f'Finished cropping images ({len(written)} crops written)')
+    return written
+
+
+def assign_split(key, ratio, seed):
+    """
+    Deterministically assigns a key to the train, validation or test set. The assignment only depends on the
+    key itself, so adding new keys never moves existing ones to another set.
+
+    Args:
+        key (str): Key to assign, e.g. the path of a cropped image relative to its root folder.
+        ratio (tuple): Fractions of the train, validation and test sets.
+        seed (int): Random seed mixed into the assignment.
+
+    Returns:
+        One of 'train', 'val' or 'test'.
+    """
+    digest = hashlib.sha1(f'{seed}:{key}'.encode()).digest()
+    fraction = int.from_bytes(digest[:8], 'big') / 2 ** 64
+    if fraction < ratio[0]:
+        return 'train'
+    if fraction < ratio[0] + ratio[1]:
+        return 'val'
+    return 'test'
+
+
+def build_split_index(cropped_path, index_path, ratio, seed):
+    """
+    Writes an index file assigning every cropped image to the train, validation or test set, instead of
+    copying the images into one folder per set. Every row holds the path of a cropped image relative to
+    cropped_path, its class name and its set. Crops already in the index keep their set, new crops are
+    assigned with assign_split and crops which do not exist anymore are dropped.
+
+    Args:
+        cropped_path (str): Path to the folder containing one folder of cropped images per class.
+        index_path (str): Path of the csv index file.
+        ratio (tuple): Fractions of the train, validation and test sets.
+        seed (int): Random seed of the split.
+
+    Returns:
+        A pandas dataframe of the index with columns path, class_name and split.
+    """
+    previous = {}
+    if os.path.exists(index_path):
+        frame = csv_to_df(index_path)
+        previous = dict(zip(frame['path'], frame['split']))
+
+    rows = []
+    for class_name in sorted(os.listdir(cropped_path)):
+        class_folder = os.path.join(cropped_path, class_name)
+        if not os.path.isdir(class_folder):
+            continue
+        for file_name in sorted(os.listdir(class_folder)):
+            key = class_name + '/' + file_name
+            split = previous[key] if key in previous else assign_split(key, ratio, seed)
+            rows.append((key, class_name, split))
+    frame = pd.DataFrame(rows, columns=['path', 'class_name', 'split'])
+
+    # replace the index atomically
+    tmp_path = index_path + '.tmp'
+    frame.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, index_path)
+    new = sum(row[0] not in previous for row in rows)
+    print(f'Finished indexing cropped images ({new} of {len(rows)} new)')
+    return frame
@@ -1,11 +1,20 @@
+import copy
+import math
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
 import torch
 from PIL import Image
 import torchvision.datasets as datasets
 from .utils import csv_to_df
+from .records import is_packed, PackedImageDataset, PackedImageStream
+from .image_io import load_image, get_image_loader
+from .coco.utils import get_world_size, get_rank
 
 
 class ObjectDetectionDataset(torch.utils.data.Dataset):
-    def __init__(self, jpg_paths, csv_paths, transform, bird_only=True):
+    def __init__(self, jpg_paths, csv_paths, transform, bird_only=True, annotations=None, sizes=None):
         '''
         Initialize ObjectDetectionDataset object.
         
@@ -14,45 +23,40 @@ class ObjectDetectionDataset(torch.utils.data.Dataset):
             csv_paths (list of str): List of paths to the CSV files containing target data.
             transform: Transforms to apply to images and targets.
             bird_only (boolean): Whether to only include bird species.
+            annotations (AnnotationStore, optional): Consolidated annotations. If given, targets are read
+                from the store by image file name instead of from the CSV files. Default is None.
+            sizes (numpy array, optional): Width and height of every image, e.g. from a Catalog. Default is None,
+                which reads them from the image headers when needed.
         '''
         self._jpg_paths = jpg_paths
         self._csv_paths = csv_paths
         self._transform = transform
         self._bird_only = bird_only
+        self._annotations = annotations
+        self._sizes = sizes
 
-    def __getitem__(self, idx):
+    def _target_df(self, idx):
         '''
-        Get image and target for a given index.
-
-        Args:
-            idx (int): Index of the item to get.
-
-        Returns:
-            Tuple of image and target.
+        Returns the annotations of the image at a given index as a dataframe.
         '''
-        # file path
-        image_path, target_path = self._jpg_paths[idx], self._csv_paths[idx]
-
-        # image
-        image = Image.open(image_path).convert('RGB')
+        if self._annotations is not None:
+            return self._annotations.get(os.path.splitext(os.path.basename(self._jpg_paths[idx]))[0])
+        return csv_to_df(self._csv_paths[idx])
 
+    def _target(self, idx):
+        '''
+        Returns the target of the image at a given index, before transforms.
+        '''
         # labels
-        target_df = csv_to_df(target_path)
+        target_df = self._target_df(idx)
         num_objs = len(target_df)
         if self._bird_only:
             labels = torch.tensor([1] * num_objs, dtype=torch.int64)
         else:
-            labels = torch.tensor(target_df['class_id'].values, dtype=torch.int64)
+            labels = torch.as_tensor(target_df['class_id'].to_numpy(dtype='int64'))
 
         # boxes
-        boxes = []
-        for row_idx in range(num_objs):
-            x_1 = target_df.iloc[row_idx]['xmin']
-            y_1 = target_df.iloc[row_idx]['ymin']
-            x_2 = target_df.iloc[row_idx]['xmax']
-            y_2 = target_df.iloc[row_idx]['ymax']
-            boxes.append([x_1, y_1, x_2, y_2])
-        boxes = torch.as_tensor(boxes, dtype=torch.float32)
+        boxes = torch.as_tensor(target_df[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy(dtype='float32').reshape(-1, 4))
 
         # compute area
         area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
@@ -67,6 +71,55 @@ class ObjectDetectionDataset(torch.utils.data.Dataset):
         target['image_id'] = torch.tensor([idx])
         target["area"] = area
         target["iscrowd"] = iscrowd
+        return target
+
+    def ground_truth_key(self):
+        '''
+        Returns a key which changes whenever the targets returned by get_annotations change. The targets of
+        this dataset never change.
+        '''
+        return None
+
+    def get_annotations(self, idx):
+        '''
+        Get the image size and the target for a given index without decoding the image. The size is read from
+        the image header and the target is the one of __getitem__ before transforms.
+
+        Args:
+            idx (int): Index of the item to get.
+
+        Returns:
+            Tuple of image height, image width and target.
+        '''
+        if self._sizes is not None:
+            width, height = self._sizes[idx]
+        else:
+            with Image.open(self._jpg_paths[idx]) as image:
+                width, height = image.size
+        return int(height), int(width), self._target(idx)
+
+    def with_transform(self, transform):
+        '''
+        Returns a copy of the dataset with other transforms, e.g. to evaluate on the training images without
+        augmentation.
+        '''
+        dataset = copy.copy(self)
+        dataset._transform = transform
+        return dataset
+
+    def __getitem__(self, idx):
+        '''
+        Get image and target for a given index.
+
+        Args:
+            idx (int): Index of the item to get.
+
+        Returns:
+            Tuple of image and target.
+        '''
+        # image
+        image = Image.open(self._jpg_paths[idx]).convert('RGB')
+        target = self._target(idx)
 
         # apply transforms
         if self._transform is not None:
@@ -84,6 +137,298 @@ class ObjectDetectionDataset(torch.utils.data.Dataset):
         return len(self._jpg_paths)
 
 
+class RandomWindowDataset(torch.utils.data.Dataset):
+    def __init__(self, jpg_paths, csv_paths, transform, window_size, windows_per_epoch, bird_only=True,
+                 annotations=None, windows_per_image=4, min_visibility=0.5, cache_mb=256, seed=0, sizes=None,
+                 scale=1):
+        '''
+        Initialize RandomWindowDataset object, which samples windows of the training size at random positions
+        of the raw annotated images instead of reading a pre-tiled copy of them. Every epoch draws a new set of
+        windows; consecutive indices take windows_per_image windows from the same image, so that an image is
+        decoded once per group of windows and kept in a small per-worker cache. Boxes are clipped to the window
+        like FixedSizeCrop does, and boxes of which less than min_visibility remains are dropped. With a scale
+        below 1 the windows and their
+        boxes are returned resized by it, and the images are decoded at a reduced resolution where it is at most
+        half.
+
+        Args:
+            jpg_paths (list of str): List of paths to the raw image files.
+            csv_paths (list of str): List of paths to the CSV files containing target data.
+            transform: Transforms to apply to windows and targets.
+            window_size (int or tuple): Height and width of the windows. Windows of small images are padded.
+            windows_per_epoch (int): Number of windows in an epoch.
+            bird_only (boolean): Whether to only include bird species. Default is True.
+            annotations (AnnotationStore, optional): Consolidated annotations to read targets from. Default is None.
+            windows_per_image (int): Number of consecutive windows taken from one image. Default is 4.
+            min_visibility (float): Minimum fraction of a box inside a window to keep it. Default is 0.5.
+            cache_mb (float): Megabytes of decoded images kept by every worker. The last decoded image is always
+                kept. Default is 256.
+            seed (int): Seed of the window positions, combined with the epoch. Default is 0.
+            sizes (numpy array, optional): Width and height of every image, e.g. from a Catalog. Default is None,
+                which reads them from the image headers.
+            scale (float): Factor of at most 1 by which the windows are resized, e.g. the factor the detector
+                resizes them by anyway. Default is 1, which keeps the full resolution.
+        '''
+        self._images = ObjectDetectionDataset(jpg_paths, csv_paths, None, bird_only, annotations)
+        self._targets = {}
+        self._transform = transform
+        self._window = (window_size, window_size) if isinstance(window_size, int) else tuple(window_size)
+        self._windows_per_epoch = windows_per_epoch
+        self._windows_per_image = windows_per_image
+        self._min_visibility = min_visibility
+        self._cache_bytes = cache_mb * 2 ** 20
+        self._cache = OrderedDict()
+        self._scale = scale
+        self._output = tuple(max(1, round(side * scale)) for side in self._window)
+        self._seed = seed
+        self._epoch = 0
+
+        # sample images in proportion to the number of windows they hold, read from the image headers
+        self.sizes = sizes if sizes is not None else get_image_sizes(jpg_paths)
+        self._weights = np.maximum(self.sizes[:, 0] * self.sizes[:, 1], 1) / np.prod(self._window)
+        self._weights = self._weights / self._weights.sum()
+        self._plan = None
+
+    def set_epoch(self, epoch):
+        '''
+        Sets the epoch, so that every epoch draws different windows.
+        '''
+        self._epoch = epoch
+        self._plan = None
+
+    def _image_plan(self):
+        # the image of every group of windows_per_image windows
+        if self._plan is None:
+            rng = np.random.default_rng((self._seed, self._epoch))
+            n_groups = math.ceil(self._windows_per_epoch / self._windows_per_image)
+            self._plan = rng.choice(len(self._weights), n_groups, p=self._weights)
+        return self._plan
+
+    def window(self, idx):
+        '''
+        Returns the image index and the (left, top, right, bottom) box of the window at a given index.
+        '''
+        image_idx = int(self._image_plan()[idx // self._windows_per_image])
+        width, height = self.sizes[image_idx]
+        rng = np.random.default_rng((self._seed, self._epoch, idx))
+        left = int(rng.integers(max(width - self._window[1], 0) + 1))
+        top = int(rng.integers(max(height - self._window[0], 0) + 1))
+        return image_idx, (left, top, left + self._window[1], top + self._window[0])
+
+    def _load(self, image_idx):
+        # decode every image once per group of windows, at a reduced resolution where the scale allows it
+        if image_idx in self._cache:
+            self._cache.move_to_end(image_idx)
+            return self._cache[image_idx]
+        target_size = None
+        if self._scale < 1:
+            width, height = self.sizes[image_idx]
+            target_size = (math.ceil(width * self._scale), math.ceil(height * self._scale))
+        image = load_image(self._images._jpg_paths[image_idx], target_size)
+        self._cache[image_idx] = image
+        while len(self._cache) > 1 and sum(cached.width * cached.height * len(cached.getbands())
+                                           for cached in self._cache.values()) > self._cache_bytes:
+            self._cache.popitem(last=False)
+        return image
+
+    def _crop(self, image_idx, box):
+        # crop the window from the image decoded at full or reduced resolution and resize it by the scale
+        image = self._load(image_idx)
+        if self._scale == 1:
+            return image.crop(box)
+        width, height = self.sizes[image_idx]
+        left, top, right, bottom = box
+        right, bottom = min(right, width), min(bottom, height)
+        fx, fy = image.width / width, image.height / height
+        sx, sy = self._output[1] / self._window[1], self._output[0] / self._window[0]
+
+        # the part of the window outside of a small image is padded like crop does
+        window = Image.new(image.mode, (self._output[1], self._output[0]))
+        size = (max(1, round((right - left) * sx)), max(1, round((bottom - top) * sy)))
+        window.paste(image.resize(size, Image.BILINEAR, box=(left * fx, top * fy, right * fx, bottom * fy)))
+        return window
+
+    def window_image(self, idx):
+        '''
+        Returns the window at a given index as a PIL image before transforms, e.g. to draw predictions on it.
+        '''
+        image_idx, box = self.window(idx)
+        return self._crop(image_idx, box)
+
+    def _image_target(self, image_idx):
+        # targets of the images are small and kept for every image
+        if image_idx not in self._targets:
+            self._targets[image_idx] = self._images._target(image_idx)
+        return self._targets[image_idx]
+
+    def ground_truth_key(self):
+        '''
+        Returns a key which changes whenever the targets returned by get_annotations change, i.e. the epoch.
+        '''
+        return self._epoch
+
+    def get_annotations(self, idx):
+        '''
+        Get the window size and the target for a given index without decoding the image.
+
+        Args:
+            idx (int): Index of the item to get.
+
+        Returns:
+            Tuple of window height, window width and target.
+        '''
+        return self._output[0], self._output[1], self._window_target(idx)[1]
+
+    def with_transform(self, transform):
+        '''
+        Returns a copy of the dataset with other transforms, e.g. to evaluate on the training windows without
+        augmentation. The copy keeps the epoch it was made in, so it draws the same windows every time.
+        '''
+        dataset = copy.copy(self)
+        dataset._transform = transform
+        dataset._cache = OrderedDict()
+        dataset._targets = {}
+        return dataset
+
+    def _window_target(self, idx):
+        '''
+        Returns the image index, the target and the (left, top, right, bottom) box of the window at a given
+        index, before transforms.
+        '''
+        image_idx, (left, top, right, bottom) = self.window(idx)
+        target = self._image_target(image_idx)
+
+        # clip the boxes in the window to it and drop the mostly hidden ones, scanning every box of the image
+        # is faster than a spatial index for the numbers of birds in an image
+        boxes = target['boxes']
+        rows = torch.nonzero((boxes[:, 0] < right) & (boxes[:, 2] > left) &
+                             (boxes[:, 1] < bottom) & (boxes[:, 3] > top)).flatten()
+        boxes = boxes[rows]
+        boxes[:, 0::2] = (boxes[:, 0::2] - left).clamp(min=0, max=right - left)
+        boxes[:, 1::2] = (boxes[:, 1::2] - top).clamp(min=0, max=bottom - top)
+        area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+        visible = (area > 0) & (area >= self._min_visibility * target['area'][rows])
+
+        # resize the boxes with the window
+        sx, sy = self._output[1] / self._window[1], self._output[0] / self._window[0]
+        boxes[:, 0::2] *= sx
+        boxes[:, 1::2] *= sy
+
+        window_target = {}
+        window_target['boxes'] = boxes[visible]
+        window_target['labels'] = target['labels'][rows[visible]]
+        window_target['image_id'] = torch.tensor([idx])
+        window_target['area'] = area[visible] * sx * sy
+        window_target['iscrowd'] = target['iscrowd'][rows[visible]]
+        return image_idx, window_target, (left, top, right, bottom)
+
+    def __getitem__(self, idx):
+        '''
+        Get window and target for a given index.
+
+        Args:
+            idx (int): Index of the item to get.
+
+        Returns:
+            Tuple of window and target.
+        '''
+        image_idx, window_target, box = self._window_target(idx)
+        window = self._crop(image_idx, box)
+
+        # apply transforms
+        if self._transform is not None:
+            window, window_target = self._transform(window, window_target)
+
+        return window, window_target
+
+    def __len__(self):
+        '''
+        Return the number of windows in an epoch.
+        '''
+        return self._windows_per_epoch
+
+
+class IndexedImageDataset(torch.utils.data.Dataset):
+    def __init__(self, index_path, root, split=None, transform=None, decode_size=None):
+        '''
+        Initialize IndexedImageDataset object over the cropped images listed in a split index file.
+        Like ImageFolder, it exposes classes, class_to_idx, samples and targets. Classes are taken from
+        the whole index, so labels are the same for every split.
+
+        Args:
+            index_path (str): Path of the csv index file with columns path, class_name and split.
+            root (str): Path to the folder the paths in the index are relative to.
+            split (str, optional): Only include the images of this split ('train', 'val' or 'test').
+                Default is None, which includes every image.
+            transform: Transforms to apply to images.
+            decode_size (int, optional): Size of the shorter side the images will be resized to. If given,
+                JPEGs at least twice as large are decoded at a reduced resolution. Default is None.
+        '''
+        index = csv_to_df(index_path)
+        self.classes = sorted(index['class_name'].unique())
+        self.class_to_idx = {name: idx for idx, name in enumerate(self.classes)}
+        if split is not None:
+            index = index[index['split'] == split]
+        self.samples = [(os.path.join(root, path), self.class_to_idx[class_name])
+                        for path, class_name in zip(index['path'], index['class_name'])]
+        self.targets = [label for dummy, label in self.samples]
+        self.transform = transform
+        self._decode_size = decode_size
+
+    def __getitem__(self, idx):
+        '''
+        Get image and label for a given index.
+
+        Args:
+            idx (int): Index of the item to get.
+
+        Returns:
+            Tuple of image and label.
+        '''
+        path, label = self.samples[idx]
+        image = load_image(path, self._decode_size)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, label
+
+    def __len__(self):
+        '''
+        Return the length of the dataset.
+        '''
+        return len(self.samples)
+
+
+class ImageFileDataset(torch.utils.data.Dataset):
+    def __init__(self, paths, transform=None):
+        '''
+        Initialize ImageFileDataset object over image files without annotations, e.g. to predict on them.
+
+        Args:
+            paths (list of str): List of paths to the image files.
+            transform: Transforms to apply to images, called with the image and None as target.
+        '''
+        self._paths = paths
+        self._transform = transform
+
+    def __getitem__(self, idx):
+        '''
+        Get image and path for a given index.
+
+        Args:
+            idx (int): Index of the item to get.
+
+        Returns:
+            Tuple of image and path.
+        '''
+        image = load_image(self._paths[idx])
+        if self._transform is not None:
+            image, dummy = self._transform(image, None)
+        return image, self._paths[idx]
+
+    def __len__(self):
+        return len(self._paths)
+
+
 def od_collate_fn(batch):
     ''' 
     Stack images and targets in batches of consistant size and shape for object detection.
@@ -97,7 +442,364 @@ def od_collate_fn(batch):
     return tuple(zip(*batch))
 
 
-def get_od_dataloader(jpg_paths, csv_paths, transform, batch_size, shuffle, species):
+def get_image_sizes(jpg_paths):
+    '''
+    Returns the size of every image, read from the image headers without decoding the images.
+
+    Args:
+        jpg_paths (list of str): List of paths to images.
+
+    Returns:
+        A numpy array of shape (N, 2) holding the width and height of every image.
+    '''
+    sizes = np.zeros((len(jpg_paths), 2), dtype=np.int64)
+    for idx, path in enumerate(jpg_paths):
+        with Image.open(path) as image:
+            sizes[idx] = image.size
+    return sizes
+
+
+def get_size_groups(sizes, aspect_bins=3, area_step=1.0):
+    '''
+    Assigns every image to a group of images with a similar aspect ratio and a similar area.
+
+    Args:
+        sizes (numpy array): Array of shape (N, 2) holding the width and height of every image.
+        aspect_bins (int): Number of aspect ratio bins on each side of a square, between ratios 1/2 and 2.
+            Default is 3.
+        area_step (float): Width of the area bins in powers of two, e.g. 1.0 puts images whose areas differ by
+            less than a factor of two together. Default is 1.0.
+
+    Returns:
+        A numpy array with the group id of every image.
+    '''
+    if len(sizes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    sizes = np.maximum(sizes, 1)
+    bins = 2 ** np.linspace(-1, 1, 2 * aspect_bins + 1)
+    aspect = np.digitize(sizes[:, 0] / sizes[:, 1], bins)
+    area = np.floor(np.log2(sizes[:, 0] * sizes[:, 1]) / area_step).astype(np.int64)
+    dummy, group_ids = np.unique(np.stack([aspect, area], axis=1), axis=0, return_inverse=True)
+    return group_ids.reshape(-1)
+
+
+def padding_waste(sizes, batches):
+    '''
+    Returns the fraction of padded pixels when the images of every batch are padded to the largest width and
+    height of the batch, as GeneralizedRCNNTransform does.
+
+    Args:
+        sizes (numpy array): Array of shape (N, 2) holding the width and height of every image.
+        batches (list of list of int): Indices of the images of every batch.
+    '''
+    pixels = 0
+    padded = 0
+    for batch in batches:
+        batch_sizes = sizes[batch]
+        pixels += int((batch_sizes[:, 0] * batch_sizes[:, 1]).sum())
+        padded += len(batch) * int(batch_sizes[:, 0].max()) * int(batch_sizes[:, 1].max())
+    return 1 - pixels / padded if padded else 0.0
+
+
+class DensityAwareSampler(torch.utils.data.Sampler):
+    '''
+    Sampler which keeps every image with bounding boxes, draws a different subset of the background images
+    (images without any bounding box) every epoch and repeats images holding rare species. The composition
+    of every epoch is printed.
+    '''
+    def __init__(self, counts, background_ratio=0.25, rare=None, rare_repeat=1, shuffle=True, seed=0):
+        '''
+        Initialize DensityAwareSampler object.
+
+        Args:
+            counts (numpy array): Number of bounding boxes of every image.
+            background_ratio (float): Fraction of the background images drawn every epoch. Default is 0.25.
+            rare (numpy array, optional): Boolean mask of the images holding a rare species. Default is None.
+            rare_repeat (int): Number of times images holding a rare species are sampled per epoch. Default is 1.
+            shuffle (boolean): Whether to shuffle the sampled images. Default is True.
+            seed (int): Seed of the sampling, combined with the epoch. Default is 0.
+        '''
+        counts = np.asarray(counts)
+        self._background = np.flatnonzero(counts == 0)
+        self._annotated = np.flatnonzero(counts > 0)
+        self._rare = np.flatnonzero(rare) if rare is not None else np.zeros(0, dtype=np.int64)
+        self._n_background = int(round(background_ratio * len(self._background)))
+        self._rare_repeat = rare_repeat
+        self._shuffle = shuffle
+        self._seed = seed
+        self._epoch = 0
+
+    def set_epoch(self, epoch):
+        '''
+        Sets the epoch, so that every epoch draws different background images.
+        '''
+        self._epoch = epoch
+
+    def epoch_indices(self, log=False):
+        '''
+        Returns the indices of the images sampled in the current epoch.
+
+        Args:
+            log (boolean): Whether to print the composition of the epoch. Default is False.
+        '''
+        rng = np.random.default_rng((self._seed, self._epoch))
+        background = rng.choice(self._background, self._n_background, replace=False)
+        extra = np.tile(self._rare, self._rare_repeat - 1)
+        indices = np.concatenate([self._annotated, background, extra]).astype(np.int64)
+        if self._shuffle:
+            rng.shuffle(indices)
+        if log:
+            print(f'Epoch {self._epoch} samples: {len(self._annotated)} annotated images, '
+                  f'{len(background)} of {len(self._background)} background images, '
+                  f'{len(extra)} repeated images of rare species')
+        return indices
+
+    def __iter__(self):
+        yield from self.epoch_indices(log=True).tolist()
+
+    def __len__(self):
+        return len(self._annotated) + self._n_background + len(self._rare) * (self._rare_repeat - 1)
+
+
+class GroupedBatchSampler(torch.utils.data.Sampler):
+    '''
+    Batch sampler which only puts images of the same group, e.g. of a similar size and aspect ratio, into a
+    batch, so that little compute is spent on padding. Every batch is drawn from one group; the images of a
+    group and the order of the batches are shuffled every epoch.
+    '''
+    def __init__(self, group_ids, batch_size, shuffle=True, seed=0, sizes=None, sampler=None):
+        '''
+        Initialize GroupedBatchSampler object.
+
+        Args:
+            group_ids (numpy array): Group id of every image, e.g. from get_size_groups.
+            batch_size (int): Batch size.
+            shuffle (boolean): Whether to shuffle the images and the batches. Default is True.
+            seed (int): Seed of the shuffling, combined with the epoch. Default is 0.
+            sizes (numpy array, optional): Width and height of every image, used by padding_stats.
+                Default is None.
+            sampler (DensityAwareSampler, optional): Sampler drawing the images of every epoch. Default is None,
+                which uses every image once.
+        '''
+        self._group_ids = np.asarray(group_ids)
+        self._sampler = sampler
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._seed = seed
+        self._sizes = sizes
+        self._epoch = 0
+
+    def set_epoch(self, epoch):
+        '''
+        Sets the epoch, so that every epoch draws different batches.
+        '''
+        self._epoch = epoch
+        if self._sampler is not None:
+            self._sampler.set_epoch(epoch)
+
+    def _indices(self, log=False):
+        if self._sampler is not None:
+            return self._sampler.epoch_indices(log)
+        return np.arange(len(self._group_ids))
+
+    def _batches(self, log=False):
+        rng = np.random.default_rng((self._seed, self._epoch))
+        batches = []
+        epoch_indices = np.sort(self._indices(log))
+        epoch_groups = self._group_ids[epoch_indices]
+        for group in np.unique(epoch_groups):
+            indices = epoch_indices[epoch_groups == group]
+            if self._shuffle:
+                rng.shuffle(indices)
+            for start in range(0, len(indices), self._batch_size):
+                batches.append(indices[start:start + self._batch_size].tolist())
+        if self._shuffle:
+            batches = [batches[idx] for idx in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        yield from self._batches(log=True)
+
+    def __len__(self):
+        counts = np.unique(self._group_ids[self._indices()], return_counts=True)[1]
+        return sum(math.ceil(count / self._batch_size) for count in counts)
+
+    def padding_stats(self):
+        '''
+        Returns the padding waste of the batches of the current epoch and of the same images batched without
+        grouping, as fractions of padded pixels.
+        '''
+        rng = np.random.default_rng((self._seed, self._epoch))
+        order = rng.permutation(self._indices())
+        ungrouped = [order[start:start + self._batch_size] for start in range(0, len(order), self._batch_size)]
+        return {'grouped': padding_waste(self._sizes, self._batches()),
+                'ungrouped': padding_waste(self._sizes, ungrouped),
+                'groups': len(np.unique(self._group_ids)),
+                'batches': len(self)}
+
+
+def get_density_sampler(jpg_paths, csv_paths, annotations=None, background_ratio=0.25, rare_repeat=1,
+                        rare_fraction=0.01, shuffle=True):
+    '''
+    Returns a DensityAwareSampler built from the number of bounding boxes of every image. A species is rare
+    if it has less than rare_fraction of all bounding boxes.
+
+    Args:
+        jpg_paths (list of str): List of paths to images.
+        csv_paths (list of str): List of paths to targets.
+        annotations (AnnotationStore, optional): Consolidated annotations to count bounding boxes in instead of
+            the CSV files. Default is None.
+        background_ratio (float): Fraction of the background images drawn every epoch. Default is 0.25.
+        rare_repeat (int): Number of times images holding a rare species are sampled per epoch. Default is 1.
+        rare_fraction (float): Fraction of the bounding boxes below which a species is rare. Default is 0.01.
+        shuffle (boolean): Whether to shuffle the sampled images. Default is True.
+
+    Returns:
+        A DensityAwareSampler object.
+    '''
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in jpg_paths]
+    if annotations is not None:
+        frame = annotations.frame[['image', 'class_name']].astype(str)
+        frame = frame[frame['image'].isin(stems)]
+    else:
+        # no files give an empty sampler, like an annotation store without them
+        frames = [csv_to_df(csv_file)[['class_name']].assign(image=stem)
+                  for stem, csv_file in zip(stems, csv_paths)]
+        frame = pd.concat(frames, axis=0, ignore_index=True) if frames else pd.DataFrame(
+            columns=['class_name', 'image'])
+    counts = frame['image'].value_counts().reindex(stems, fill_value=0).to_numpy()
+
+    # images holding at least one box of a rare species
+    class_counts = frame['class_name'].value_counts()
+    rare_classes = class_counts.index[class_counts < rare_fraction * class_counts.sum()]
+    rare = np.isin(stems, frame.loc[frame['class_name'].isin(rare_classes), 'image'].unique())
+    return DensityAwareSampler(counts, background_ratio, rare, rare_repeat, shuffle, seed=0)
+
+
+def get_subset_loader(dataloader, fraction, seed=0, transform=None):
+    '''
+    Returns a dataloader over a fixed random fraction of the dataset of a dataloader, in order.
+
+    Args:
+        dataloader (dataloader): The data loader to subsample.
+        fraction (float): The fraction of the dataset to keep.
+        seed (int): The seed of the random subset. Defaults to 0.
+        transform (optional): Transforms replacing those of the dataset, which needs a with_transform method.
+            Defaults to None, which keeps the transforms of the dataset.
+
+    Returns:
+        A data loader over the subset, with the batch size and collate function of the data loader.
+    '''
+    dataset = dataloader.dataset
+    if transform is not None:
+        dataset = dataset.with_transform(transform)
+    n_samples = max(1, int(round(len(dataset) * fraction)))
+    indices = np.sort(np.random.default_rng(seed).choice(len(dataset), n_samples, replace=False))
+    batch_size = dataloader.batch_size or getattr(dataloader.batch_sampler, 'batch_size', 1)
+    subset = torch.utils.data.Subset(dataset, indices.tolist())
+    return torch.utils.data.DataLoader(subset, batch_size=batch_size, shuffle=False, collate_fn=dataloader.collate_fn,
+                                       num_workers=dataloader.num_workers)
+
+
+class DistributedBatchSampler(torch.utils.data.Sampler):
+    '''
+    Batch sampler which splits the batches of another batch sampler between the processes of distributed
+    training. Every process draws the same batches, from samplers seeded with the epoch, and keeps every
+    num_replicas-th of them; the first batches are repeated so that every process gets as many batches.
+    '''
+    def __init__(self, batch_sampler, num_replicas, rank):
+        '''
+        Initialize DistributedBatchSampler object.
+
+        Args:
+            batch_sampler (Sampler): Batch sampler drawing the same batches in every process, e.g. a
+                GroupedBatchSampler or a batch sampler over a DensityAwareSampler.
+            num_replicas (int): Number of processes.
+            rank (int): Rank of the process.
+        '''
+        self._batch_sampler = batch_sampler
+        self._num_replicas = num_replicas
+        self._rank = rank
+
+    def set_epoch(self, epoch):
+        '''
+        Sets the epoch of the batch sampler or of its sampler, so that every epoch draws different batches.
+        '''
+        for source in (self._batch_sampler, getattr(self._batch_sampler, 'sampler', None)):
+            if hasattr(source, 'set_epoch'):
+                source.set_epoch(epoch)
+
+    def __iter__(self):
+        batches = list(self._batch_sampler)
+        batches += batches[:len(self) * self._num_replicas - len(batches)]
+        yield from batches[self._rank::self._num_replicas]
+
+    def __len__(self):
+        return math.ceil(len(self._batch_sampler) / self._num_replicas)
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    '''
+    Sampler over every num_replicas-th sample of a dataset in order, so that the processes of distributed
+    training evaluate disjoint shards. Unlike a DistributedSampler no samples are repeated, so the shards may
+    differ in length by one.
+    '''
+    def __init__(self, n_samples, num_replicas, rank):
+        '''
+        Initialize ShardSampler object.
+
+        Args:
+            n_samples (int): Number of samples of the dataset.
+            num_replicas (int): Number of processes.
+            rank (int): Rank of the process.
+        '''
+        self._indices = range(rank, n_samples, num_replicas)
+
+    def __iter__(self):
+        return iter(self._indices)
+
+    def __len__(self):
+        return len(self._indices)
+
+
+def get_distributed_loader(dataloader, train=True, seed=0):
+    '''
+    Returns a dataloader over the shard of the process in distributed training, with the batch size, collate
+    function and workers of a dataloader.
+
+    Training loaders with a plain shuffled or sequential sampler are split with a DistributedSampler, which
+    shuffles with the seed and the epoch and repeats samples so that every process gets as many. The batches of
+    other batch samplers, which are seeded with the epoch, are split with a DistributedBatchSampler. Evaluation
+    loaders are split into disjoint shards in order with a ShardSampler.
+
+    Args:
+        dataloader (dataloader): The data loader to split.
+        train (bool): Whether the loader is used for training. Defaults to True.
+        seed (int): The seed of the shuffling of a DistributedSampler. Defaults to 0.
+
+    Returns:
+        The data loader of the process.
+    '''
+    dataset = dataloader.dataset
+    num_replicas, rank = get_world_size(), get_rank()
+    kwargs = {'collate_fn': dataloader.collate_fn, 'num_workers': dataloader.num_workers}
+    batch_size = dataloader.batch_size or getattr(dataloader.batch_sampler, 'batch_size', 1)
+    if not train:
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+                                           sampler=ShardSampler(len(dataset), num_replicas, rank), **kwargs)
+    plain = (torch.utils.data.RandomSampler, torch.utils.data.SequentialSampler)
+    if type(dataloader.batch_sampler) is torch.utils.data.BatchSampler and type(dataloader.sampler) in plain:
+        sampler = torch.utils.data.DistributedSampler(
+            dataset, num_replicas, rank, shuffle=isinstance(dataloader.sampler, torch.utils.data.RandomSampler),
+            seed=seed)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                                           drop_last=dataloader.drop_last, **kwargs)
+    batch_sampler = DistributedBatchSampler(dataloader.batch_sampler, num_replicas, rank)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, **kwargs)
+
+
+def get_od_dataloader(jpg_paths, csv_paths, transform, batch_size, shuffle, species, annotations=None,
+                      group_by_size=False, background_ratio=None, rare_repeat=1, sizes=None):
     '''
     Returns a dataloader for object detection.
 
@@ -108,11 +810,40 @@ def get_od_dataloader(jpg_paths, csv_paths, transform, batch_size, shuffle, spec
         batch_size (int): Batch size.
         shuffle (boolean): Whether to shuffle the data.
         species (boolean): Whether to be bird-only or species.
+        annotations (AnnotationStore, optional): Consolidated annotations to read targets from. Default is None.
+        group_by_size (boolean): Whether to batch images of a similar size and aspect ratio together with a
+            GroupedBatchSampler, which reduces padding. Default is False.
+        background_ratio (float, optional): If given, only this fraction of the images without bounding boxes
+            is drawn every epoch with a DensityAwareSampler. Default is None, which uses every image.
+        rare_repeat (int): Number of times images holding a rare species are sampled per epoch when
+            background_ratio is given. Default is 1.
+        sizes (numpy array, optional): Width and height of every image, e.g. from a Catalog, used to group the
+            images by size. Default is None, which reads them from the image headers.
 
     Returns:
         The object detection dataloader.
     '''
-    od_dataset = ObjectDetectionDataset(jpg_paths, csv_paths, transform, species)
+    od_dataset = ObjectDetectionDataset(jpg_paths, csv_paths, transform, species, annotations, sizes)
+
+    # Subsample background images and oversample rare species
+    sampler = None
+    if background_ratio is not None:
+        sampler = get_density_sampler(jpg_paths, csv_paths, annotations, background_ratio, rare_repeat,
+                                      shuffle=shuffle)
+
+    # Batch images of similar sizes together
+    if group_by_size:
+        if sizes is None:
+            sizes = get_image_sizes(jpg_paths)
+        batch_sampler = GroupedBatchSampler(get_size_groups(sizes), batch_size, shuffle, sizes=sizes,
+                                            sampler=sampler)
+        stats = batch_sampler.padding_stats()
+        print(f"Grouped {len(jpg_paths)} images into {stats['groups']} size groups, padding waste "
+              f"{stats['grouped']:.1%} (ungrouped {stats['ungrouped']:.1%})")
+        return torch.utils.data.DataLoader(od_dataset, batch_sampler=batch_sampler, collate_fn=od_collate_fn)
+    if sampler is not None:
+        return torch.utils.data.DataLoader(od_dataset, batch_size=batch_size, sampler=sampler,
+                                           collate_fn=od_collate_fn)
 
     # Create PyTorch DataLoader for Object Detection
     od_dataloader = torch.utils.data.DataLoader(od_dataset,
@@ -122,21 +853,98 @@ def get_od_dataloader(jpg_paths, csv_paths, transform, batch_size, shuffle, spec
     return od_dataloader
 
 
-def get_clf_dataloader_from_dir(dir_path, batch_size, shuffle, preprocess):
+def get_window_dataloader(jpg_paths, csv_paths, transform, batch_size, species, window_size, windows_per_epoch,
+                          annotations=None, windows_per_image=4, seed=0, sizes=None, scale=1):
+    '''
+    Returns a dataloader for object detection over random windows of raw images.
+
+    Args:
+        jpg_paths (list of str): List of paths to raw images.
+        csv_paths (list of str): List of paths to targets.
+        transform: Transforms to apply to windows.
+        batch_size (int): Batch size.
+        species (boolean): Whether to be bird-only or species.
+        window_size (int or tuple): Height and width of the windows.
+        windows_per_epoch (int): Number of windows in an epoch.
+        annotations (AnnotationStore, optional): Consolidated annotations to read targets from. Default is None.
+        windows_per_image (int): Number of consecutive windows taken from one image. Default is 4.
+        seed (int): Seed of the window positions. Default is 0.
+        sizes (numpy array, optional): Width and height of every image, e.g. from a Catalog. Default is None.
+        scale (float): Factor of at most 1 by which the windows are resized and decoded. Default is 1.
+
+    Returns:
+        The object detection dataloader.
+    '''
+    window_dataset = RandomWindowDataset(jpg_paths, csv_paths, transform, window_size, windows_per_epoch,
+                                         species, annotations, windows_per_image, seed=seed, sizes=sizes,
+                                         scale=scale)
+
+    # windows are already drawn at random, keep consecutive windows of an image together
+    return torch.utils.data.DataLoader(window_dataset, batch_size=batch_size, shuffle=False,
+                                       collate_fn=od_collate_fn)
+
+
+def get_clf_dataloader_from_dir(dir_path, batch_size, shuffle, preprocess, streaming=False, cache=None,
+                                decode_size=None):
     '''
     Returns a dataloader for classification.
 
     Args:
-        dir_path (str): Path to the folder containing the images.
+        dir_path (str): Path to the folder containing the images, either an image folder with one
+            sub folder per class or a packed dataset written by src.data.records.pack_image_folder.
         batch_size (int): Batch size.
         shuffle (boolean): Whether to shuffle the data.
         preprocess: Transforms to apply to images.
+        streaming (boolean): Whether to read a packed dataset sequentially shard by shard, shuffling
+            at shard level, instead of with random access. Default is False.
+        cache (PreprocessCache, optional): Cache of preprocessed images. If given, it replaces preprocess and
+            the deterministic preprocessing runs only once per image. Default is None.
+        decode_size (int, optional): Size of the shorter side the images will be resized to. If given, image
+            files at least twice as large are decoded at a reduced resolution. Default is None.
 
     Returns:
         The classification dataloader.
     '''
-    data = datasets.ImageFolder(dir_path, transform=preprocess)
+    if is_packed(dir_path) and streaming:
+        data = PackedImageStream(dir_path, transform=preprocess, shuffle=shuffle, decode_size=decode_size)
+        return torch.utils.data.DataLoader(data, batch_size=batch_size)
+    transform = None if cache is not None else preprocess
+    if is_packed(dir_path):
+        data = PackedImageDataset(dir_path, transform=transform, decode_size=decode_size)
+    else:
+        data = datasets.ImageFolder(dir_path, transform=transform, loader=get_image_loader(decode_size))
+    if cache is not None:
+        data = cache.wrap(data, dir_path)
 
     # Create PyTorch DataLoader for Classfication
     dataloader = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=shuffle)
     return dataloader
+
+
+def get_clf_dataloader_from_index(index_path, root, split, batch_size, shuffle, preprocess, cache=None,
+                                  decode_size=None):
+    '''
+    Returns a dataloader for classification over one split of a split index file.
+
+    Args:
+        index_path (str): Path of the csv index file.
+        root (str): Path to the folder the paths in the index are relative to.
+        split (str, optional): Split to load ('train', 'val' or 'test'), or None for every image.
+        batch_size (int): Batch size.
+        shuffle (boolean): Whether to shuffle the data.
+        preprocess: Transforms to apply to images.
+        cache (PreprocessCache, optional): Cache of preprocessed images. If given, it replaces preprocess and
+            the deterministic preprocessing runs only once per image. Default is None.
+        decode_size (int, optional): Size of the shorter side the images will be resized to. If given, image
+            files at least twice as large are decoded at a reduced resolution. Default is None.
+
+    Returns:
+        The classification dataloader.
+    '''
+    if cache is not None:
+        data = IndexedImageDataset(index_path, root, split, decode_size=decode_size)
+        data = cache.wrap(data, f'{index_path}:{split}')
+    else:
+        data = IndexedImageDataset(index_path, root, split, transform=preprocess, decode_size=decode_size)
+    dataloader = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=shuffle)
+    return dataloader
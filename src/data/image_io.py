@@ -0,0 +1,105 @@
+import math
+import time
+from functools import partial
+from PIL import Image
+
+
+def _requested_size(size, target_size):
+    '''
+    Returns the (width, height) an image of a given size has to be decoded at to reach target_size.
+
+    Args:
+        size (tuple): (width, height) of the source image.
+        target_size (int or tuple): Size of the shorter side, or (width, height) the image should cover.
+    '''
+    width, height = size
+    if isinstance(target_size, int):
+        scale = target_size / min(width, height)
+    else:
+        scale = max(target_size[0] / width, target_size[1] / height)
+    return math.ceil(width * scale), math.ceil(height * scale)
+
+
+def load_image(path, target_size=None):
+    '''
+    Opens an image as RGB. When the image is a JPEG and target_size is at most half of its size, the image is
+    decoded at a reduced resolution in the DCT domain (PIL draft mode), which skips most of the decoding work.
+    The returned image is never smaller than target_size; otherwise the image is decoded at full resolution.
+
+    Args:
+        path (str): Path of the image.
+        target_size (int or tuple, optional): Size of the shorter side, or (width, height) the image will be
+            resized to afterwards. Default is None, which decodes at full resolution.
+
+    Returns:
+        A PIL image in RGB mode.
+    '''
+    image = Image.open(path)
+    if target_size is not None and image.format == 'JPEG':
+        width, height = _requested_size(image.size, target_size)
+        if 2 * width <= image.size[0] and 2 * height <= image.size[1]:
+            image.draft('RGB', (width, height))
+    return image.convert('RGB')
+
+
+def load_preview(path, max_size=None):
+    '''
+    Opens a preview of an image as RGB, no larger than max_size. Large JPEGs are decoded at a reduced resolution
+    by load_image before being resized to the preview size.
+
+    Args:
+        path (str): Path of the image.
+        max_size (int, optional): Maximum width and height of the preview. Default is None, which keeps the full
+            size.
+
+    Returns:
+        A tuple of the preview as a PIL image in RGB mode and the scale from image to preview coordinates.
+    '''
+    width, height = Image.open(path).size
+    if not max_size or max(width, height) <= max_size:
+        return load_image(path), 1
+    scale = max_size / max(width, height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return load_image(path, size).resize(size, Image.BILINEAR), scale
+
+
+def get_image_loader(target_size=None):
+    '''
+    Returns an image loader for ImageFolder and the classifier datasets decoding at a reduced resolution.
+
+    Args:
+        target_size (int or tuple, optional): Size the images will be resized to afterwards. Default is None.
+
+    Returns:
+        A function mapping an image path to a PIL image.
+    '''
+    return partial(load_image, target_size=target_size)
+
+
+def benchmark_image_loading(paths, target_size, repeat=3):
+    '''
+    Measures the time to load images at full resolution and with reduced-resolution decoding,
+    both followed by a resize to target_size.
+
+    Args:
+        paths (list of str): Paths of the images to load, e.g. the cropped images or the tiles.
+        target_size (int or tuple): Size the images are resized to.
+        repeat (int): Number of passes over the images. The best pass is reported. Default is 3.
+
+    Returns:
+        A dictionary with the best time in seconds of the full and reduced decoding, and the speed-up.
+    '''
+    def _resize(image):
+        return image.resize(_requested_size(image.size, target_size), Image.BILINEAR)
+
+    timings = {}
+    for name, target in [('full', None), ('reduced', target_size)]:
+        best = float('inf')
+        for dummy in range(repeat):
+            start = time.perf_counter()
+            for path in paths:
+                _resize(load_image(path, target))
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+    timings['speedup'] = timings['full'] / timings['reduced']
+    return timings
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+
+
+class Manifest:
+    '''
+    Keeps track of the files processed by every stage of the database update. For each input key the manifest
+    records the content hashes of the input files and the output files produced from them, so that a stage only
+    has to process new or changed inputs and can remove the outputs of inputs that vanished.
+    '''
+    def __init__(self, path):
+        '''
+        Initialize Manifest object, loading the previous manifest from path if it exists.
+
+        Args:
+            path (str): Path of the JSON file holding the manifest.
+        '''
+        self._path = path
+        self._files = {}
+        self._stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            self._files = manifest.get('files', {})
+            self._stages = manifest.get('stages', {})
+
+    def file_hash(self, file_name):
+        '''
+        Returns the content hash of a file. The hash is only recomputed when the size or modification time
+        of the file differs from the recorded one.
+
+        Args:
+            file_name (str): Path of the file.
+
+        Returns:
+            The SHA-1 hex digest of the file content.
+        '''
+        stat = os.stat(file_name)
+        record = self._files.get(file_name)
+        if record and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime_ns:
+            return record['hash']
+
+        # hash the file content in chunks
+        sha = hashlib.sha1()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self._files[file_name] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest}
+        return digest
+
+    def _stage(self, stage):
+        return self._stages.setdefault(stage, {'state': {}, 'entries': {}})
+
+    def is_current(self, stage, key, file_names):
+        '''
+        Checks whether an input was already processed by a stage with the same content and all of its
+        outputs still exist.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Key identifying the input, e.g. the stem of the image.
+            file_names (list of str): Files the input consists of.
+
+        Returns:
+            True if the input does not need to be processed again, False otherwise.
+        '''
+        entry = self._stage(stage)['entries'].get(key)
+        if entry is None:
+            return False
+        hashes = [self.file_hash(file_name) for file_name in file_names]
+        if entry['hashes'] != hashes:
+            return False
+        return all(os.path.exists(output) for output in entry['outputs'])
+
+    def record(self, stage, key, file_names, outputs):
+        '''
+        Records the hashes of the files of an input and the outputs produced from it.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Key identifying the input.
+            file_names (list of str): Files the input consists of.
+            outputs (list of str): Files produced from the input.
+        '''
+        hashes = [self.file_hash(file_name) for file_name in file_names]
+        self._stage(stage)['entries'][key] = {'hashes': hashes, 'outputs': list(outputs)}
+
+    def outputs(self, stage, key):
+        '''
+        Returns the outputs recorded for an input, or an empty list if the input is unknown.
+        '''
+        entry = self._stage(stage)['entries'].get(key)
+        return list(entry['outputs']) if entry else []
+
+    def remove_outputs(self, stage, key):
+        '''
+        Deletes the outputs recorded for an input and forgets the input.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Key identifying the input.
+        '''
+        entry = self._stage(stage)['entries'].pop(key, None)
+        if entry is None:
+            return
+        for output in entry['outputs']:
+            if os.path.exists(output):
+                os.remove(output)
+
+    def remove_vanished(self, stage, keys):
+        '''
+        Deletes the outputs of every recorded input that is not part of keys anymore.
+
+        Args:
+            stage (str): Name of the stage.
+            keys (iterable of str): Keys of the inputs that currently exist.
+
+        Returns:
+            A list of the keys that were removed.
+        '''
+        keys = set(keys)
+        vanished = [key for key in self._stage(stage)['entries'] if key not in keys]
+        for key in vanished:
+            self.remove_outputs(stage, key)
+        return vanished
+
+    def get_state(self, stage, name, default=None):
+        '''
+        Returns a value stored for a stage, such as the parameters the stage was run with.
+        '''
+        return self._stage(stage)['state'].get(name, default)
+
+    def set_state(self, stage, name, value):
+        '''
+        Stores a JSON serializable value for a stage.
+        '''
+        self._stage(stage)['state'][name] = value
+
+    def invalidate(self, stage):
+        '''
+        Marks every input of a stage as stale and forgets its state, so that all of its inputs are processed
+        again. The outputs stay recorded, so that remove_vanished still deletes the outputs of inputs that
+        vanished in the meantime.
+        '''
+        stage = self._stage(stage)
+        stage['state'] = {}
+        for entry in stage['entries'].values():
+            entry['hashes'] = None
+
+    def save(self):
+        '''
+        Writes the manifest to its path. The file is replaced atomically so an interrupted run
+        never leaves a truncated manifest behind.
+        '''
+        folder = os.path.dirname(self._path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self._files, 'stages': self._stages}, f)
+        os.replace(tmp_path, self._path)
@@ -1,10 +1,11 @@
 import matplotlib.pyplot as plt
 import os
-from torchvision.io import read_image
+from PIL import Image
 from torchvision.utils import draw_bounding_boxes
 import torchvision.transforms.functional as F
 import numpy as np
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
+from .image_io import load_preview
 
 
 def get_cmap(num, name='tab20c'):
@@ -89,10 +90,12 @@ def plot_curves(arr1, arr2, label1, label2, xlabel, ylabel, title, path=None):
     Returns:
         A matplotlib figure of the two curves.
     '''
-    # Create plot with two curves
+    # Create plot with two curves, skipping epochs without values
     fig, axs = plt.subplots()
-    axs.plot(arr1, label=label1)
-    axs.plot(arr2, label=label2)
+    for arr, label in ((arr1, label1), (arr2, label2)):
+        arr = np.asarray(arr, dtype=float)
+        epochs = np.flatnonzero(np.isfinite(arr))
+        axs.plot(epochs, arr[epochs], label=label)
     axs.set_xlabel(xlabel)
     axs.set_ylabel(ylabel)
     axs.set_title(title)
@@ -122,11 +125,12 @@ def plot_precision_recall(stat_arr, xlabel, ylabel, title, path=None):
     '''
     fig, axs = plt.subplots()
 
-    # Plot precision and recall for each epoch for IoU thresholds of 0.5 and 0.75
-    axs.plot(stat_arr[:, 0], label="Precision with IoU=0.5")
-    axs.plot(stat_arr[:, 1], label="Precision with IoU=0.75")
-    axs.plot(stat_arr[:, 2], label="Recall with IoU=0.5")
-    axs.plot(stat_arr[:, 3], label="Recall with IoU=0.75")
+    # Plot precision and recall for each evaluated epoch for IoU thresholds of 0.5 and 0.75
+    epochs = np.flatnonzero(np.isfinite(stat_arr[:, 0]))
+    axs.plot(epochs, stat_arr[epochs, 0], label="Precision with IoU=0.5")
+    axs.plot(epochs, stat_arr[epochs, 1], label="Precision with IoU=0.75")
+    axs.plot(epochs, stat_arr[epochs, 2], label="Recall with IoU=0.5")
+    axs.plot(epochs, stat_arr[epochs, 3], label="Recall with IoU=0.75")
     axs.set_xlabel(xlabel)
     axs.set_ylabel(ylabel)
     axs.set_title(title)
@@ -164,27 +168,33 @@ def show(img, dpi):
     return fig
 
 
-def visualize_predictions(file_paths, output, path, title, dpi, score_threshold=0.8):
+def visualize_predictions(file_paths, output, path, title, dpi, score_threshold=0.8, max_size=None):
     '''
     Visualize bounding box predictions for the test dataset.
 
     Args:
-        file_paths (list): A list of file paths (string) to the images in the test dataset.
+        file_paths (str or PIL image): The path of the image, or the image itself, e.g. a validation window.
         output (dict): A dictionary containing the predictions made by the model.
         path (str): The directory where the output image should be saved.
         title (str): The title of the output image.
         dpi (int): The DPI of the output image.
         score_threshold (float): The minimum score threshold for drawing bounding boxes. 
             Defaults to 0.8.
+        max_size (int, optional): The maximum width and height of the drawn image. Larger images are decoded at
+            a reduced resolution and the boxes are scaled accordingly. Defaults to None, which keeps the full size.
 
     Returns:
         A figure object containing each image overlaid with predicted bounding boxes.
     '''
-    img = read_image(file_paths)
+    if isinstance(file_paths, Image.Image):
+        img, scale = file_paths, 1
+    else:
+        img, scale = load_preview(file_paths, max_size)
+    img = F.pil_to_tensor(img)
 
     # Draw the predicted bounding boxes on the image
-    result = draw_bounding_boxes(img, output['boxes'][output['scores'] > score_threshold],
-                                 colors='blue', width=3)
+    boxes = output['boxes'][output['scores'] > score_threshold] * scale
+    result = draw_bounding_boxes(img, boxes, colors='blue', width=3)
     fig = show(result, dpi)
     if path:
         if not os.path.exists(path):
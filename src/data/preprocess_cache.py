@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+import torchvision.transforms.functional as F
+
+
+class PreprocessCache:
+    '''
+    Settings of a cache of preprocessed classifier inputs. The deterministic part of the preprocessing (resize
+    and center crop) runs once per image and its uint8 result is cached, either in memory with an LRU bound
+    or in an array on disk. The remaining transform runs on the small cached tensors every time.
+    '''
+    def __init__(self, resize_size, crop_size, transform=None,
+                 interpolation=transforms.InterpolationMode.BILINEAR, max_items=4096, cache_path=None):
+        '''
+        Initialize PreprocessCache object.
+
+        Args:
+            resize_size (int): Size the shorter side of an image is resized to.
+            crop_size (int): Size of the square center crop which is cached.
+            transform: Transforms to apply to the cached uint8 tensors.
+            interpolation: Interpolation used for resizing. Default is bilinear.
+            max_items (int, optional): Maximum number of tensors kept by the in-memory cache, e.g. about 600 MB
+                of 224 x 224 crops per process for the default of 4096. None keeps every tensor.
+            cache_path (str, optional): Folder to keep the cache on disk instead of in memory. Default is None.
+        '''
+        self.resize_size = resize_size
+        self.crop_size = crop_size
+        self.transform = transform
+        self.interpolation = interpolation
+        self.max_items = max_items
+        self.cache_path = cache_path
+
+    @classmethod
+    def from_weights(cls, weights, augment=False, max_items=4096, cache_path=None):
+        '''
+        Returns the cache settings equivalent to the preprocessing of pretrained torchvision weights.
+
+        Args:
+            weights: Pretrained torchvision weights, e.g. ResNet50_Weights.IMAGENET1K_V2.
+            augment (boolean): Whether to cache the resized images uncropped and apply a random crop and
+                horizontal flip on every access, for training. Default is False, which caches the center crop
+                so the result is identical to weights.transforms().
+            max_items (int, optional): Maximum number of tensors kept by the in-memory cache. Default is 4096.
+            cache_path (str, optional): Folder to keep the cache on disk instead of in memory. Default is None.
+
+        Returns:
+            A PreprocessCache object.
+        '''
+        preset = weights.transforms()
+        resize_size, crop_size = preset.resize_size[0], preset.crop_size[0]
+        normalize = [transforms.ConvertImageDtype(torch.float), transforms.Normalize(preset.mean, preset.std)]
+        if augment:
+            transform = transforms.Compose([transforms.RandomCrop(crop_size),
+                                            transforms.RandomHorizontalFlip()] + normalize)
+            return cls(resize_size, resize_size, transform, preset.interpolation, max_items, cache_path)
+        return cls(resize_size, crop_size, transforms.Compose(normalize), preset.interpolation, max_items, cache_path)
+
+    def wrap(self, dataset, key):
+        '''
+        Returns a dataset which preprocesses the images of dataset through this cache.
+
+        Args:
+            dataset: Dataset returning (PIL image, label) pairs, i.e. without a transform.
+            key (str): Name of the data, e.g. its folder and split. Together with a fingerprint of the files of
+                the dataset it identifies the on-disk cache file.
+
+        Returns:
+            A CachedPreprocessDataset object.
+        '''
+        return CachedPreprocessDataset(dataset, self, key)
+
+
+def _fingerprint(dataset):
+    # the digest of a packed dataset, or the size and modification time of every image file
+    if hasattr(dataset, 'fingerprint'):
+        return dataset.fingerprint()
+    samples = getattr(dataset, 'samples', None)
+    if samples is None:
+        return None
+    digest = hashlib.sha1()
+    for path, label in samples:
+        stat = os.stat(path)
+        digest.update(f'{path}:{label}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()
+
+
+class CachedPreprocessDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, cache, key):
+        '''
+        Initialize CachedPreprocessDataset object. It exposes the classes and targets of the wrapped dataset.
+
+        Args:
+            dataset: Dataset returning (PIL image, label) pairs.
+            cache (PreprocessCache): Settings of the cache.
+            key (str): Name of the data, used to identify the on-disk cache file.
+        '''
+        self._dataset = dataset
+        self._cache = cache
+        self._memory = OrderedDict()
+        self._arrays = None
+        self.classes = dataset.classes
+        self.targets = dataset.targets
+
+        # name the on-disk cache after the data and the preprocessing, so stale caches are never reused
+        self._file_name = None
+        if cache.cache_path:
+            identity = json.dumps([key, len(dataset), _fingerprint(dataset),
+                                   cache.resize_size, cache.crop_size, str(cache.interpolation)])
+            digest = hashlib.sha1(identity.encode()).hexdigest()[:16]
+            self._file_name = os.path.join(cache.cache_path, f'{digest}_{cache.crop_size}')
+
+    def __getstate__(self):
+        # memory maps cannot be pickled, workers reopen them
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _open(self):
+        '''
+        Opens or creates the on-disk arrays of cached tensors and of flags marking the filled entries.
+        '''
+        if not os.path.exists(self._cache.cache_path):
+            os.makedirs(self._cache.cache_path, exist_ok=True)
+        size = self._cache.crop_size
+        if not os.path.exists(self._file_name + '_flags.npy'):
+            # create the arrays under names of this process, so that DataLoader workers sharing the cache never
+            # open arrays another worker is still creating
+            tmp_name = f'{self._file_name}_{os.getpid()}'
+            np.lib.format.open_memmap(tmp_name + '_data.npy', mode='w+', dtype=np.uint8,
+                                      shape=(len(self._dataset), 3, size, size))
+            np.lib.format.open_memmap(tmp_name + '_flags.npy', mode='w+', dtype=np.uint8,
+                                      shape=(len(self._dataset),))
+            os.replace(tmp_name + '_data.npy', self._file_name + '_data.npy')
+            os.replace(tmp_name + '_flags.npy', self._file_name + '_flags.npy')
+        self._arrays = (np.load(self._file_name + '_data.npy', mmap_mode='r+'),
+                        np.load(self._file_name + '_flags.npy', mmap_mode='r+'))
+
+    def _preprocess(self, idx):
+        '''
+        Returns the resized and center cropped uint8 tensor of the image at a given index.
+        '''
+        image, dummy = self._dataset[idx]
+        image = F.resize(image, self._cache.resize_size, interpolation=self._cache.interpolation, antialias=True)
+        image = F.center_crop(image, self._cache.crop_size)
+        return F.pil_to_tensor(image)
+
+    def _get(self, idx):
+        '''
+        Returns the cached tensor at a given index, preprocessing the image on a cache miss.
+        '''
+        # on-disk cache
+        if self._file_name is not None:
+            if self._arrays is None:
+                self._open()
+            data, flags = self._arrays
+            if not flags[idx]:
+                data[idx] = self._preprocess(idx).numpy()
+                flags[idx] = 1
+            return torch.from_numpy(np.array(data[idx]))
+
+        # in-memory LRU cache
+        if idx in self._memory:
+            self._memory.move_to_end(idx)
+            return self._memory[idx]
+        tensor = self._preprocess(idx)
+        self._memory[idx] = tensor
+        if self._cache.max_items is not None and len(self._memory) > self._cache.max_items:
+            self._memory.popitem(last=False)
+        return tensor
+
+    def __getitem__(self, idx):
+        '''
+        Get the preprocessed image and the label for a given index.
+        '''
+        image = self._get(idx)
+        if self._cache.transform is not None:
+            image = self._cache.transform(image)
+        return image, self.targets[idx]
+
+    def __len__(self):
+        '''
+        Return the length of the dataset.
+        '''
+        return len(self._dataset)
@@ -0,0 +1,228 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import numpy as np
+import torch
+import torchvision.datasets as datasets
+from .image_io import load_image
+
+# Files describing a packed dataset
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.npz'
+
+
+def is_packed(dir_path):
+    '''
+    Returns whether a folder holds a packed dataset written by pack_samples.
+    '''
+    return os.path.exists(os.path.join(dir_path, META_FILE))
+
+
+def pack_samples(samples, classes, out_path, shard_size=256 * 1024 * 1024, seed=0):
+    '''
+    Packs encoded image files into a few large shard files. Each shard holds the concatenated bytes of its
+    images, and one index records the shard, offset, length and label of every image.
+
+    Args:
+        samples (list of tuple): List of (image path, label) pairs, e.g. ImageFolder.samples.
+        classes (list of str): Class names, indexed by label.
+        out_path (str): Folder to save the shards, the index and the metadata.
+        shard_size (int): Approximate size of a shard in bytes. Default is 256 MiB.
+        seed (int, optional): Seed to shuffle the samples before packing, so that every shard holds a mix of
+            classes. None keeps the order of samples. Default is 0.
+    '''
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+    order = np.arange(len(samples))
+    if seed is not None:
+        np.random.default_rng(seed).shuffle(order)
+
+    shards = []
+    shard_ids = np.zeros(len(samples), dtype=np.int32)
+    offsets = np.zeros(len(samples), dtype=np.int64)
+    lengths = np.zeros(len(samples), dtype=np.int64)
+    labels = np.zeros(len(samples), dtype=np.int64)
+    shard = None
+    for idx, sample_idx in enumerate(order):
+        path, label = samples[sample_idx]
+
+        # start a new shard when the current one is full
+        if shard is None or shard.tell() >= shard_size:
+            if shard is not None:
+                shard.close()
+            shards.append(f'shard_{len(shards):05d}.bin')
+            shard = open(os.path.join(out_path, shards[-1]), 'wb')
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        shard_ids[idx] = len(shards) - 1
+        offsets[idx] = shard.tell()
+        lengths[idx] = len(data)
+        labels[idx] = label
+        shard.write(data)
+    if shard is not None:
+        shard.close()
+
+    np.savez(os.path.join(out_path, INDEX_FILE), shard=shard_ids, offset=offsets, length=lengths, label=labels)
+    with open(os.path.join(out_path, META_FILE), 'w') as f:
+        json.dump({'classes': list(classes), 'shards': shards}, f)
+    print(f'Finished packing {len(samples)} images into {len(shards)} shards')
+
+
+def pack_image_folder(dir_path, out_path, shard_size=256 * 1024 * 1024, seed=0):
+    '''
+    Packs an image folder with one sub folder per class, as read by ImageFolder, into shard files.
+
+    Args:
+        dir_path (str): Path to the folder containing the images.
+        out_path (str): Folder to save the packed dataset.
+        shard_size (int): Approximate size of a shard in bytes. Default is 256 MiB.
+        seed (int, optional): Seed to shuffle the samples before packing. Default is 0.
+    '''
+    data = datasets.ImageFolder(dir_path)
+    pack_samples(data.samples, data.classes, out_path, shard_size, seed)
+
+
+class _PackedRecords:
+    '''
+    Shared reading logic of the packed datasets. Shards are memory mapped lazily, so every DataLoader worker
+    opens its own maps after it has been started.
+    '''
+    def __init__(self, dir_path, transform=None, decode_size=None):
+        with open(os.path.join(dir_path, META_FILE)) as f:
+            meta = json.load(f)
+        index = np.load(os.path.join(dir_path, INDEX_FILE))
+        self._dir_path = dir_path
+        self._shard_files = meta['shards']
+        self._shard = index['shard']
+        self._offset = index['offset']
+        self._length = index['length']
+        self._maps = {}
+        self.transform = transform
+        self._decode_size = decode_size
+        self.classes = meta['classes']
+        self.class_to_idx = {name: idx for idx, name in enumerate(self.classes)}
+        self.targets = index['label'].tolist()
+
+    def __getstate__(self):
+        # memory maps cannot be pickled, workers reopen them
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def fingerprint(self):
+        '''
+        Returns a digest of the index, the metadata and the size and modification time of every shard, which
+        changes whenever the dataset is packed again.
+        '''
+        digest = hashlib.sha1()
+        for name in (META_FILE, INDEX_FILE):
+            with open(os.path.join(self._dir_path, name), 'rb') as f:
+                digest.update(f.read())
+        for shard_file in self._shard_files:
+            stat = os.stat(os.path.join(self._dir_path, shard_file))
+            digest.update(f'{shard_file}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        return digest.hexdigest()
+
+    def _map(self, shard):
+        if shard not in self._maps:
+            with open(os.path.join(self._dir_path, self._shard_files[shard]), 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def _load(self, idx):
+        '''
+        Returns the decoded image and the label of the record at a given index.
+        '''
+        offset, length = self._offset[idx], self._length[idx]
+        data = self._map(int(self._shard[idx]))[offset:offset + length]
+        image = load_image(io.BytesIO(data), self._decode_size)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[idx]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class PackedImageDataset(_PackedRecords, torch.utils.data.Dataset):
+    '''
+    Random access dataset over a packed dataset. It exposes classes, class_to_idx and targets like ImageFolder.
+    '''
+    def __init__(self, dir_path, transform=None, decode_size=None):
+        '''
+        Initialize PackedImageDataset object.
+
+        Args:
+            dir_path (str): Folder of the packed dataset.
+            transform: Transforms to apply to images.
+            decode_size (int, optional): Size of the shorter side the images will be resized to. If given,
+                JPEGs at least twice as large are decoded at a reduced resolution. Default is None.
+        '''
+        super().__init__(dir_path, transform, decode_size)
+
+    def __getitem__(self, idx):
+        '''
+        Get image and label for a given index.
+        '''
+        return self._load(idx)
+
+
+class PackedImageStream(_PackedRecords, torch.utils.data.IterableDataset):
+    '''
+    Streaming dataset over a packed dataset. Shards are read sequentially in a shuffled order and split
+    between DataLoader workers; samples are mixed through a shuffle buffer.
+    '''
+    def __init__(self, dir_path, transform=None, shuffle=True, buffer_size=1024, seed=0, decode_size=None):
+        '''
+        Initialize PackedImageStream object.
+
+        Args:
+            dir_path (str): Folder of the packed dataset.
+            transform: Transforms to apply to images.
+            shuffle (boolean): Whether to shuffle the shards and the samples. Default is True.
+            buffer_size (int): Number of samples in the shuffle buffer. Default is 1024.
+            seed (int): Seed of the shuffling, combined with the epoch. Default is 0.
+            decode_size (int, optional): Size of the shorter side the images will be resized to. If given,
+                JPEGs at least twice as large are decoded at a reduced resolution. Default is None.
+        '''
+        super().__init__(dir_path, transform, decode_size)
+        self._shuffle = shuffle
+        self._buffer_size = buffer_size
+        self._seed = seed
+        self._epoch = 0
+
+    def set_epoch(self, epoch):
+        '''
+        Sets the epoch, so that every epoch reads the shards in a different order.
+        '''
+        self._epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng((self._seed, self._epoch))
+        shards = np.arange(len(self._shard_files))
+        if self._shuffle:
+            rng.shuffle(shards)
+
+        # split the shards between the workers
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        buffer = []
+        for shard in shards:
+            for idx in np.flatnonzero(self._shard == shard):
+                sample = self._load(idx)
+                if not self._shuffle:
+                    yield sample
+                    continue
+                if len(buffer) < self._buffer_size:
+                    buffer.append(sample)
+                    continue
+                pos = rng.integers(len(buffer))
+                yield buffer[pos]
+                buffer[pos] = sample
+        rng.shuffle(buffer)
+        yield from buffer
@@ -0,0 +1,223 @@
+import time
+import numpy as np
+
+
+class BoxIndex:
+    '''
+    Uniform grid over the bounding boxes of one image. Every box is registered in the grid cells it covers,
+    so window, nearest-box and overlap queries only look at the boxes of a few cells instead of every box.
+    A vectorized scan over every box is faster than the grid for all but very crowded images, see
+    benchmark_index, so images with fewer than scan_below boxes are scanned instead.
+    '''
+    def __init__(self, boxes, cell_size=None, scan_below=10000):
+        '''
+        Initialize BoxIndex object.
+
+        Args:
+            boxes (numpy array): Array of shape (N, 4) holding xmin, ymin, xmax and ymax of every box.
+            cell_size (float, optional): Width and height of a grid cell. Default is None, which uses four times
+                the median box size, so that a box covers few cells.
+            scan_below (int): Number of boxes below which queries scan every box instead of the grid.
+                Default is 10000, about where the grid starts to win.
+        '''
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.scan_below = scan_below
+        if cell_size is None:
+            sizes = np.maximum(self.boxes[:, 2:] - self.boxes[:, :2], 1)
+            cell_size = 4 * float(np.median(sizes)) if len(sizes) else 1.0
+        self.cell_size = float(cell_size)
+        self.origin = self.boxes[:, :2].min(axis=0) if len(self.boxes) else np.zeros(2)
+
+        # cells covered by every box, as sorted (cell key, box) pairs
+        lo, hi = self._cells(self.boxes[:, :2]), self._cells(self.boxes[:, 2:])
+        self.n_cols = int(hi[:, 0].max()) + 1 if len(self.boxes) else 1
+        self.n_rows = int(hi[:, 1].max()) + 1 if len(self.boxes) else 1
+        keys, items = [], []
+        for idx, ((col0, row0), (col1, row1)) in enumerate(zip(lo, hi)):
+            cols, rows = np.meshgrid(np.arange(col0, col1 + 1), np.arange(row0, row1 + 1))
+            keys.append((rows * self.n_cols + cols).ravel())
+            items.append(np.full(keys[-1].shape, idx))
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+        items = np.concatenate(items) if items else np.zeros(0, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        self._items = items[order]
+
+        # the boxes of cell c are items[offsets[c]:offsets[c + 1]], and a row of cells is one contiguous slice
+        self._offsets = np.searchsorted(keys[order], np.arange(self.n_rows * self.n_cols + 1))
+
+    def _cells(self, points):
+        cells = np.floor((np.asarray(points, dtype=np.float64) - self.origin) / self.cell_size)
+        return np.maximum(cells, 0).astype(np.int64)
+
+    def _candidates(self, col0, row0, col1, row1):
+        # boxes registered in the cells of a rectangle of cells
+        col0, row0 = max(col0, 0), max(row0, 0)
+        col1, row1 = min(col1, self.n_cols - 1), min(row1, self.n_rows - 1)
+        if col0 > col1 or row0 > row1:
+            return np.zeros(0, dtype=np.int64)
+        first = np.arange(row0, row1 + 1) * self.n_cols
+        starts, ends = self._offsets[first + col0], self._offsets[first + col1 + 1]
+        lengths = ends - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.unique(self._items[positions])
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def query(self, window):
+        '''
+        Returns the indices of the boxes intersecting a window.
+
+        Args:
+            window (tuple): xmin, ymin, xmax and ymax of the window.
+
+        Returns:
+            A sorted numpy array of box indices.
+        '''
+        scan = len(self.boxes) < self.scan_below
+        if scan:
+            boxes = self.boxes
+        else:
+            (col0, row0), (col1, row1) = self._cells([window[:2], window[2:]])
+            candidates = self._candidates(col0, row0, col1, row1)
+            boxes = self.boxes[candidates]
+        hits = ((boxes[:, 0] < window[2]) & (boxes[:, 2] > window[0]) &
+                (boxes[:, 1] < window[3]) & (boxes[:, 3] > window[1]))
+        return np.flatnonzero(hits) if scan else candidates[hits]
+
+    def nearest(self, point, k=1):
+        '''
+        Returns the indices of the k boxes closest to a point, by the distance of the point to the box border,
+        which is zero for boxes containing the point.
+
+        Args:
+            point (tuple): x and y of the point.
+            k (int): Number of boxes to return. Default is 1.
+
+        Returns:
+            A numpy array of box indices, closest first.
+        '''
+        k = min(k, len(self.boxes))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        if len(self.boxes) < self.scan_below:
+            distances = self._distances(point, slice(None))
+            closest = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(k)
+            return closest[np.argsort(distances[closest], kind='stable')]
+        col, row = self._cells([point])[0]
+        radius = 0
+        while True:
+            candidates = self._candidates(col - radius, row - radius, col + radius, row + radius)
+            distances = self._distances(point, candidates)
+            order = np.argsort(distances, kind='stable')[:k]
+
+            # every box closer than the searched rings of cells has been seen
+            covers_grid = (col - radius <= 0 and row - radius <= 0 and
+                           col + radius >= self.n_cols - 1 and row + radius >= self.n_rows - 1)
+            if len(order) == k and (covers_grid or distances[order[-1]] <= radius * self.cell_size):
+                return candidates[order]
+            radius = radius + 1 if radius < 4 else 2 * radius
+
+    def _distances(self, point, indices):
+        boxes = self.boxes[indices]
+        dx = np.maximum(np.maximum(boxes[:, 0] - point[0], point[0] - boxes[:, 2]), 0)
+        dy = np.maximum(np.maximum(boxes[:, 1] - point[1], point[1] - boxes[:, 3]), 0)
+        return np.hypot(dx, dy)
+
+    def overlaps(self, box, min_iou=0.5):
+        '''
+        Returns the boxes overlapping a box with an IoU of at least min_iou.
+
+        Args:
+            box (tuple): xmin, ymin, xmax and ymax of the box.
+            min_iou (float): Minimum IoU. Default is 0.5.
+
+        Returns:
+            A tuple of a numpy array of box indices and a numpy array of their IoUs.
+        '''
+        candidates = self.query(box)
+        boxes = self.boxes[candidates]
+        width = np.minimum(boxes[:, 2], box[2]) - np.maximum(boxes[:, 0], box[0])
+        height = np.minimum(boxes[:, 3], box[3]) - np.maximum(boxes[:, 1], box[1])
+        inter = np.maximum(width, 0) * np.maximum(height, 0)
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        union = areas + (box[2] - box[0]) * (box[3] - box[1]) - inter
+        ious = inter / np.maximum(union, 1e-12)
+        keep = ious >= min_iou
+        return candidates[keep], ious[keep]
+
+
+def benchmark_index(box_counts=(300, 3000, 30000), n_trials=5, n_queries=200, seed=0):
+    '''
+    Validates the window, nearest-box and overlap queries of BoxIndex, both scanning and through the grid, against
+    a brute force search over every box on random fixtures, with duplicated boxes, boxes spanning many cells and
+    queries outside of the grid, and measures them for images of increasing numbers of boxes.
+
+    Args:
+        box_counts (tuple of int): Maximum numbers of boxes of an image to measure. Default is (300, 3000, 30000).
+        n_trials (int): Number of random images per box count. Default is 5.
+        n_queries (int): Number of queries of every kind per image. Default is 200.
+        seed (int): Seed of the fixtures. Default is 0.
+
+    Returns:
+        A dictionary mapping every box count to the total time in seconds of the brute force search, of the
+        grid alone and of BoxIndex with its default scan_below, and the speed-up of BoxIndex.
+    '''
+    rng = np.random.default_rng(seed)
+    results = {}
+    for n_boxes in box_counts:
+        timings = {'brute_force': 0.0, 'grid': 0.0, 'index': 0.0}
+        for trial in range(n_trials):
+            # bird-sized boxes on a raw image, some duplicated and a few large ones
+            n = int(rng.integers(0, n_boxes + 1))
+            corners = rng.uniform(0, 6000, (n, 2))
+            sizes = np.where(rng.random((n, 1)) < 0.02, rng.uniform(200, 2000, (n, 2)),
+                             rng.uniform(10, 80, (n, 2)))
+            boxes = np.hstack([corners, corners + sizes])
+            boxes[1::11] = boxes[0:-1:11]
+
+            # windows and points partly or fully outside of the boxes, and the boxes themselves for overlaps
+            starts = rng.uniform(-1000, 7000, (n_queries, 2))
+            windows = np.hstack([starts, starts + rng.uniform(1, 1500, (n_queries, 2))])
+            points = rng.uniform(-1000, 7000, (n_queries, 2))
+            ks = rng.integers(1, 6, n_queries)
+            probes = boxes[rng.integers(0, n, n_queries)] + rng.uniform(-10, 10, (n_queries, 4)) if n else windows
+            thresholds = rng.uniform(0.1, 0.9, n_queries)
+            queries = list(zip(windows, points, ks, probes, thresholds))
+
+            tic = time.perf_counter()
+            expected = [_brute_force_queries(boxes, *query) for query in queries]
+            timings['brute_force'] += time.perf_counter() - tic
+            for name, index in [('grid', BoxIndex(boxes, scan_below=0)), ('index', BoxIndex(boxes))]:
+                tic = time.perf_counter()
+                found = [(index.query(window), index.nearest(point, k), index.overlaps(probe, threshold))
+                         for window, point, k, probe, threshold in queries]
+                timings[name] += time.perf_counter() - tic
+
+                for (hits, distances, (overlaps, ious)), (result_hits, nearest, (result_overlaps, result_ious)), \
+                        point in zip(expected, found, points):
+                    # boxes at the same distance may be returned in either order, so the distances are compared
+                    if (not np.array_equal(hits, result_hits) or
+                            not np.array_equal(distances, index._distances(point, nearest)) or
+                            not np.array_equal(overlaps, result_overlaps) or not np.allclose(ious, result_ious)):
+                        raise AssertionError('BoxIndex ({}) differs from the brute force search with {} boxes in '
+                                             'trial {}'.format(name, n_boxes, trial))
+        timings['speedup'] = timings['brute_force'] / max(timings['index'], 1e-12)
+        results[n_boxes] = timings
+    return results
+
+
+def _brute_force_queries(boxes, window, point, k, box, min_iou):
+    # the results of query, nearest and overlaps computed from every box
+    hits = np.flatnonzero((boxes[:, 0] < window[2]) & (boxes[:, 2] > window[0]) &
+                          (boxes[:, 1] < window[3]) & (boxes[:, 3] > window[1]))
+    dx = np.maximum(np.maximum(boxes[:, 0] - point[0], point[0] - boxes[:, 2]), 0)
+    dy = np.maximum(np.maximum(boxes[:, 1] - point[1], point[1] - boxes[:, 3]), 0)
+    distances = np.sort(np.hypot(dx, dy))[:k]
+    width = np.minimum(boxes[:, 2], box[2]) - np.maximum(boxes[:, 0], box[0])
+    height = np.minimum(boxes[:, 3], box[3]) - np.maximum(boxes[:, 1], box[1])
+    inter = np.maximum(width, 0) * np.maximum(height, 0)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    ious = inter / np.maximum(areas + (box[2] - box[0]) * (box[3] - box[1]) - inter, 1e-12)
+    overlaps = np.flatnonzero((ious >= min_iou) & (inter > 0))
+    return hits, distances, (overlaps, ious[overlaps])
@@ -45,10 +45,11 @@ def get_file_names(path, extension):
     """
     file_names = []
 
-    # Get file names of files with the correct extnesion
-    for file in os.listdir(path):
-        if file.endswith(extension):
-            file_names.append(os.path.join(path, file))
+    # Get file names of files with the correct extnesion in one directory scan
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(extension):
+                file_names.append(os.path.join(path, entry.name))
     return sorted(file_names)
 
 
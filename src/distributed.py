@@ -0,0 +1,82 @@
+import argparse
+import contextlib
+import torch
+import torch.distributed as dist
+from .data.coco import utils
+
+
+def setup_distributed(device, backend=None):
+    '''
+    Joins the process group of distributed data parallel training if the process was started by torchrun or
+    launch.py, i.e. the RANK and WORLD_SIZE environment variables are set. Only the first process prints.
+
+    Args:
+        device (str or torch.device): Device to train on if the training is not distributed.
+        backend (str, optional): Backend of the process group, 'gloo' for processes on the CPU or 'nccl' for
+            processes on GPUs. Default is None, which uses NCCL where GPUs exist and gloo otherwise.
+
+    Returns:
+        A tuple of whether the training is distributed and the device of the process, which is the GPU of its
+        local rank with NCCL and the CPU with gloo.
+    '''
+    args = argparse.Namespace(dist_url='env://', dist_backend=backend)
+    utils.init_distributed_mode(args)
+    if not args.distributed:
+        return False, device
+    if args.dist_backend == 'nccl':
+        return True, torch.device('cuda', args.gpu)
+    return True, torch.device('cpu')
+
+
+def cleanup_distributed():
+    '''
+    Leaves the process group of distributed training, if the process joined one.
+    '''
+    if utils.is_dist_avail_and_initialized():
+        dist.destroy_process_group()
+
+
+def wrap_model(model, device):
+    '''
+    Returns a model moved to the device of the process and wrapped in DistributedDataParallel, which averages
+    the gradients of all processes in the backward pass.
+    '''
+    model = model.to(device)
+    device_ids = [device.index] if torch.device(device).type == 'cuda' else None
+    return torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
+
+
+def unwrap_model(model):
+    '''
+    Returns the model wrapped in DistributedDataParallel, or the model itself if it is not wrapped.
+    '''
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.module
+    return model
+
+
+def no_sync(model, sync):
+    '''
+    Returns a context skipping the gradient averaging of a DistributedDataParallel model unless sync is True,
+    for the batches whose gradients are accumulated locally before an optimizer step.
+    '''
+    if sync or not isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def reduce_sum(device, **values):
+    '''
+    Returns the sums of numbers over all processes, e.g. of losses and sample counts, which are the numbers
+    themselves if the training is not distributed.
+
+    Args:
+        device (str or torch.device): Device of the process, on which the numbers are summed.
+        values (float): Numbers to sum by name.
+
+    Returns:
+        A dictionary of the sums by name.
+    '''
+    totals = utils.reduce_dict({name: torch.tensor(float(value), dtype=torch.float64, device=device)
+                                for name, value in values.items()}, average=False)
+    return {name: total.item() for name, total in totals.items()}
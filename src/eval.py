@@ -1,37 +1,94 @@
+import json
+import os
 import torch
+from collections import OrderedDict
 from .data.coco.coco_utils import get_coco_api_from_dataset
-from .data.coco.coco_eval import CocoEvaluator
+from .data.coco.coco_eval import CocoEvaluator, StreamingCocoEvaluator
+from .data.dataloader import ImageFileDataset, od_collate_fn
+from .data.transforms import get_transform
+from .precision import autocast
+from .distributed import reduce_sum
 import pandas as pd
 
 
+def predict_od(model, device, dataset=None, indices=None, paths=None, transform=None, batch_size=8,
+               num_workers=0, output_path=None):
+    '''
+    Returns object detection predictions for given samples of a dataset or given image files. Only these are
+    loaded, in batches of batch_size, and the model runs in inference mode.
+
+    Args:
+        model (Torch object): Object detection model
+        device (str): Device to run inference on ('cpu' or 'cuda')
+        dataset (Dataset, optional): Object detection dataset of (image, target) items. Default is None.
+        indices (list of int, optional): Indices of the dataset samples to predict on. Default is None, which
+            predicts on the whole dataset.
+        paths (list of str, optional): Image files to predict on instead of dataset samples. Default is None.
+        transform (optional): Transforms of the image files. Default is None, which converts them to float tensors.
+        batch_size (int): Number of images per forward pass. Default is 8.
+        num_workers (int): Number of processes loading the images. Default is 0.
+        output_path (str, optional): Path of a JSON lines file to stream the predictions to, one image per line
+            with its boxes, scores and labels, instead of keeping them in memory. Default is None.
+
+    Returns:
+        A dictionary mapping the image ids of the dataset samples, or the image paths, to the predictions on
+        the CPU. The dictionary is empty if the predictions are streamed to output_path.
+    '''
+    # load only the requested samples
+    if paths is not None:
+        dataset = ImageFileDataset(paths, transform or get_transform(False))
+    elif indices is not None:
+        dataset = torch.utils.data.Subset(dataset, list(indices))
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                             num_workers=num_workers, collate_fn=od_collate_fn)
+
+    predictions = {}
+    output = open(output_path + '.tmp', 'w') if output_path else None
+    cpu_device = torch.device("cpu")
+    model.eval()
+    with torch.inference_mode():
+        for images, targets in dataloader:
+            images = list(image.to(device, non_blocking=True) for image in images)
+            outputs = model(images)
+            keys = targets if paths is not None else [target["image_id"].item() for target in targets]
+            for key, out in zip(keys, outputs):
+                out = {k: v.to(cpu_device) for k, v in out.items()}
+                if output is None:
+                    predictions[key] = out
+                else:
+                    output.write(json.dumps({"image_id": key, **{k: v.tolist() for k, v in out.items()}}) + '\n')
+    if output is not None:
+        output.close()
+        os.replace(output_path + '.tmp', output_path)
+    return predictions
+
+
 def get_od_predictions(model, dataloader, device, idx):
     '''
-    Returns object detection predictions for a given index in a dataloader.
+    Returns object detection predictions for a given batch index in a dataloader. Only the images of the batch
+    are loaded; the indices of the earlier batches are drawn from the sampler without loading their images.
 
     Args:
         model (Torch object): Object detection model
         dataloader: DataLoader
         device (str): Device to run training on ('cpu' or 'cuda')
-        idx (int): Index of the image to predict on
+        idx (int): Index of the batch to predict on
 
     Returns:
-        object detection results for a given index in a dataloader
+        object detection results for a given batch index in a dataloader, one per sample of the batch in order,
+        or None if there is no such batch
     '''
-    model.eval()
-    with torch.no_grad():
-        for batch_id, (images, targets) in enumerate(dataloader):
-            if batch_id == idx:
-                # move data to device
-                images = list(image.to(device) for image in images)
-                targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-                # forward pass
-                outputs = model(images)
-                return outputs
+    for batch_id, batch_indices in enumerate(dataloader.batch_sampler):
+        if batch_id == idx:
+            # samples drawn repeatedly in the batch, e.g. rare tiles, are predicted once
+            unique = list(dict.fromkeys(batch_indices))
+            predictions = predict_od(model, device, dataloader.dataset, unique, batch_size=len(unique))
+            by_index = dict(zip(unique, predictions.values()))
+            return [by_index[index] for index in batch_indices]
     return None
 
 
-def get_od_loss(model, loss_fn, dataloader, device):
+def get_od_loss(model, loss_fn, dataloader, device, mixed_precision=False):
     '''
     Returns loss for an object detection model on a given dataset.
 
@@ -40,6 +97,7 @@ def get_od_loss(model, loss_fn, dataloader, device):
         loss_fn (function): Loss function TODO: customize and use loss_fn in the future
         dataloader: DataLoader
         device (str): Device to run training on ('cpu' or 'cuda')
+        mixed_precision (bool): Whether to run the model in mixed precision. Default is False.
 
     Returns:
         Loss for an object detection model on a given dataset.
@@ -52,14 +110,18 @@ def get_od_loss(model, loss_fn, dataloader, device):
             targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
             # forward pass
-            loss_dict = model(images, targets)
-            losses = sum(loss for loss in loss_dict.values())
+            with autocast(device, mixed_precision):
+                loss_dict = model(images, targets)
+                losses = sum(loss for loss in loss_dict.values())
             loss += losses.item()
-    loss = loss / len(dataloader)
+
+    # average over the batches of all processes
+    totals = reduce_sum(device, loss=loss, batches=len(dataloader))
+    loss = totals['loss'] / totals['batches']
     return loss
 
 
-def get_od_stats(model, dataloader, device):
+def get_od_stats(model, dataloader, device, num_workers=0, mixed_precision=False):
     '''
     Returns statistics for an object detection model on a given dataset.
 
@@ -67,6 +129,9 @@ def get_od_stats(model, dataloader, device):
         model (Torch model): Object detection model
         dataloader: DataLoader
         device (stR): Device to use
+        num_workers (int): Number of processes evaluating shards of the images. Default is 0, which matches the
+            predictions of every batch in the current process as they arrive.
+        mixed_precision (bool): Whether to run the model in mixed precision. Default is False.
 
     Returns:
         Statistics for an object detection model on a given dataset.
@@ -77,16 +142,14 @@ def get_od_stats(model, dataloader, device):
 
     cpu_device = torch.device("cpu")
     model.eval()
-    coco = get_coco_api_from_dataset(dataloader.dataset)
-    iou_types = ["bbox"]
-    coco_evaluator = CocoEvaluator(coco, iou_types)
+    coco_evaluator = get_coco_evaluator(dataloader.dataset, num_workers)
 
     with torch.no_grad():
         for batch, (images, targets) in enumerate(dataloader):
             images = list(img.to(device) for img in images)
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
-            outputs = model(images)
+            outputs = get_od_outputs(model, images, device, mixed_precision)
             outputs = [{key: val.to(cpu_device) for key, val in out.items()} for out in outputs]
             res = {target["image_id"].item(): output for target, output in zip(targets, outputs)}
             coco_evaluator.update(res)
@@ -102,15 +165,150 @@ def get_od_stats(model, dataloader, device):
     return stats
 
 
-def get_clf_loss_accuracy(model, loss_fn, dataloader, device):
+def get_coco_evaluator(dataset, num_workers=0, max_dets=(1, 20, 200)):
+    '''
+    Returns an evaluator of bounding boxes against the ground truth of a dataset.
+
+    Args:
+        dataset: Object detection dataset
+        num_workers (int): Number of processes evaluating shards of the images. Default is 0, which matches the
+            predictions of every batch in the current process as they arrive.
+        max_dets (tuple of int): Thresholds on the number of detections per image, the last of which limits the
+            detections evaluated. Default is (1, 20, 200).
+
+    Returns:
+        A CocoEvaluator if num_workers is greater than 1, else a StreamingCocoEvaluator.
+    '''
+    coco = get_coco_api_from_dataset(dataset)
+    iou_types = ["bbox"]
+    if num_workers > 1:
+        return CocoEvaluator(coco, iou_types, num_workers, max_dets)
+    return StreamingCocoEvaluator(coco, iou_types, max_dets)
+
+
+def _get_od_features(model, images, targets, device, mixed_precision):
+    # only the backbone runs in mixed precision: the region proposal network and the box heads get float32
+    # features, so that the boxes are decoded and postprocessed in float32 instead of being rounded to bfloat16
+    images, targets = model.transform(images, targets)
+    with autocast(device, mixed_precision):
+        features = model.backbone(images.tensors)
+    if isinstance(features, torch.Tensor):
+        features = OrderedDict([("0", features)])
+    features = OrderedDict((name, feature.float()) for name, feature in features.items())
+    return images, targets, features
+
+
+def get_od_outputs(model, images, device='cpu', mixed_precision=False):
+    '''
+    Returns the detections of a Faster R-CNN model in evaluation mode for a batch, like model(images), running
+    only the backbone in mixed precision if it is used.
+
+    Args:
+        model (Torch model): Object detection model in evaluation mode
+        images (list of Tensor): Images of the batch
+        device (str): Device the model runs on. Default is 'cpu'.
+        mixed_precision (bool): Whether to run the backbone in mixed precision. Default is False.
+
+    Returns:
+        The list of detections.
+    '''
+    original_image_sizes = [tuple(image.shape[-2:]) for image in images]
+    images, _, features = _get_od_features(model, images, None, device, mixed_precision)
+    proposals, _ = model.rpn(images, features)
+    detections, _ = model.roi_heads(features, proposals, images.image_sizes)
+    return model.transform.postprocess(detections, images.image_sizes, original_image_sizes)
+
+
+def get_od_losses_and_outputs(model, images, targets, device='cpu', mixed_precision=False):
+    '''
+    Returns the losses and the detections of a Faster R-CNN model for a batch from one pass of the backbone.
+    The features are passed to the region proposal network and the box heads twice, once in training mode for
+    the losses and once in evaluation mode for the postprocessed detections.
+
+    Args:
+        model (Torch model): Object detection model in evaluation mode
+        images (list of Tensor): Images of the batch
+        targets (list of dict): Targets of the batch
+        device (str): Device the model runs on. Default is 'cpu'.
+        mixed_precision (bool): Whether to run the backbone in mixed precision. Default is False.
+
+    Returns:
+        A tuple of the dictionary of losses and the list of detections.
+    '''
+    original_image_sizes = [tuple(image.shape[-2:]) for image in images]
+    images, targets, features = _get_od_features(model, images, targets, device, mixed_precision)
+    try:
+        model.rpn.training, model.roi_heads.training = True, True
+        proposals, proposal_losses = model.rpn(images, features, targets)
+        _, detector_losses = model.roi_heads(features, proposals, images.image_sizes, targets)
+    finally:
+        model.rpn.training, model.roi_heads.training = False, False
+    proposals, _ = model.rpn(images, features)
+    detections, _ = model.roi_heads(features, proposals, images.image_sizes)
+    detections = model.transform.postprocess(detections, images.image_sizes, original_image_sizes)
+    return {**detector_losses, **proposal_losses}, detections
+
+
+def get_od_loss_and_stats(model, dataloader, device, num_workers=0, mixed_precision=False):
+    '''
+    Returns the loss and the statistics of an object detection model on a given dataset from one pass over the
+    dataset, with one backbone pass per batch for both. In distributed training every process passes the loader of
+    its shard and gets the loss and statistics of the whole dataset.
+
+    Args:
+        model (Torch model): Object detection model
+        dataloader: DataLoader
+        device (str): Device to use
+        num_workers (int): Number of processes evaluating shards of the images. Default is 0.
+        mixed_precision (bool): Whether to run the model in mixed precision. Default is False.
+
+    Returns:
+        A tuple of the loss and the statistics of the model on the dataset.
+    '''
+    cpu_device = torch.device("cpu")
+    was_training = model.training
+    model.eval()
+    coco_evaluator = get_coco_evaluator(dataloader.dataset, num_workers)
+
+    loss = 0
+    with torch.no_grad():
+        for batch, (images, targets) in enumerate(dataloader):
+            images = list(img.to(device) for img in images)
+            targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+            loss_dict, outputs = get_od_losses_and_outputs(model, images, targets, device, mixed_precision)
+            loss += sum(value for value in loss_dict.values()).item()
+
+            outputs = [{key: val.to(cpu_device) for key, val in out.items()} for out in outputs]
+            res = {target["image_id"].item(): output for target, output in zip(targets, outputs)}
+            coco_evaluator.update(res)
+    model.train(was_training)
+
+    # average over the batches of all processes
+    totals = reduce_sum(device, loss=loss, batches=len(dataloader))
+    loss = totals['loss'] / totals['batches']
+
+    # gather the stats from all processes
+    coco_evaluator.synchronize_between_processes()
+
+    coco_evaluator.accumulate()
+    coco_evaluator.summarize()
+
+    stats = coco_evaluator.coco_eval['bbox'].stats
+
+    return loss, stats
+
+
+def get_clf_loss_accuracy(model, loss_fn, dataloader, device, mixed_precision=False):
     '''
-    Returns loss and accuracy for a classifier model on a given dataset.
+    Returns loss and accuracy for a classifier model on a given dataset. In distributed training every process
+    passes the loader of its shard and gets the loss and accuracy of the whole dataset.
 
     Args:
         model (Torch model): Classifier model
         loss_fn (function): Loss function
         dataloader: DataLoader
         device (sr): Device to run training on ('cpu' or 'cuda')
+        mixed_precision (bool): Whether to run the model in mixed precision. Default is False.
 
     Returns:
         Loss and accuracy for a classifier model on a given dataset.
@@ -127,8 +325,9 @@ def get_clf_loss_accuracy(model, loss_fn, dataloader, device):
         for batch_id, (inputs, labels) in enumerate(dataloader):
             inputs, labels = inputs.to(device), labels.to(device)
             # Loss
-            predicted = model(inputs)
-            loss = loss_fn(predicted, labels)
+            with autocast(device, mixed_precision):
+                predicted = model(inputs)
+                loss = loss_fn(predicted, labels)
             cumulative_loss += loss.item()
 
             # Accuracy
@@ -137,8 +336,10 @@ def get_clf_loss_accuracy(model, loss_fn, dataloader, device):
             correct += (max_ids == labels).sum().cpu().item()
             n_samples += inputs.size(0)
 
-    loss = cumulative_loss / len(dataloader)
-    accuracy = correct / n_samples
+    # Sum over the shards of all processes
+    totals = reduce_sum(device, loss=cumulative_loss, batches=len(dataloader), correct=correct, samples=n_samples)
+    loss = totals['loss'] / totals['batches']
+    accuracy = totals['correct'] / totals['samples']
     return loss, accuracy
 
 
@@ -0,0 +1,169 @@
+import atexit
+import copy
+import multiprocessing
+import os
+import queue
+import time
+import torch
+from .data.dataloader import get_subset_loader
+from .checkpoint import save_checkpoint, load_checkpoint
+
+
+class EvalScheduler:
+    '''
+    Decides after which epochs a model is evaluated: every N epochs, every M minutes, and always after the last
+    epoch. Evaluation can be restricted to a fixed random subset of the validation set.
+    '''
+    def __init__(self, every_epochs=1, every_minutes=None, subset=None):
+        '''
+        Initialize EvalScheduler object.
+
+        Args:
+            every_epochs (int, optional): Number of epochs between evaluations. Default is 1. None only evaluates
+                on time and after the last epoch.
+            every_minutes (float, optional): Minutes of training after which the model is evaluated at the end
+                of the epoch. Default is None.
+            subset (int or float, optional): Number of validation samples, or fraction of the validation set if
+                below 1, to evaluate on. Default is None, which evaluates on the whole validation set.
+        '''
+        self.every_epochs = every_epochs
+        self.every_minutes = every_minutes
+        self.subset = subset
+        self._last = time.monotonic()
+
+    def is_due(self, epoch, n_epochs):
+        '''
+        Returns whether the model is evaluated after an epoch, and restarts the timer if so.
+        '''
+        due = epoch == n_epochs - 1
+        if self.every_epochs and (epoch + 1) % self.every_epochs == 0:
+            due = True
+        if self.every_minutes is not None and time.monotonic() - self._last >= 60 * self.every_minutes:
+            due = True
+        if due:
+            self._last = time.monotonic()
+        return due
+
+    def loader(self, dataloader):
+        '''
+        Returns the data loader to evaluate on, which is a fixed subset of the given one if a subset is set.
+        '''
+        if not self.subset:
+            return dataloader
+        fraction = self.subset if self.subset < 1 else self.subset / len(dataloader.dataset)
+        return get_subset_loader(dataloader, min(fraction, 1))
+
+
+def preserve_rng(device):
+    '''
+    Returns a context which restores the random states of the CPU and of the GPU of a device when it exits. The
+    data loaders of an evaluation draw their seeds from the global random state, so evaluating inside the context
+    leaves the batches and augmentations of the following epochs the same whenever and wherever it runs.
+    '''
+    device = torch.device(device)
+    return torch.random.fork_rng(devices=[device] if device.type == 'cuda' else [])
+
+
+def _evaluator_loop(function, model, args, kwargs, device, tasks, results):
+    # evaluate the checkpoints of the queue until None is received
+    model = model.to(device)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        epoch, path = task
+        try:
+            model.load_state_dict(load_checkpoint(path)['model'])
+            results.put((epoch, path, function(model, *args, device=device, **kwargs), None))
+        except Exception as error:
+            results.put((epoch, path, None, repr(error)))
+
+
+class AsyncEvaluator:
+    '''
+    Evaluates checkpoints in a separate process while the next epochs train. Every submitted training state is
+    saved to a candidate checkpoint, whose model state_dict the evaluator process loads into its copy of the model
+    and evaluates with function(model, *args, device=device, **kwargs).
+    '''
+    def __init__(self, function, model, args, device, checkpoint_prefix, kwargs=None, writer=None):
+        '''
+        Initialize AsyncEvaluator object and start the evaluator process.
+
+        Args:
+            function (function): Module level function evaluating a model.
+            model (torch.nn.Module): Model whose checkpoints are evaluated, which is copied to the process once.
+            args (tuple): Arguments of the function, such as data loaders, which are sent to the process once.
+            device (str): Device of the evaluator process.
+            checkpoint_prefix (str): Path prefix of the candidate checkpoints.
+            kwargs (dict, optional): Keyword arguments of the function. Default is None.
+            writer (CheckpointWriter, optional): Writer saving the candidate checkpoints in the background.
+                Default is None, which saves them before submit returns.
+        '''
+        # not a daemon, so that the evaluation can use a pool of processes; stopped at exit if not closed
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._process = context.Process(target=_evaluator_loop,
+                                        args=(function, copy.deepcopy(model).cpu(), args, kwargs or {},
+                                              str(device), self._tasks, self._results))
+        self._process.start()
+        atexit.register(self.close)
+        self.checkpoint_prefix = checkpoint_prefix
+        self.writer = writer
+        self.pending = 0
+
+    def submit(self, epoch, state):
+        '''
+        Saves a training state to the candidate checkpoint of an epoch and queues it for evaluation once written.
+        '''
+        path = f'{self.checkpoint_prefix}_epoch_{epoch}.pt'
+        self.pending += 1
+        if self.writer is not None:
+            self.writer.save(state, path, done=lambda: self._tasks.put((epoch, path)))
+        else:
+            save_checkpoint(state, path)
+            self._tasks.put((epoch, path))
+
+    def collect(self, wait=False):
+        '''
+        Returns the results which have arrived, or waits for all pending results.
+
+        Args:
+            wait (bool): Whether to wait until every submitted checkpoint is evaluated. Default is False.
+
+        Returns:
+            A list of (epoch, checkpoint path, result) tuples in the order the evaluations finished.
+        '''
+        arrived = []
+        while self.pending:
+            try:
+                epoch, path, result, error = self._results.get(block=wait, timeout=5 if wait else None)
+            except queue.Empty:
+                if wait and self._process is not None and self._process.is_alive():
+                    continue
+                if wait:
+                    raise RuntimeError('Evaluator process exited with checkpoints pending')
+                break
+            self.pending -= 1
+            if error is not None:
+                raise RuntimeError(f'Evaluation of the checkpoint of epoch {epoch} failed: {error}')
+            arrived.append((epoch, path, result))
+        return arrived
+
+    def close(self):
+        '''
+        Stops the evaluator process and removes the candidate checkpoints which were not collected.
+        '''
+        if self._process is None:
+            return
+        atexit.unregister(self.close)
+        self._tasks.put(None)
+        self._process.join()
+        while True:
+            try:
+                _, path, _, _ = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if os.path.exists(path):
+                os.remove(path)
+        self._process = None
@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 from sklearn.utils.class_weight import compute_class_weight
 import torch.nn as nn
 import torch
@@ -25,6 +26,31 @@ def compute_class_weights_from_dataset(dataset):
     return class_weights
 
 
+def compute_class_weights_from_index(index_path, split=None):
+    '''
+    Computes class weights directly from a split index file of cropped images, without listing
+    or opening any image. Classes are ordered alphabetically, as in IndexedImageDataset.
+
+    Args:
+        index_path (str): Path of the csv index file with columns path, class_name and split
+        split (str, optional): Only count the images of this split. Default is None, which counts every image
+
+    Returns:
+        A list of class weights computed using the `compute_class_weight` function
+    '''
+    index = pd.read_csv(index_path, usecols=['class_name', 'split'])
+    classes = sorted(index['class_name'].unique())
+    if split is not None:
+        index = index[index['split'] == split]
+    targets = pd.Categorical(index['class_name'], categories=classes).codes
+
+    # Compute class weights for each class in the index
+    class_weights = compute_class_weight(class_weight='balanced',
+                                         classes=np.unique(targets),
+                                         y=targets)
+    return class_weights
+
+
 def get_weighted_cross_entropy_loss_fn(class_weights, device):
     ''''
     Returns a weighted cross entropy loss function with the given class weights.
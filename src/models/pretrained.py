@@ -1,10 +1,12 @@
 import torchvision
-from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
+from torchvision.models.detection.faster_rcnn import FasterRCNN, FastRCNNPredictor
+from torchvision.models.detection.backbone_utils import resnet_fpn_backbone
+from torchvision.ops import misc as misc_nn_ops
 from torchvision.models import resnet50, ResNet50_Weights
 import torch
 
 
-def get_pretrained_od_model(num_classes, choice='fasterrcnn_resnet50_fpn'):
+def get_pretrained_od_model(num_classes, choice='fasterrcnn_resnet50_fpn', pretrained=True):
     '''
     Return a pretrained object detection model from torchvision
     Use FastRCNPredictor as box predictor with num_classes output channels
@@ -12,14 +14,22 @@ def get_pretrained_od_model(num_classes, choice='fasterrcnn_resnet50_fpn'):
     Args:
         num_classes (int): number of classes in the dataset
         choice (str, optional): name of the pretrained model to use (default: 'fasterrcnn_resnet50_fpn')
+        pretrained (bool, optional): whether to download the pretrained weights. False builds the same model
+            untrained, to load the state_dict of a trained checkpoint into (default: True)
 
     Returns:
         pretrained object detection model
     '''
     # Choose pretrained object detection model
     if choice == 'fasterrcnn_resnet50_fpn':
-        model = torchvision.models.detection.fasterrcnn_resnet50_fpn(weights='DEFAULT',
-                                                                     weights_backbone='DEFAULT')
+        if pretrained:
+            model = torchvision.models.detection.fasterrcnn_resnet50_fpn(weights='DEFAULT',
+                                                                         weights_backbone='DEFAULT')
+        else:
+            # frozen batch normalization like the pretrained model, so that the state_dicts match
+            backbone = resnet_fpn_backbone(backbone_name='resnet50', weights=None,
+                                           norm_layer=misc_nn_ops.FrozenBatchNorm2d, trainable_layers=3)
+            model = FasterRCNN(backbone, num_classes=91)
 
     in_features = model.roi_heads.box_predictor.cls_score.in_features
     model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
@@ -0,0 +1,19 @@
+import torch
+
+
+def get_warmup_scheduler(optimizer, warmup_steps, start_factor=0.001):
+    """
+    Returns a learning rate scheduler increasing the learning rate linearly over the first optimizer steps.
+    The scheduler is stepped once per optimizer step, so warmup counts optimizer steps rather than batches.
+
+    Args:
+        optimizer (Torch object): The optimizer whose learning rate is warmed up.
+        warmup_steps (int): Number of optimizer steps until the full learning rate is reached.
+        start_factor (float): Fraction of the learning rate used for the first step. Default is 0.001.
+
+    Returns:
+        The created LinearLR scheduler, or None if warmup_steps is 0.
+    """
+    if not warmup_steps:
+        return None
+    return torch.optim.lr_scheduler.LinearLR(optimizer, start_factor=start_factor, total_iters=warmup_steps)
@@ -0,0 +1,87 @@
+import contextlib
+import math
+import torch
+
+# whether the peak resident memory of the process was reset, which only Linux allows
+_cpu_peak_reset = False
+
+
+def autocast(device, enabled=True):
+    '''
+    Returns a mixed precision context for a device, computing in bfloat16 on the CPU and in float16 on a GPU.
+
+    Args:
+        device (str): Device the model runs on ('cpu' or 'cuda')
+        enabled (bool): Whether to use mixed precision. Default is True; if False the context does nothing.
+
+    Returns:
+        A torch.autocast context, or a context doing nothing.
+    '''
+    if not enabled:
+        return contextlib.nullcontext()
+    device_type = torch.device(device).type
+    return torch.autocast(device_type, dtype=torch.bfloat16 if device_type == 'cpu' else torch.float16)
+
+
+def get_grad_scaler(device, enabled=True):
+    '''
+    Returns a gradient scaler for mixed precision training. Gradients are only scaled in float16, i.e. on a GPU;
+    otherwise the scaler passes the loss and the optimizer step through unchanged.
+
+    Args:
+        device (str): Device the model runs on ('cpu' or 'cuda')
+        enabled (bool): Whether mixed precision is used. Default is True.
+
+    Returns:
+        A GradScaler.
+    '''
+    enabled = enabled and torch.device(device).type == 'cuda'
+    # torch.amp.GradScaler replaces torch.cuda.amp.GradScaler from torch 2.3, which the pinned torch 2.0 predates
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def reset_peak_memory(device):
+    '''
+    Resets the peak memory of a GPU, or the peak resident memory of the process on the CPU where the system allows
+    it, i.e. on Linux.
+    '''
+    global _cpu_peak_reset
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        _cpu_peak_reset = True
+    except OSError:
+        _cpu_peak_reset = False
+
+
+def peak_memory_mb(device):
+    '''
+    Returns the peak memory in MB since the last reset: the memory allocated by tensors on a GPU, or the peak
+    resident memory of the process on the CPU. It is NaN on the CPU where the peak could not be reset, as the
+    lifetime peak would not change between resets.
+    '''
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    if not _cpu_peak_reset:
+        return math.nan
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return math.nan
+
+
+def synchronize(device):
+    '''
+    Waits for the work queued on a GPU, so that it is included in timings.
+    '''
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
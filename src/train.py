@@ -1,7 +1,16 @@
 import torch
 import os
+import time
 import numpy as np
-from .eval import get_od_loss, get_od_stats, get_clf_loss_accuracy
+from .eval import get_od_loss_and_stats, get_od_stats, get_clf_loss_accuracy
+from .eval_schedule import EvalScheduler, AsyncEvaluator, preserve_rng
+from .data.dataloader import get_subset_loader, get_distributed_loader
+from .data.transforms import get_transform
+from .data.coco.utils import is_dist_avail_and_initialized, is_main_process, broadcast
+from .precision import autocast, get_grad_scaler, reset_peak_memory, peak_memory_mb, synchronize
+from .optimizers.warmup import get_warmup_scheduler
+from .checkpoint import CheckpointWriter, training_state, restore_training_state, load_checkpoint
+from .distributed import unwrap_model, no_sync, reduce_sum
 import sys
 from livelossplot import PlotLosses
 
@@ -25,12 +34,59 @@ class HiddenPrints:
         sys.stdout = self._original_stdout
 
 
+def is_step_batch(batch_id, n_batches, accumulation_steps):
+    '''
+    Returns whether the optimizer steps after a batch, and the number of batches accumulated into that step.
+    The last step of an epoch accumulates the remaining batches.
+
+    Input:
+        batch_id (int): The index of the batch in the epoch.
+        n_batches (int): The number of batches in the epoch.
+        accumulation_steps (int): The number of batches accumulated into every optimizer step.
+
+    Output:
+        A tuple of whether the optimizer steps after the batch and the number of batches of the step.
+    '''
+    start = batch_id - batch_id % accumulation_steps
+    size = min(accumulation_steps, n_batches - start)
+    return batch_id == start + size - 1, size
+
+
+def evaluate_detector(model, valloader, statsloader, eval_workers, device, mixed_precision=False):
+    '''
+    Evaluates a detector model on the validation set and, if given, a subset of the training set.
+
+    Input:
+        model (torch object): The detector model.
+        valloader (dataloader): The data loader for the validation set.
+        statsloader (dataloader): The data loader for the training subset, or None.
+        eval_workers (int): The number of processes evaluating the statistics.
+        device (str): The device to use for inference.
+        mixed_precision (bool): Whether to run the model in mixed precision. Defaults to False.
+
+    Output:
+        A tuple of the validation loss, the validation statistics and the training statistics, which are NaN
+        without a training subset.
+    '''
+    with HiddenPrints():
+        val_loss, val_stats = get_od_loss_and_stats(model, valloader, device, eval_workers, mixed_precision)
+    if statsloader is None:
+        return val_loss, val_stats, np.full(len(val_stats), np.nan)
+    with HiddenPrints():
+        train_stats = get_od_stats(model, statsloader, device, eval_workers, mixed_precision)
+    return val_loss, val_stats, train_stats
+
+
 def train_detector(model, optimizer, loss_fn, n_epochs,
                    trainloader, valloader,
                    device,
-                   save_path, name):
+                   save_path, name, eval_workers=0, train_stats_fraction=None, schedule=None,
+                   async_eval=False, mixed_precision=False, accumulation_steps=1, warmup_steps=0,
+                   checkpoint_every=1, resume=False):
     '''
     Trains a detector model for object detection using the specified optimizer, loss function, and training/validation data loaders.
+    In distributed training the model is wrapped in DistributedDataParallel, every process trains on and evaluates a shard of
+    the data loaders, the losses and statistics are reduced over all processes and only the first process writes checkpoints.
 
     Input:
         model (torch object): The detector model to train.
@@ -42,80 +98,206 @@ def train_detector(model, optimizer, loss_fn, n_epochs,
         device (str): The device to use for training and inference.
         save_path (str): The path to save the best model.
         name (str): The name of the model.
+        eval_workers (int): The number of processes evaluating the statistics. Defaults to 0.
+        train_stats_fraction (float, optional): The fraction of the training set on which training statistics
+            are computed every epoch. Defaults to None, which skips them and records NaN.
+        schedule (EvalScheduler, optional): The scheduler deciding after which epochs the model is evaluated.
+            Defaults to None, which evaluates after every epoch.
+        async_eval (bool): Whether to evaluate checkpoints in a separate process while training continues, which is
+            not supported in distributed training. Defaults to False.
+        mixed_precision (bool): Whether to train and evaluate in mixed precision, bfloat16 on the CPU and float16
+            with gradient scaling on a GPU. Defaults to False.
+        accumulation_steps (int): The number of batches whose gradients are accumulated into every optimizer
+            step, so the effective batch size is accumulation_steps times the loader batch size. Defaults to 1.
+        warmup_steps (int): The number of optimizer steps over which the learning rate is increased linearly
+            to its full value. Defaults to 0.
+        checkpoint_every (int): The number of epochs between checkpoints of the training state, which is always
+            saved after the last epoch. Defaults to 1.
+        resume (bool): Whether to resume from the latest checkpoint of the training state, if there is one.
+            Defaults to False.
 
     Output:
-        A tuple of four numpy arrays containing the training loss, validation loss, training statistics, and validation statistics.
+        A tuple of four numpy arrays containing the training loss, validation loss, training statistics, and validation statistics,
+        and a dictionary of the training throughput in images per second, the peak memory in MB and the samples per
+        optimizer step of every epoch.
+        The validation loss and statistics are NaN for epochs without evaluation.
+        The best model is checkpointed to save_path + name + '.pt' and the latest training state to
+        save_path + name + '_last.pt'.
     '''
     # create save path
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
+    os.makedirs(save_path, exist_ok=True)
+    distributed = is_dist_avail_and_initialized()
+    if distributed and async_eval:
+        raise ValueError('Asynchronous evaluation is not supported in distributed training')
 
     # initialize variables
     train_loss_list = []
-    val_loss_list = []
-    train_stats_list = []
-    val_stats_list = []
+    val_loss_list = [np.nan] * n_epochs
+    train_stats_list = [None] * n_epochs
+    val_stats_list = [None] * n_epochs
     best_val_loss = float('inf')
     model = model.to(device)
+    module = unwrap_model(model)
 
     # plot live loss
     liveloss = PlotLosses()
 
-    for epoch in range(n_epochs):
+    # training statistics are computed on a fixed subset of the training set, without augmentation so that the
+    # images match their annotations
+    statsloader = None
+    if train_stats_fraction:
+        statsloader = get_subset_loader(trainloader, train_stats_fraction, transform=get_transform(train=False))
+    schedule = schedule or EvalScheduler()
+    valloader = schedule.loader(valloader)
+    if distributed:
+        trainloader = get_distributed_loader(trainloader)
+        valloader = get_distributed_loader(valloader, train=False)
+        statsloader = get_distributed_loader(statsloader, train=False) if statsloader is not None else None
+    writer = CheckpointWriter()
+    best_path, last_path = save_path + name + '.pt', save_path + name + '_last.pt'
+    evaluator = AsyncEvaluator(evaluate_detector, module, (valloader, statsloader, eval_workers), device,
+                               save_path + name, {'mixed_precision': mixed_precision}, writer) if async_eval else None
+    scaler = get_grad_scaler(device, mixed_precision)
+    warmup = get_warmup_scheduler(optimizer, warmup_steps)
+    performance = {'images_per_s': [], 'peak_memory_mb': [], 'samples_per_step': []}
+
+    def state(epoch):
+        # training state after an epoch with the metrics recorded so far
+        return training_state(epoch, module, optimizer, scaler, warmup, {
+            'train_loss_list': train_loss_list, 'val_loss_list': val_loss_list,
+            'train_stats_list': train_stats_list, 'val_stats_list': val_stats_list,
+            'performance': performance, 'best_val_loss': best_val_loss})
+
+    # resume after the epoch of the latest training state, with the random state it left
+    start_epoch = 0
+    if resume and os.path.exists(last_path):
+        last_epoch, metrics = restore_training_state(load_checkpoint(last_path), module, optimizer, scaler, warmup)
+        start_epoch = last_epoch + 1
+        train_loss_list, performance = metrics['train_loss_list'], metrics['performance']
+        val_loss_list[:start_epoch] = metrics['val_loss_list'][:start_epoch]
+        train_stats_list[:start_epoch] = metrics['train_stats_list'][:start_epoch]
+        val_stats_list[:start_epoch] = metrics['val_stats_list'][:start_epoch]
+        best_val_loss = metrics['best_val_loss']
+        print(f'Resuming {name} after epoch {last_epoch + 1}')
+
+    for epoch in range(start_epoch, n_epochs):
         logs = {}
         model.train()
         train_loss = 0
+        for source in (trainloader.dataset, trainloader.sampler, trainloader.batch_sampler):
+            if hasattr(source, 'set_epoch'):
+                source.set_epoch(epoch)
+        reset_peak_memory(device)
+        n_images = 0
+        n_steps = 0
+        tic = time.perf_counter()
+        optimizer.zero_grad()
         for batch_id, (images, targets) in enumerate(trainloader):
             # move data to device
             images = list(image.to(device) for image in images)
             targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
-            # forward pass
-            loss_dict = model(images, targets)
-            losses = sum(loss for loss in loss_dict.values())
+            # forward and backward pass, accumulating the gradients of the batches of an optimizer step, which
+            # are only averaged over the processes in the last batch of the step
+            step, n_accumulated = is_step_batch(batch_id, len(trainloader), accumulation_steps)
+            with no_sync(model, step):
+                with autocast(device, mixed_precision):
+                    loss_dict = model(images, targets)
+                    losses = sum(loss for loss in loss_dict.values())
+                scaler.scale(losses / n_accumulated).backward()
             train_loss += losses.item()
-
-            # backward pass
-            optimizer.zero_grad()
-            losses.backward()
-            optimizer.step()
-
-        # evaluate model
-        train_loss /= len(trainloader)
-        logs['loss'] = train_loss
-        val_loss = get_od_loss(model, loss_fn, valloader, device)
-        logs['val_loss'] = val_loss
-
-        with HiddenPrints():
-            train_stats = get_od_stats(model, trainloader, device)
-
-        with HiddenPrints():
-            val_stats = get_od_stats(model, valloader, device)
-
-        # record evaluation metrics
+            n_images += len(images)
+            if step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+                if warmup is not None:
+                    warmup.step()
+                n_steps += 1
+        synchronize(device)
+
+        # average over the batches of all processes
+        totals = reduce_sum(device, loss=train_loss, batches=len(trainloader), images=n_images)
+        train_loss = totals['loss'] / totals['batches']
+        n_images = totals['images']
         train_loss_list.append(train_loss)
-        val_loss_list.append(val_loss)
-        train_stats_list.append(train_stats)
-        val_stats_list.append(val_stats)
-
-        # save best model
-        if val_loss < best_val_loss:
-            best_val_loss = val_loss
-            torch.save(model, save_path + name + '.pt')
-
-        liveloss.update(logs)
+        performance['images_per_s'].append(n_images / (time.perf_counter() - tic))
+        performance['peak_memory_mb'].append(peak_memory_mb(device))
+        performance['samples_per_step'].append(n_images / max(n_steps, 1))
+        logs['loss'] = train_loss
+        logs['images_per_s'] = performance['images_per_s'][-1]
+        logs['peak_memory_mb'] = performance['peak_memory_mb'][-1]
+        logs['samples_per_step'] = performance['samples_per_step'][-1]
+        liveloss.update(logs, current_step=epoch)
+
+        # evaluate model when scheduled, in the evaluator process if asynchronous; every process follows the schedule
+        # of the first one
+        arrived = []
+        if broadcast(schedule.is_due(epoch, n_epochs)):
+            if evaluator is not None:
+                evaluator.submit(epoch, state(epoch))
+            else:
+                # evaluation leaves the random state of the training unchanged
+                with preserve_rng(device):
+                    arrived.append((epoch, None, evaluate_detector(module, valloader, statsloader, eval_workers,
+                                                                   device, mixed_precision)))
+        if evaluator is not None:
+            if epoch == n_epochs - 1:
+                # candidates are only queued for evaluation once written
+                writer.wait()
+            arrived.extend(evaluator.collect(wait=epoch == n_epochs - 1))
+
+        improved = False
+
+        for eval_epoch, checkpoint, (val_loss, val_stats, train_stats) in arrived:
+            # record evaluation metrics
+            val_loss_list[eval_epoch] = val_loss
+            train_stats_list[eval_epoch] = train_stats
+            val_stats_list[eval_epoch] = val_stats
+            liveloss.update({'val_loss': val_loss}, current_step=eval_epoch)
+
+            # save best model
+            if val_loss < best_val_loss:
+                best_val_loss = val_loss
+                if checkpoint is None:
+                    improved = True
+                else:
+                    os.replace(checkpoint, best_path)
+            elif checkpoint is not None:
+                os.remove(checkpoint)
         liveloss.send()
 
-    return train_loss_list, val_loss_list, np.array(train_stats_list), np.array(val_stats_list)
+        # checkpoint the best model and the training state in the background, written by the first process only
+        paths = [best_path] if improved else []
+        if (epoch + 1) % checkpoint_every == 0 or epoch == n_epochs - 1:
+            paths.append(last_path)
+        if paths:
+            latest = state(epoch)
+            if is_main_process():
+                writer.save(latest, *paths)
+
+    if evaluator is not None:
+        evaluator.close()
+    writer.close()
+    if distributed:
+        # the checkpoints are written before any process reads them
+        torch.distributed.barrier()
+    n_stats = next(len(stats) for stats in val_stats_list if stats is not None)
+    train_stats_list = [np.full(n_stats, np.nan) if stats is None else stats for stats in train_stats_list]
+    val_stats_list = [np.full(n_stats, np.nan) if stats is None else stats for stats in val_stats_list]
+    return train_loss_list, val_loss_list, np.array(train_stats_list), np.array(val_stats_list), performance
 
 
 def train_classifier(model, optimizer, loss_fn, n_epochs,
                      trainloader, valloader,
                      device,
                      save_path, name,
-                     print_every=5):
+                     print_every=5, schedule=None, async_eval=False, mixed_precision=False, accumulation_steps=1,
+                     warmup_steps=0, checkpoint_every=1, resume=False):
     '''
     Trains a PyTorch classifier model and saves the best model based on validation accuracy.
+    In distributed training the model is wrapped in DistributedDataParallel, every process trains on and evaluates a shard of
+    the data loaders, the losses and accuracies are reduced over all processes and only the first process writes checkpoints.
 
     Input:
         model (Torch object): The classifier model to train.
@@ -128,41 +310,106 @@ def train_classifier(model, optimizer, loss_fn, n_epochs,
         save_path (str): The path to save the best model.
         name (str): The name of the model to save.
         print_every (int): Print evaluation metrics every `print_every` epochs. Defaults to 5.
+        schedule (EvalScheduler, optional): The scheduler deciding after which epochs the model is evaluated.
+            Defaults to None, which evaluates after every epoch.
+        async_eval (bool): Whether to evaluate checkpoints in a separate process while training continues, which is
+            not supported in distributed training. Defaults to False.
+        mixed_precision (bool): Whether to train and evaluate in mixed precision, bfloat16 on the CPU and float16
+            with gradient scaling on a GPU. Defaults to False.
+        accumulation_steps (int): The number of batches whose gradients are accumulated into every optimizer
+            step, so the effective batch size is accumulation_steps times the loader batch size. Defaults to 1.
+        warmup_steps (int): The number of optimizer steps over which the learning rate is increased linearly
+            to its full value. Defaults to 0.
+        checkpoint_every (int): The number of epochs between checkpoints of the training state, which is always
+            saved after the last epoch. Defaults to 1.
+        resume (bool): Whether to resume from the latest checkpoint of the training state, if there is one.
+            Defaults to False.
 
     Output:
-        Tuple of four lists representing the training loss, validation loss, training accuracy, and validation accuracy.
+        Tuple of four lists representing the training loss, validation loss, training accuracy, and validation accuracy,
+        and a dictionary of the training throughput in images per second, the peak memory in MB and the samples per
+        optimizer step of every epoch.
+        The validation loss and accuracy are NaN for epochs without evaluation.
+        The best model is checkpointed to save_path + name + '.pt' and the latest training state to
+        save_path + name + '_last.pt'.
     '''
     # create save path
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
+    os.makedirs(save_path, exist_ok=True)
+    distributed = is_dist_avail_and_initialized()
+    if distributed and async_eval:
+        raise ValueError('Asynchronous evaluation is not supported in distributed training')
 
     # initialize variables
     train_loss_list = []
-    val_loss_list = []
+    val_loss_list = [np.nan] * n_epochs
     train_accuracy_list = []
-    val_accuracy_list = []
+    val_accuracy_list = [np.nan] * n_epochs
 
     best_val_accuracy = 0
 
     # Move the model and loss function to device
     model = model.to(device)
+    module = unwrap_model(model)
     loss_fn = loss_fn.to(device)
     liveloss = PlotLosses()
-
-    for epoch in range(n_epochs):
+    schedule = schedule or EvalScheduler()
+    valloader = schedule.loader(valloader)
+    if distributed:
+        trainloader = get_distributed_loader(trainloader)
+        valloader = get_distributed_loader(valloader, train=False)
+    writer = CheckpointWriter()
+    best_path, last_path = save_path + name + '.pt', save_path + name + '_last.pt'
+    evaluator = AsyncEvaluator(get_clf_loss_accuracy, module, (loss_fn, valloader), device, save_path + name,
+                               {'mixed_precision': mixed_precision}, writer) if async_eval else None
+    scaler = get_grad_scaler(device, mixed_precision)
+    warmup = get_warmup_scheduler(optimizer, warmup_steps)
+    performance = {'images_per_s': [], 'peak_memory_mb': [], 'samples_per_step': []}
+
+    def state(epoch):
+        # training state after an epoch with the metrics recorded so far
+        return training_state(epoch, module, optimizer, scaler, warmup, {
+            'train_loss_list': train_loss_list, 'val_loss_list': val_loss_list,
+            'train_accuracy_list': train_accuracy_list, 'val_accuracy_list': val_accuracy_list,
+            'performance': performance, 'best_val_accuracy': best_val_accuracy})
+
+    # Resume after the epoch of the latest training state, with the random state it left
+    start_epoch = 0
+    if resume and os.path.exists(last_path):
+        last_epoch, metrics = restore_training_state(load_checkpoint(last_path), module, optimizer, scaler, warmup)
+        start_epoch = last_epoch + 1
+        train_loss_list, train_accuracy_list = metrics['train_loss_list'], metrics['train_accuracy_list']
+        val_loss_list[:start_epoch] = metrics['val_loss_list'][:start_epoch]
+        val_accuracy_list[:start_epoch] = metrics['val_accuracy_list'][:start_epoch]
+        performance, best_val_accuracy = metrics['performance'], metrics['best_val_accuracy']
+        print(f'Resuming {name} after epoch {last_epoch + 1}')
+
+    for epoch in range(start_epoch, n_epochs):
         logs = {}
         correct = 0
         train_loss = 0
         n_samples = 0
+        n_steps = 0
 
         # Train
         model.train()
+        for source in (trainloader.dataset, trainloader.sampler, trainloader.batch_sampler):
+            if hasattr(source, 'set_epoch'):
+                source.set_epoch(epoch)
+        reset_peak_memory(device)
+        tic = time.perf_counter()
+        model.zero_grad()
         for batch_id, (inputs, labels) in enumerate(trainloader):
-            model.zero_grad()
             inputs, labels = inputs.to(device), labels.to(device)
-            # Loss
-            predicted = model(inputs)
-            loss = loss_fn(predicted, labels)
+            step, n_accumulated = is_step_batch(batch_id, len(trainloader), accumulation_steps)
+            with no_sync(model, step):
+                # Loss
+                with autocast(device, mixed_precision):
+                    predicted = model(inputs)
+                    loss = loss_fn(predicted, labels)
+
+                # Backpropagation, accumulating the gradients of the batches of an optimizer step, which are only
+                # averaged over the processes in the last batch of the step
+                scaler.scale(loss / n_accumulated).backward()
             train_loss += loss.item()
 
             # Accuracy
@@ -171,30 +418,81 @@ def train_classifier(model, optimizer, loss_fn, n_epochs,
             correct += (max_ids == labels).sum().cpu().item()
             n_samples += inputs.size(0)
 
-            # Backpropagation
-            loss.backward()
-            optimizer.step()
-
-        train_loss /= len(trainloader)
-        train_accuracy = correct / n_samples
+            if step:
+                scaler.step(optimizer)
+                scaler.update()
+                model.zero_grad()
+                if warmup is not None:
+                    warmup.step()
+                n_steps += 1
+        synchronize(device)
+
+        # Sum over the shards of all processes
+        totals = reduce_sum(device, loss=train_loss, batches=len(trainloader), correct=correct, samples=n_samples)
+        train_loss = totals['loss'] / totals['batches']
+        n_samples = totals['samples']
+        train_accuracy = totals['correct'] / n_samples
         train_loss_list.append(train_loss)
         train_accuracy_list.append(train_accuracy)
-
-        # Evaluate
-        val_loss, val_accuracy = get_clf_loss_accuracy(model, loss_fn, valloader, device)
-        val_loss_list.append(val_loss)
-        val_accuracy_list.append(val_accuracy)
+        performance['images_per_s'].append(n_samples / (time.perf_counter() - tic))
+        performance['peak_memory_mb'].append(peak_memory_mb(device))
+        performance['samples_per_step'].append(n_samples / max(n_steps, 1))
 
         logs['loss'] = train_loss
-        logs['val_loss'] = val_loss
         logs['accuracy'] = train_accuracy
-        logs['val_accuracy'] = val_accuracy
-
-        # save best model
-        if val_accuracy > best_val_accuracy:
-            best_val_accuracy = val_accuracy
-            torch.save(model, save_path + name + '.pt')
-
-        liveloss.update(logs)
+        logs['images_per_s'] = performance['images_per_s'][-1]
+        logs['peak_memory_mb'] = performance['peak_memory_mb'][-1]
+        logs['samples_per_step'] = performance['samples_per_step'][-1]
+        liveloss.update(logs, current_step=epoch)
+
+        # Evaluate when scheduled, in the evaluator process if asynchronous; every process follows the schedule of
+        # the first one
+        arrived = []
+        if broadcast(schedule.is_due(epoch, n_epochs)):
+            if evaluator is not None:
+                evaluator.submit(epoch, state(epoch))
+            else:
+                # evaluation leaves the random state of the training unchanged
+                with preserve_rng(device):
+                    arrived.append((epoch, None, get_clf_loss_accuracy(module, loss_fn, valloader, device,
+                                                                       mixed_precision)))
+        if evaluator is not None:
+            if epoch == n_epochs - 1:
+                # Candidates are only queued for evaluation once written
+                writer.wait()
+            arrived.extend(evaluator.collect(wait=epoch == n_epochs - 1))
+
+        improved = False
+
+        for eval_epoch, checkpoint, (val_loss, val_accuracy) in arrived:
+            val_loss_list[eval_epoch] = val_loss
+            val_accuracy_list[eval_epoch] = val_accuracy
+            liveloss.update({'val_loss': val_loss, 'val_accuracy': val_accuracy}, current_step=eval_epoch)
+
+            # save best model
+            if val_accuracy > best_val_accuracy:
+                best_val_accuracy = val_accuracy
+                if checkpoint is None:
+                    improved = True
+                else:
+                    os.replace(checkpoint, best_path)
+            elif checkpoint is not None:
+                os.remove(checkpoint)
         liveloss.send()
-    return train_loss_list, val_loss_list, train_accuracy_list, val_accuracy_list
+
+        # Checkpoint the best model and the training state in the background, written by the first process only
+        paths = [best_path] if improved else []
+        if (epoch + 1) % checkpoint_every == 0 or epoch == n_epochs - 1:
+            paths.append(last_path)
+        if paths:
+            latest = state(epoch)
+            if is_main_process():
+                writer.save(latest, *paths)
+
+    if evaluator is not None:
+        evaluator.close()
+    writer.close()
+    if distributed:
+        # The checkpoints are written before any process reads them
+        torch.distributed.barrier()
+    return train_loss_list, val_loss_list, train_accuracy_list, val_accuracy_list, performance
@@ -1,33 +1,57 @@
+import numpy as np
 import torch
 from config import CLASSIFIER_PATH, CONFIG_CLASSIFIER, HYPERPARAMS_CLASSIFIER
-from config import CLF_TRAIN_PATH, CLF_VAL_PATH, CROPPED_PATH, DEVICE, PLOTS_PATH, DATA_PATH
-import torchvision.datasets as datasets
-from src.data.dataloader import get_clf_dataloader_from_dir
+from config import SPLIT_INDEX_PATH, CROPPED_PATH, DEVICE, DIST_BACKEND, PLOTS_PATH, DATA_PATH, PREPROCESS_CACHE_PATH
+from src.data.dataloader import get_clf_dataloader_from_dir, get_clf_dataloader_from_index
+from src.data.preprocess_cache import PreprocessCache
 from torchvision.models import ResNet50_Weights
 from src.models.pretrained import get_pretrained_resnet50
 from src.optimizers.adam import get_adam_optim
-from src.loss_fn.weighted_cross_entropy import compute_class_weights_from_dataset, get_weighted_cross_entropy_loss_fn
+from src.loss_fn.weighted_cross_entropy import compute_class_weights_from_index, get_weighted_cross_entropy_loss_fn
 from src.train import train_classifier
+from src.checkpoint import load_checkpoint
+from src.distributed import setup_distributed, cleanup_distributed, wrap_model, unwrap_model
+from src.data.coco.utils import is_main_process
+from src.eval_schedule import EvalScheduler
 from src.eval import get_clf_predictions, get_stats_from_confusion_matrix
 from src.data.plotlib import plot_confusion_matrix
 from sklearn.metrics import confusion_matrix
 from src.data.plotlib import plot_curves
 
 
-def train_classifier_pipline(all_data_dir, train_dir, val_dir, batch_size, n_epochs, name, save_path, device, lr):
+def train_classifier_pipline(index_path, data_dir, batch_size, n_epochs, name, save_path, device, lr, packed_dir=None,
+                             cache_preprocess=False, cache_path=None, schedule=None, async_eval=False,
+                             mixed_precision=False, accumulation_steps=1, warmup_steps=0, checkpoint_every=1,
+                             resume=False, distributed=False):
     ''' 
     Train a ResNet50 classifier model using the given hyperparameters and configurations.
     
     Input:
-        all_data_dir (str): Directory for full dataset of cropped bird images paired with labels in CSV format
-        train_dir (str): Directory for cropped bird train set
-        val_dir (str): Directory for cropped bird validation set
+        index_path (str): Path of the index file assigning every cropped bird image to the train, validation or test set
+        data_dir (str): Directory for full dataset of cropped bird images, the paths in the index are relative to it
         batch_size (int): Batch size to train the classification model
         n_epochs (int): Number of epochs to train the classification model
         name (str): Desired name of the classification model
         save_path (str): Path to save the trained model and training statistics
         device (str): The device to run the training on ('cpu' or 'cuda')
         lr (float): Learning rate to train the classification model
+        packed_dir (str, optional): Directory of the packed train, validation and test sets. If given, the train
+            and validation sets are read from the packed datasets instead of the image files. Default is None.
+        cache_preprocess (bool): Whether to resize and crop every image only once and cache the result instead of
+            preprocessing it every epoch. Default is False.
+        cache_path (str, optional): Directory to keep the cache on disk. Default is None, which caches in memory.
+        schedule (EvalScheduler, optional): Scheduler deciding after which epochs the model is evaluated.
+            Default is None, which evaluates after every epoch.
+        async_eval (bool): Whether to evaluate checkpoints in a separate process while training continues.
+            Default is False.
+        mixed_precision (bool): Whether to train and evaluate in mixed precision. Default is False.
+        accumulation_steps (int): Number of batches accumulated into every optimizer step. Default is 1.
+        warmup_steps (int): Number of optimizer steps of linear learning rate warmup. Default is 0.
+        checkpoint_every (int): Number of epochs between checkpoints of the training state. Default is 1.
+        resume (bool): Whether to resume from the latest checkpoint of the training state. Default is False.
+        distributed (bool): Whether the process is one of several training the model with distributed data
+            parallel, e.g. launched with launch.py. Only the first process plots and evaluates the best model.
+            Default is False.
     
     Output:
         Trained classification model
@@ -35,29 +59,51 @@ def train_classifier_pipline(all_data_dir, train_dir, val_dir, batch_size, n_epo
         Plot of confusion matrix for each object class in the test set
     '''
     # explore cropped bird images data
-    all_data = datasets.ImageFolder(all_data_dir)
-    all_dataloader = get_clf_dataloader_from_dir(all_data_dir, batch_size=batch_size, shuffle=False, preprocess=None)
+    all_dataloader = get_clf_dataloader_from_index(index_path, data_dir, None,
+                                                   batch_size=batch_size, shuffle=False, preprocess=None)
     class_names = all_dataloader.dataset.classes
 
     # compute weights and tranformations
     weights = ResNet50_Weights.IMAGENET1K_V2
     preprocess = weights.transforms()
+    cache = PreprocessCache.from_weights(weights, cache_path=cache_path) if cache_preprocess else None
+    decode_size = preprocess.resize_size[0]
 
-    # get dataloaders from image folders
-    trainloader = get_clf_dataloader_from_dir(train_dir, batch_size=batch_size, shuffle=True, preprocess=preprocess)
-    valloader = get_clf_dataloader_from_dir(val_dir, batch_size=batch_size, shuffle=False, preprocess=preprocess)
+    # get dataloaders from the split index or the packed datasets
+    if packed_dir:
+        trainloader = get_clf_dataloader_from_dir(packed_dir + 'train/', batch_size=batch_size, shuffle=True,
+                                                  preprocess=preprocess, cache=cache, decode_size=decode_size)
+        valloader = get_clf_dataloader_from_dir(packed_dir + 'val/', batch_size=batch_size, shuffle=False,
+                                                preprocess=preprocess, cache=cache, decode_size=decode_size)
+    else:
+        trainloader = get_clf_dataloader_from_index(index_path, data_dir, 'train', batch_size=batch_size,
+                                                    shuffle=True, preprocess=preprocess, cache=cache,
+                                                    decode_size=decode_size)
+        valloader = get_clf_dataloader_from_index(index_path, data_dir, 'val', batch_size=batch_size,
+                                                  shuffle=False, preprocess=preprocess, cache=cache,
+                                                  decode_size=decode_size)
 
     # get resnet50 model
     model = get_pretrained_resnet50(num_classes=len(class_names), weights=weights)
 
     # get optimizer and weighted cross entropy loss function
     optimizer = get_adam_optim(model, lr=lr)
-    class_weights = compute_class_weights_from_dataset(all_data)
+    class_weights = compute_class_weights_from_index(index_path)
     loss_fn = get_weighted_cross_entropy_loss_fn(class_weights, device=device)
+    if distributed:
+        model = wrap_model(model, device)
 
     # train classifier
     results = train_classifier(model, optimizer, loss_fn, n_epochs,
-                               trainloader, valloader, device, save_path, name)
+                               trainloader, valloader, device, save_path, name,
+                               schedule=schedule, async_eval=async_eval, mixed_precision=mixed_precision,
+                               accumulation_steps=accumulation_steps, warmup_steps=warmup_steps,
+                               checkpoint_every=checkpoint_every, resume=resume)
+    if not is_main_process():
+        return
+    print(f"Training throughput: {np.mean(results[4]['images_per_s']):.1f} images/s, "
+          f"peak memory: {np.max(results[4]['peak_memory_mb']):.0f} MB, "
+          f"samples per optimizer step: {np.mean(results[4]['samples_per_step']):.1f}")
 
     # plot loss curves and accuracy curves
     plot_curves(results[0], results[1], 'training loss', 'validation loss', 'epoch', 'loss',
@@ -66,7 +112,8 @@ def train_classifier_pipline(all_data_dir, train_dir, val_dir, batch_size, n_epo
                 f'Training and validation accuracy curves of {name} bird classifier', PLOTS_PATH)
 
     # load the best classifier
-    model = torch.load(save_path + name + '.pt')
+    model = unwrap_model(model)
+    model.load_state_dict(load_checkpoint(save_path + name + '.pt')['model'])
 
     true_labels, predicted = get_clf_predictions(model, valloader, device)
     true_labels_list = torch.concat(true_labels).tolist()
@@ -84,6 +131,18 @@ def train_classifier_pipline(all_data_dir, train_dir, val_dir, batch_size, n_epo
 
 
 if __name__ == '__main__':
-    train_classifier_pipline(CROPPED_PATH, CLF_TRAIN_PATH, CLF_VAL_PATH,
+    # Train in every process started by launch.py or torchrun, or in this process alone
+    distributed, device = setup_distributed(DEVICE, DIST_BACKEND)
+    schedule = EvalScheduler(CONFIG_CLASSIFIER['eval_every_epochs'], CONFIG_CLASSIFIER['eval_every_minutes'],
+                             CONFIG_CLASSIFIER['eval_subset'])
+    train_classifier_pipline(SPLIT_INDEX_PATH, CROPPED_PATH,
                              CONFIG_CLASSIFIER['batch_size'], HYPERPARAMS_CLASSIFIER['num_epoch'],
-                             CONFIG_CLASSIFIER['model'], CLASSIFIER_PATH, DEVICE, HYPERPARAMS_CLASSIFIER['l_r'])
+                             CONFIG_CLASSIFIER['model'], CLASSIFIER_PATH, device, HYPERPARAMS_CLASSIFIER['l_r'],
+                             cache_preprocess=CONFIG_CLASSIFIER['cache_preprocess'], cache_path=PREPROCESS_CACHE_PATH,
+                             schedule=schedule, async_eval=CONFIG_CLASSIFIER['async_eval'],
+                             mixed_precision=CONFIG_CLASSIFIER['mixed_precision'],
+                             accumulation_steps=CONFIG_CLASSIFIER['accumulation_steps'],
+                             warmup_steps=CONFIG_CLASSIFIER['warmup_steps'],
+                             checkpoint_every=CONFIG_CLASSIFIER['checkpoint_every'],
+                             resume=CONFIG_CLASSIFIER['resume'], distributed=distributed)
+    cleanup_distributed()
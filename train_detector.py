@@ -1,13 +1,21 @@
+import math
+import numpy as np
 import torch
-from config import CONFIG_DETECTOR, SEED, HYPERPARAMS_DETECTOR, DEVICE, BIRD_ONLY
-from config import DETECTOR_PATH, TILED_NEW_CSV_PATH, TILED_IMG_PATH, PLOTS_PATH, DPI
-from src.data.utils import get_file_names, split_img_annos
-from src.data.dataloader import get_od_dataloader
+from config import CONFIG_DETECTOR, SEED, HYPERPARAMS_DETECTOR, DEVICE, DIST_BACKEND, BIRD_ONLY, PREVIEW_SIZE
+from config import DETECTOR_PATH, TILED_NEW_CSV_PATH, TILED_IMG_PATH, TILED_ANNOTATIONS_PATH, PLOTS_PATH, DPI
+from config import NEW_CSV_PATH, IMG_PATH, ANNOTATIONS_PATH, CATALOG_PATH, TILED_CATALOG_PATH
+from src.data.annotation_store import AnnotationStore
+from src.data.catalog import Catalog
+from src.data.utils import split_img_annos
+from src.data.dataloader import get_od_dataloader, get_window_dataloader
 from src.data.transforms import get_transform
 from src.data.plotlib import plot_curves, plot_precision_recall, visualize_predictions
 from src.models.pretrained import get_pretrained_od_model
 from src.optimizers.sgd import get_sgd_optim
 from src.train import train_detector
+from src.distributed import setup_distributed, cleanup_distributed, wrap_model, unwrap_model
+from src.data.coco.utils import is_main_process
+from src.eval_schedule import EvalScheduler
 from src.eval import get_od_predictions
 
 
@@ -15,7 +23,12 @@ from src.eval import get_od_predictions
 torch.manual_seed(SEED)
 
 
-def train_detector_pipeline(csv_path, img_path, split_ratio, batch_size, num_classes, l_r, num_epoch, model_name):
+def train_detector_pipeline(csv_path, img_path, split_ratio, batch_size, num_classes, l_r, num_epoch, model_name,
+                            store_path=None, group_by_size=False, background_ratio=None, rare_repeat=1,
+                            window_size=None, windows_per_epoch=None, catalog_path=None, eval_workers=0,
+                            train_stats_fraction=None, schedule=None, async_eval=False, mixed_precision=False,
+                            accumulation_steps=1, warmup_steps=0, checkpoint_every=1, resume=False, device=DEVICE,
+                            distributed=False):
     ''' 
     Train a detector model using the given hyperparameters and configurations. 
     
@@ -28,35 +41,90 @@ def train_detector_pipeline(csv_path, img_path, split_ratio, batch_size, num_cla
         l_r (float): Learning rate to train the detection model
         num_epoch (int): Number of epochs to train the detection model 
         model_name (str): Desired name of the model object
+        store_path (str, optional): Path of the consolidated annotation file. If given, targets are read from it
+            in one read instead of from the CSV files. Default is None.
+        group_by_size (bool): Whether to batch training images of a similar size and aspect ratio together.
+            Default is False.
+        background_ratio (float, optional): Fraction of the training images without birds drawn every epoch.
+            Default is None, which uses every image.
+        rare_repeat (int): Number of times training images with rare species are drawn every epoch. Default is 1.
+        window_size (int or tuple, optional): If given, the model is trained on random windows of this size drawn
+            from the images, which are then the raw images, instead of on the images themselves. Default is None.
+        windows_per_epoch (int, optional): Number of training windows per epoch. Default is None.
+        catalog_path (str, optional): Path of the saved catalog of the images, which is validated against the
+            folders and updated. Default is None.
+        eval_workers (int): Number of processes evaluating the precision and recall. Default is 0.
+        train_stats_fraction (float, optional): Fraction of the training images on which the precision and
+            recall are evaluated every epoch. Default is None, which skips them.
+        schedule (EvalScheduler, optional): Scheduler deciding after which epochs the model is evaluated.
+            Default is None, which evaluates after every epoch.
+        async_eval (bool): Whether to evaluate checkpoints in a separate process while training continues.
+            Default is False.
+        mixed_precision (bool): Whether to train and evaluate in mixed precision. Default is False.
+        accumulation_steps (int): Number of batches accumulated into every optimizer step. Default is 1.
+        warmup_steps (int): Number of optimizer steps of linear learning rate warmup. Default is 0.
+        checkpoint_every (int): Number of epochs between checkpoints of the training state. Default is 1.
+        resume (bool): Whether to resume from the latest checkpoint of the training state. Default is False.
+        device (torch.device): Device to train on. Default is DEVICE.
+        distributed (bool): Whether the process is one of several training the model with distributed data
+            parallel, e.g. launched with launch.py. Only the first process saves, plots and visualizes.
+            Default is False.
         
     Output:
         A trained Torch object detection model
         Visualizations of training progress (loss and accuracy for each epoch)
         Evaluation metrics (precision and recall curves)
     '''
-    # Add JPG and CSV file names to a dictionary (makes referencing the files easier).
-    csv_files = get_file_names(csv_path, 'csv')
-    jpg_files = get_file_names(img_path, 'jpg')
+    # Pair JPG and CSV files by name through the catalog of the images
+    catalog = Catalog(img_path, csv_path, catalog_path)
+    if is_main_process():
+        catalog.save()
+    print('Catalog: ' + catalog.summary())
+    stems, jpg_files, csv_files = catalog.pairs()
 
     # Split the dataset into training set, test set, and validation set.
     trainset, testset, valset = split_img_annos(jpg_files, csv_files, split_ratio, seed=SEED)
-
-    # Dataloaders
-    trainloader = get_od_dataloader(
-        trainset['jpg'], trainset['csv'],
-        get_transform(train=True), batch_size,
-        True, BIRD_ONLY
-    )
-
-    valloader = get_od_dataloader(
-        valset['jpg'], valset['csv'],
-        get_transform(train=False), batch_size,
-        False, BIRD_ONLY
-    )
+    annotations = AnnotationStore(store_path) if store_path else None
 
     # Model and optimizer
     model = get_pretrained_od_model(num_classes)
     optimizer = get_sgd_optim(model, l_r)
+    if distributed:
+        model = wrap_model(model, device)
+
+    # Dataloaders
+    if window_size is not None:
+        # the model resizes large windows down to its input size, so they are decoded at that size
+        window = (window_size, window_size) if isinstance(window_size, int) else window_size
+        transform = unwrap_model(model).transform
+        scale = min(1, transform.min_size[-1] / min(window), transform.max_size / max(window))
+
+        # validation windows are drawn once, as the validation set never changes its epoch
+        val_windows = math.ceil(windows_per_epoch * split_ratio[2] / split_ratio[0])
+        trainloader = get_window_dataloader(
+            trainset['jpg'], trainset['csv'],
+            get_transform(train=True), batch_size,
+            BIRD_ONLY, window_size, windows_per_epoch, annotations,
+            seed=SEED, sizes=catalog.sizes(trainset['jpg']), scale=scale
+        )
+        valloader = get_window_dataloader(
+            valset['jpg'], valset['csv'],
+            get_transform(train=False), batch_size,
+            BIRD_ONLY, window_size, val_windows, annotations,
+            seed=SEED, sizes=catalog.sizes(valset['jpg']), scale=scale
+        )
+    else:
+        trainloader = get_od_dataloader(
+            trainset['jpg'], trainset['csv'],
+            get_transform(train=True), batch_size,
+            True, BIRD_ONLY, annotations, group_by_size, background_ratio, rare_repeat,
+            catalog.sizes(trainset['jpg'])
+        )
+        valloader = get_od_dataloader(
+            valset['jpg'], valset['csv'],
+            get_transform(train=False), batch_size,
+            False, BIRD_ONLY, annotations, sizes=catalog.sizes(valset['jpg'])
+        )
 
     # Train the model
     results = train_detector(
@@ -66,10 +134,24 @@ def train_detector_pipeline(csv_path, img_path, split_ratio, batch_size, num_cla
         num_epoch,
         trainloader,
         valloader,
-        DEVICE,
+        device,
         DETECTOR_PATH,
-        model_name
+        model_name,
+        eval_workers,
+        train_stats_fraction,
+        schedule,
+        async_eval,
+        mixed_precision,
+        accumulation_steps,
+        warmup_steps,
+        checkpoint_every,
+        resume
     )
+    if not is_main_process():
+        return
+    print(f"Training throughput: {np.mean(results[4]['images_per_s']):.1f} images/s, "
+          f"peak memory: {np.max(results[4]['peak_memory_mb']):.0f} MB, "
+          f"samples per optimizer step: {np.mean(results[4]['samples_per_step']):.1f}")
 
     # Plot the loss curves and precision-recall curves
     plot_curves(results[0], results[1], 'training loss', 'validation loss', 'epoch', 'loss',
@@ -79,16 +161,53 @@ def train_detector_pipeline(csv_path, img_path, split_ratio, batch_size, num_cla
     plot_precision_recall(results[3], 'epoch', 'precision and recall',
                           f'Validation precision and recall curves of {model_name} detector', PLOTS_PATH)
 
-    # Visualize the predictions
+    # Visualize the predictions on the validation windows or images
     batch = 0
-    preds = get_od_predictions(model, valloader, DEVICE, batch)
+    preds = get_od_predictions(unwrap_model(model), valloader, device, batch)
     for idx in range(len(preds)):
-        visualize_predictions(valset['jpg'][idx + batch * batch_size],
+        if window_size is not None:
+            image = valloader.dataset.window_image(idx + batch * batch_size)
+        else:
+            image = valset['jpg'][idx + batch * batch_size]
+        visualize_predictions(image,
                               preds[idx], PLOTS_PATH, model_name + '_batch_' + str(batch) + '_idx_' + str(idx),
-                              DPI, 0.5)
+                              DPI, 0.5, PREVIEW_SIZE)
 
 
 if __name__ == '__main__':
-    train_detector_pipeline(TILED_NEW_CSV_PATH, TILED_IMG_PATH,
-                            CONFIG_DETECTOR['data_split'], CONFIG_DETECTOR['batch_size'], CONFIG_DETECTOR['model'][1],
-                            HYPERPARAMS_DETECTOR['l_r'], HYPERPARAMS_DETECTOR['num_epoch'], CONFIG_DETECTOR['model'][0])
+    # Train in every process started by launch.py or torchrun, or in this process alone
+    distributed, device = setup_distributed(DEVICE, DIST_BACKEND)
+    schedule = EvalScheduler(CONFIG_DETECTOR['eval_every_epochs'], CONFIG_DETECTOR['eval_every_minutes'],
+                             CONFIG_DETECTOR['eval_subset'])
+    # Train on random windows of the raw images or on the pre-tiled images
+    if CONFIG_DETECTOR['window_size'] is not None:
+        train_detector_pipeline(NEW_CSV_PATH, IMG_PATH,
+                                CONFIG_DETECTOR['data_split'], CONFIG_DETECTOR['batch_size'],
+                                CONFIG_DETECTOR['model'][1], HYPERPARAMS_DETECTOR['l_r'],
+                                HYPERPARAMS_DETECTOR['num_epoch'], CONFIG_DETECTOR['model'][0], ANNOTATIONS_PATH,
+                                window_size=CONFIG_DETECTOR['window_size'],
+                                windows_per_epoch=CONFIG_DETECTOR['windows_per_epoch'], catalog_path=CATALOG_PATH,
+                                eval_workers=CONFIG_DETECTOR['eval_workers'],
+                                train_stats_fraction=CONFIG_DETECTOR['train_stats_fraction'],
+                                schedule=schedule, async_eval=CONFIG_DETECTOR['async_eval'],
+                                mixed_precision=CONFIG_DETECTOR['mixed_precision'],
+                                accumulation_steps=CONFIG_DETECTOR['accumulation_steps'],
+                                warmup_steps=CONFIG_DETECTOR['warmup_steps'],
+                                checkpoint_every=CONFIG_DETECTOR['checkpoint_every'],
+                                resume=CONFIG_DETECTOR['resume'], device=device, distributed=distributed)
+    else:
+        train_detector_pipeline(TILED_NEW_CSV_PATH, TILED_IMG_PATH,
+                                CONFIG_DETECTOR['data_split'], CONFIG_DETECTOR['batch_size'],
+                                CONFIG_DETECTOR['model'][1], HYPERPARAMS_DETECTOR['l_r'],
+                                HYPERPARAMS_DETECTOR['num_epoch'], CONFIG_DETECTOR['model'][0], TILED_ANNOTATIONS_PATH,
+                                CONFIG_DETECTOR['group_by_size'], CONFIG_DETECTOR['background_ratio'],
+                                CONFIG_DETECTOR['rare_repeat'], catalog_path=TILED_CATALOG_PATH,
+                                eval_workers=CONFIG_DETECTOR['eval_workers'],
+                                train_stats_fraction=CONFIG_DETECTOR['train_stats_fraction'],
+                                schedule=schedule, async_eval=CONFIG_DETECTOR['async_eval'],
+                                mixed_precision=CONFIG_DETECTOR['mixed_precision'],
+                                accumulation_steps=CONFIG_DETECTOR['accumulation_steps'],
+                                warmup_steps=CONFIG_DETECTOR['warmup_steps'],
+                                checkpoint_every=CONFIG_DETECTOR['checkpoint_every'],
+                                resume=CONFIG_DETECTOR['resume'], device=device, distributed=distributed)
+    cleanup_distributed()
@@ -1,53 +1,87 @@
-import splitfolders
+import os
 from config import PLOTS_PATH, DESC_MAPPING
 from config import OLD_CSV_PATH, NEW_CSV_PATH, TILED_OLD_CSV_PATH, TILED_NEW_CSV_PATH
-from config import DATA_PATH, IMG_PATH, CROPPED_PATH, CROPPED_SPLIT_PATH, SEED
-from src.data.convert_annotations import write_csv, add_class_id_and_data_exploration
-from src.data.crop_birds import cropping
+from config import DATA_PATH, IMG_PATH, CROPPED_PATH, SPLIT_INDEX_PATH, SEED, MANIFEST_PATH
+from config import ANNOTATIONS_PATH, TILED_ANNOTATIONS_PATH, CROPPED_PACKED_PATH
+from config import TILED_IMG_PATH, CATALOG_PATH, TILED_CATALOG_PATH
+from src.data.annotation_store import AnnotationStore
+from src.data.catalog import Catalog
+from src.data.convert_annotations import convert_annotations
+from src.data.crop_birds import cropping, build_split_index
+from src.data.manifest import Manifest
+from src.data.records import pack_samples
+from src.data.dataloader import IndexedImageDataset
 
 
-def update_database():
+def update_database(rebuild=False, pack=False):
     ''' 
     Process the dataset using the following steps: 
-        1. Update annotations on the original images by writing a new CSV file NEW_CSV_PATH.
-        2. Update annotations on the tiled images by creating a new CSV file TILED_NEW_CSV_PATH.
-        3. Plot a histogram of bird species distribution in the full image dataset.
-        4. Plot a histogram of bird species distribution in the tiled image dataset.
-        5. Crop the birds from the original images into folders according to their species class, 
-           using annotations in the NEW_CSV_PATH file and saving the cropped images in CROPPED_PATH.
-        6. Split the cropped images into train, validation, and test sets, and save them 
-           in a separate directory at CROPPED_SPLIT_PATH, with a ratio of (0.8, 0.1, 0.1) respectively.
+        1. Convert the annotations on the original images into new CSV files with class ids in NEW_CSV_PATH,
+           plot a histogram of bird species distribution and save all annotations in the consolidated file
+           ANNOTATIONS_PATH. Every CSV file is read once and written once.
+        2. Convert the annotations on the tiled images in the same way into TILED_NEW_CSV_PATH and
+           TILED_ANNOTATIONS_PATH.
+        3. Catalog the original and tiled images, pairing them with their annotations by file name, and save
+           the catalogs at CATALOG_PATH and TILED_CATALOG_PATH.
+        4. Crop the birds from the original images into folders according to their species class, 
+           using annotations in the ANNOTATIONS_PATH file and saving the cropped images in CROPPED_PATH.
+        5. Split the cropped images into train, validation, and test sets with a ratio of (0.8, 0.1, 0.1)
+           respectively, and save the assignment of every cropped image in the index file SPLIT_INDEX_PATH.
+        6. Optionally, pack the train, validation and test sets into large shard files at CROPPED_PACKED_PATH.
+
+    Every step records the content hashes of its inputs and the outputs produced from them in the manifest
+    at MANIFEST_PATH. On later runs only new or changed inputs are processed, and outputs whose inputs
+    vanished are removed.
+
+    Input:
+        rebuild (bool): Whether to ignore the manifest and process every input again. Default is False.
+        pack (bool): Whether to pack the train, validation and test sets into shard files. Default is False.
     
     Output: 
         Updated annotations in NEW_CSV_PATH and TILED_NEW_CSV_PATH
+        Consolidated annotations in ANNOTATIONS_PATH and TILED_ANNOTATIONS_PATH
+        Catalogs of the original and tiled images in CATALOG_PATH and TILED_CATALOG_PATH
         Histograms of species class distribution in the full image and tiled image datasets
         Cropped bird images organized into folders by species class
-        Training, validation and test sets of cropped images
+        Index file of the training, validation and test sets of cropped images
+        Packed training, validation and test sets of cropped images if pack is True
     '''
+    if rebuild and os.path.exists(MANIFEST_PATH):
+        os.remove(MANIFEST_PATH)
+    manifest = Manifest(MANIFEST_PATH)
 
-    # update annotations on original images
-    write_csv(OLD_CSV_PATH, NEW_CSV_PATH, DESC_MAPPING)
+    # convert annotations on original images, add class ids and save them in one consolidated file
+    convert_annotations(OLD_CSV_PATH, NEW_CSV_PATH, DESC_MAPPING,
+                        'Histogram of bird species (original images)',
+                        DATA_PATH, PLOTS_PATH, ANNOTATIONS_PATH, manifest)
 
-    # update annotations on tiled images
-    write_csv(TILED_OLD_CSV_PATH, TILED_NEW_CSV_PATH, DESC_MAPPING)
+    # convert annotations on tiled images, add class ids and save them in one consolidated file
+    convert_annotations(TILED_OLD_CSV_PATH, TILED_NEW_CSV_PATH, DESC_MAPPING,
+                        'Histogram of bird species (tiled images)',
+                        DATA_PATH, PLOTS_PATH, TILED_ANNOTATIONS_PATH, manifest)
+    manifest.save()
 
-    # add class id and data exploration on updated annotations of original images
-    add_class_id_and_data_exploration(NEW_CSV_PATH,
-                                      'Histogram of bird species (original images)',
-                                      DATA_PATH, PLOTS_PATH)
-
-    # add class id and data exploration on updated annotations of tiled images
-    add_class_id_and_data_exploration(TILED_NEW_CSV_PATH,
-                                      'Histogram of bird species (tiled images)',
-                                      DATA_PATH, PLOTS_PATH)
+    # catalog the original and tiled images, only reading the headers of new or changed images
+    catalog = Catalog(IMG_PATH, NEW_CSV_PATH, CATALOG_PATH)
+    catalog.save()
+    print('Catalog of original images: ' + catalog.summary())
+    tiled_catalog = Catalog(TILED_IMG_PATH, TILED_NEW_CSV_PATH, TILED_CATALOG_PATH)
+    tiled_catalog.save()
+    print('Catalog of tiled images: ' + tiled_catalog.summary())
 
     # croppe birds from original images into folders according to their species
-    cropping(NEW_CSV_PATH, IMG_PATH, CROPPED_PATH)
+    cropping(NEW_CSV_PATH, IMG_PATH, CROPPED_PATH, manifest, annotations=AnnotationStore(ANNOTATIONS_PATH),
+             catalog=catalog)
+    manifest.save()
+
+    # split cropped images into train, val, and test sets and save the assignment in an index file
+    build_split_index(CROPPED_PATH, SPLIT_INDEX_PATH, (0.8, 0.1, 0.1), SEED)
 
-    # split cropped images into train, val, and test sets and save them in a separate directory
-    splitfolders.ratio(CROPPED_PATH, output=CROPPED_SPLIT_PATH,
-                       seed=SEED,
-                       ratio=(0.8, 0.1, 0.1))
+    # pack the train, val, and test sets into shard files
+    if pack:
+        for split in ['train', 'val', 'test']:
+            data = IndexedImageDataset(SPLIT_INDEX_PATH, CROPPED_PATH, split)
+            pack_samples(data.samples, data.classes, CROPPED_PACKED_PATH + split + '/', seed=SEED)
 
 
 if __name__ == '__main__':